@@ -4,10 +4,19 @@ ffi = FFI()
 pmemobj_structs = """
     /* for pmemobj.py */
     typedef PMEMoid PObjPtr;
+    typedef struct {
+        size_t initialized;
+        size_t threshold[3];
+        size_t count[3];
+        size_t long_lived_total;
+        size_t long_lived_pending;
+        } PGCState;
     typedef struct {
         PObjPtr type_table;
         PObjPtr root_object;
         PObjPtr clean_shutdown;
+        PObjPtr intern_table;
+        PGCState gc_state;
         } PRoot;
     typedef struct {
         size_t ob_refcnt;
@@ -141,6 +150,20 @@ ffi.cdef("""
     typedef struct pmemobjpool PMEMobjpool;
     #define PMEMOBJ_MIN_POOL ...
     #define PMEMOBJ_MAX_ALLOC_SIZE ...
+    #define POBJ_XALLOC_ZERO ...
+    enum pobj_header_type {
+        POBJ_HEADER_LEGACY,
+        POBJ_HEADER_COMPACT,
+        POBJ_HEADER_NONE,
+        ...
+        };
+    struct pobj_alloc_class_desc {
+        size_t unit_size;
+        size_t alignment;
+        unsigned units_per_block;
+        enum pobj_header_type header_type;
+        unsigned class_id;
+        };
     typedef struct pmemoid {
         uint64_t pool_uuid_lo;
         uint64_t off;
@@ -172,6 +195,7 @@ ffi.cdef("""
     int pmemobj_tx_add_range_direct(const void *ptr, size_t size);
     PMEMoid pmemobj_tx_alloc(size_t size, uint64_t type_num);
     PMEMoid pmemobj_tx_zalloc(size_t size, uint64_t type_num);
+    PMEMoid pmemobj_tx_xalloc(size_t size, uint64_t type_num, uint64_t flags);
     PMEMoid pmemobj_tx_realloc(PMEMoid oid, size_t size, uint64_t type_num);
     PMEMoid pmemobj_tx_zrealloc(PMEMoid oid, size_t size, uint64_t type_num);
     PMEMoid pmemobj_tx_strdup(const char *s, uint64_t type_num);
@@ -180,6 +204,10 @@ ffi.cdef("""
     PMEMoid pmemobj_first(PMEMobjpool *pop);
     PMEMoid pmemobj_next(PMEMoid oid);
     uint64_t pmemobj_type_num(PMEMoid oid);
+    size_t pmemobj_alloc_usable_size(PMEMoid oid);
+    int pmemobj_ctl_get(PMEMobjpool *pop, const char *name, void *arg);
+    int pmemobj_ctl_set(PMEMobjpool *pop, const char *name, void *arg);
+    int pmemobj_ctl_exec(PMEMobjpool *pop, const char *name, void *arg);
 
 """ + pmemobj_structs)
 
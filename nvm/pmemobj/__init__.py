@@ -1,4 +1,5 @@
 from .pool import open, create, MIN_POOL_SIZE, PersistentObjectPool
+from .pool import ctl_get, ctl_set, ctl_exec
 from .list import PersistentList
 from .dict import PersistentDict
 from .object import PersistentObject
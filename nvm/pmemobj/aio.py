@@ -0,0 +1,120 @@
+"""Use a PersistentObjectPool from asyncio code.
+
+Changing a pool means running transactions, which block, so they shouldn't
+be run in an event loop's thread.  An AsyncPool runs them in a thread of its
+own instead, and gives the loop something to await.  This module requires
+Python 3.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import queue
+from threading import Thread
+
+log = logging.getLogger('nvm.pmemobj.aio')
+
+# The most queued functions a group commit runs in one transaction.
+GROUP_COMMIT_MAX = 100
+
+
+class AsyncPool(object):
+    """Run functions in transactions on a pool, in a thread of their own.
+
+    The functions are run one at a time in the order they were submitted.
+    If group_commit is true, functions that are waiting when the thread is
+    ready for more work are run together in a single transaction, up to
+    max_group of them, which saves the cost of committing each one.  If one
+    of them raises an exception, the whole group is rolled back and they
+    are rerun one transaction each, so that only that one fails.  Since a
+    function may be run more than once, it should only change persistent
+    objects.  Each transaction is run with the pool's run_transaction, so
+    is retried if the pool runs out of memory.
+    """
+
+    def __init__(self, pool, group_commit=False, max_group=GROUP_COMMIT_MAX):
+        self.pool = pool
+        self.group_commit = group_commit
+        self.max_group = max_group
+        self.closed = False
+        self._queue = queue.Queue()
+        self._thread = Thread(target=self._work, name='nvm.pmemobj.aio')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self, fn, *args):
+        """Return an awaitable for the result of fn(*args).
+
+        fn is called in a transaction in the AsyncPool's thread.  If it
+        raises an exception, the transaction is aborted and awaiting the
+        result raises the exception.  Must be called from a thread with an
+        event loop.
+        """
+        if self.closed:
+            raise RuntimeError("the AsyncPool is closed")
+        future = concurrent.futures.Future()
+        self._queue.put((fn, args, future))
+        return asyncio.wrap_future(future)
+
+    def close(self):
+        """Wait for the functions already submitted to finish, and stop.
+
+        The pool itself is not closed.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _work(self):
+        get = self._queue.get
+        while True:
+            group = [get()]
+            if self.group_commit:
+                while len(group) < self.max_group and group[-1] is not None:
+                    try:
+                        group.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+            stop = group[-1] is None
+            if stop:
+                group.pop()
+            # Skip the ones whose awaiters have been cancelled.
+            group = [item for item in group
+                     if item[2].set_running_or_notify_cancel()]
+            if len(group) > 1:
+                self._run_group(group)
+            elif group:
+                self._run_one(*group[0])
+            if stop:
+                return
+
+    def _run_one(self, fn, args, future):
+        try:
+            result = self.pool.run_transaction(lambda: fn(*args))
+        # Pass on anything fn raises, even SystemExit, so that the awaiter
+        # isn't left waiting forever.
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def _run_group(self, group):
+        log.debug('group commit of %d transactions', len(group))
+        try:
+            results = self.pool.run_transaction(
+                lambda: [fn(*args) for fn, args, future in group])
+        except BaseException:
+            log.debug('group commit failed, running singly')
+            for item in group:
+                self._run_one(*item)
+            return
+        for (fn, args, future), result in zip(group, results):
+            future.set_result(result)
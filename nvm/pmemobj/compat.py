@@ -9,9 +9,13 @@ except ImportError:
     import collections as abc
 
 try:
-    from reprlib import recursive_repr
+    from threading import get_ident
 except ImportError:
     from thread import get_ident
+
+try:
+    from reprlib import recursive_repr
+except ImportError:
     def recursive_repr(fillvalue='...'):
         'Decorator to make a repr function return fillvalue for a recursive call'
         def decorating_function(user_function):
@@ -30,6 +34,33 @@ except ImportError:
         return decorating_function
 
 
+if hasattr(int, 'from_bytes'):
+    def int_to_bytes(i, size):
+        """Return i as size bytes of little endian two's complement."""
+        return i.to_bytes(size, 'little', signed=True)
+
+    def int_from_bytes(b):
+        """Return the int stored in b as little endian two's complement."""
+        return int.from_bytes(b, 'little', signed=True)
+else:
+    import binascii
+
+    def int_to_bytes(i, size):
+        """Return i as size bytes of little endian two's complement."""
+        if i < 0:
+            i += 1 << (size * 8)
+        return binascii.unhexlify('%0*x' % (size * 2, i))[::-1]
+
+    def int_from_bytes(b):
+        """Return the int stored in b as little endian two's complement."""
+        if not b:
+            return 0
+        i = int(binascii.hexlify(b[::-1]), 16)
+        if ord(b[-1]) & 0x80:
+            i -= 1 << (len(b) * 8)
+        return i
+
+
 def _coerce_fn(file_name):
     """Return 'char *' compatible file_name on both python2 and python3."""
     if sys.version_info[0] > 2 and hasattr(file_name, 'encode'):
@@ -63,8 +63,6 @@ def _usable_fraction(n):
 class PersistentDict(abc.MutableMapping):
     """Persistent version of the 'dict' type."""
 
-    # XXX locking
-
     def __init__(self, *args, **kw):
         if len(args) > 1:
             raise TypeError("PersistentDict expected at most 1"
@@ -82,7 +80,6 @@ class PersistentDict(abc.MutableMapping):
     def _p_new(self, manager):
         mm = self._p_mm = manager
         with mm.transaction():
-            # XXX will want to implement a freelist here.
             self._p_oid = mm.zalloc(ffi.sizeof('PDictObject'))
             ob = ffi.cast('PObject *', mm.direct(self._p_oid))
             ob.ob_type = mm._get_type_code(PersistentDict)
@@ -119,12 +116,8 @@ class PersistentDict(abc.MutableMapping):
             dk.dk_refcnt = 1
             dk.dk_size = size
             dk.dk_usable = _usable_fraction(size)
-            ep = ffi.cast('PDictKeyEntry *', ffi.addressof(dk.dk_entries[0]))
-            # Hash value of slot 0 is used by popitem, so it must be initizlied
-            ep[0].me_hash = 0
-            for i in range(size):
-                ep[i].me_key = mm.OID_NULL
-                ep[i].me_value = mm.OID_NULL
+            # The zeroed entries already have a 0 hash (slot 0's is used by
+            # popitem, so it must be initialized) and OID_NULL keys and values.
             # XXX Set dk_lookup to lookdict_unicode_nodummy if we end up using it.
         return dk_oid
 
@@ -166,7 +159,7 @@ class PersistentDict(abc.MutableMapping):
             perturb = khash
             while True:
                 i = (i << 2) + i + perturb + 1
-                ep = ep0[i & mask]
+                ep = ffi.addressof(ep0[i & mask])
                 me_key = mm.otuple(ep.me_key)
                 if me_key == mm.OID_NULL:
                     return ep if freeslot is None else freeslot
@@ -195,7 +188,7 @@ class PersistentDict(abc.MutableMapping):
         perturb = khash
         while mm.otuple(ep.me_key) != mm.OID_NULL:
             i = (i << 2) + i + perturb + 1
-            ep = ep0[i & mask]
+            ep = ffi.addressof(ep0[i & mask])
             perturb = perturb >> PERTURB_SHIFT
         assert mm.otuple(ep.me_key) == mm.OID_NULL
         return ep
@@ -245,20 +238,23 @@ class PersistentDict(abc.MutableMapping):
                     ep.me_hash, mm.otuple(ep.me_key), mm.otuple(ep.me_value))
 
     def __len__(self):
-        return self._body.ma_used
+        with self._p_mm.object_lock(self).shared():
+            return self._body.ma_used
 
     def __setitem__(self, key, value):
         # This is modeled on CPython's insertdict.
         khash = fixed_hash(key)
         mm = self._p_mm
-        keys = self._keys
-        ep = self._lookdict(key, khash)
         with mm.transaction():
+            mm.lock(self)
+            keys = self._keys
+            ep = self._lookdict(key, khash)
             v_oid = mm.persist(value)
             old_v_oid = mm.otuple(ep.me_value)
             me_key = mm.otuple(ep.me_key)
             if old_v_oid != mm.OID_NULL:
                 assert me_key not in (mm.OID_NULL, DUMMY)
+                mm.snapshot_range(ep, ffi.sizeof('PDictKeyEntry'))
                 ep.me_value = v_oid
                 mm.incref(v_oid)
                 mm.decref(old_v_oid)
@@ -269,19 +265,25 @@ class PersistentDict(abc.MutableMapping):
                     self._insertion_resize()
                     keys = self._keys
                 ep = self._find_empty_slot(key, khash)
+                mm.snapshot_range(ffi.addressof(keys, 'dk_usable'),
+                                  ffi.sizeof('ssize_t'))
                 keys.dk_usable -= 1
                 assert keys.dk_usable >= 0, "dk_usable is %s" % keys.dk_usable
+                mm.snapshot_range(ep, ffi.sizeof('PDictKeyEntry'))
                 ep.me_key = k_oid
                 mm.incref(k_oid)
                 ep.me_hash = khash
             else:
                 if me_key == DUMMY:
+                    mm.snapshot_range(ep, ffi.sizeof('PDictKeyEntry'))
                     ep.me_key = k_oid
                     mm.incref(k_oid)
                     ep.me_hash = khash
                 else:
                     raise NotImplementedError("CPython algo thinks this should"
                                               " be a split dict at this point")
+            mm.snapshot_range(ffi.addressof(self._body, 'ma_used'),
+                              ffi.sizeof('size_t'))
             self._body.ma_used += 1
             ep.me_value = v_oid
             mm.incref(v_oid)
@@ -290,28 +292,50 @@ class PersistentDict(abc.MutableMapping):
     def __getitem__(self, key):
         mm = self._p_mm
         khash = fixed_hash(key)
-        ep = self._lookdict(key, khash)
-        if ep is None or mm.otuple(ep.me_value) == mm.OID_NULL:
-            raise KeyError(key)
+        with mm.object_lock(self).shared():
+            ep = self._lookdict(key, khash)
+            if ep is None or mm.otuple(ep.me_value) == mm.OID_NULL:
+                raise KeyError(key)
+            return mm.resurrect(ep.me_value)
+
+    def __contains__(self, key):
         mm = self._p_mm
-        return self._p_mm.resurrect(ep.me_value)
+        khash = fixed_hash(key)
+        with mm.object_lock(self).shared():
+            ep = self._lookdict(key, khash)
+            return ep is not None and mm.otuple(ep.me_value) != mm.OID_NULL
 
     def __delitem__(self, key):
         mm = self._p_mm
         khash = fixed_hash(key)
-        ep = self._lookdict(key, khash)
-        if ep is None or mm.otuple(ep.me_value) == mm.OID_NULL:
-            raise KeyError(key)
         with mm.transaction():
-            old_value_oid = mm.otuple(ep.me_value)
-            ep.me_value = mm.OID_NULL
-            self._body.ma_used -= 1
-            old_key_oid = mm.otuple(ep.me_key)
-            ep.me_key = DUMMY
-            mm.decref(old_value_oid)
-            mm.decref(old_key_oid)
+            mm.lock(self)
+            ep = self._lookdict(key, khash)
+            # Raising in here would abort any enclosing transaction.
+            missing = ep is None or mm.otuple(ep.me_value) == mm.OID_NULL
+            if not missing:
+                mm.snapshot_range(ep, ffi.sizeof('PDictKeyEntry'))
+                mm.snapshot_range(ffi.addressof(self._body, 'ma_used'),
+                                  ffi.sizeof('size_t'))
+                old_value_oid = mm.otuple(ep.me_value)
+                ep.me_value = mm.OID_NULL
+                self._body.ma_used -= 1
+                old_key_oid = mm.otuple(ep.me_key)
+                ep.me_key = DUMMY
+                mm.decref(old_value_oid)
+                mm.decref(old_key_oid)
+        if missing:
+            raise KeyError(key)
 
     def __iter__(self):
+        mm = self._p_mm
+        if mm.object_locks:
+            # Rather than holding the lock between items, take a copy.
+            with mm.object_lock(self).shared():
+                return iter(list(self._iter_keys()))
+        return self._iter_keys()
+
+    def _iter_keys(self):
         mm = self._p_mm
         keys = self._keys
         ep0 = ffi.cast('PDictKeyEntry *', ffi.addressof(keys.dk_entries[0]))
@@ -333,16 +357,8 @@ class PersistentDict(abc.MutableMapping):
     # Additional methods required by the pmemobj API.
 
     def _p_traverse(self):
-        mm = self._p_mm
-        keys = self._keys
-        ep0 = ffi.cast('PDictKeyEntry *', ffi.addressof(keys.dk_entries[0]))
-        for i in range(keys.dk_size):
-            ep = ep0[i]
-            if (ep.me_hash == ffi.NULL
-                    or mm.otuple(ep.me_key) in (mm.OID_NULL, DUMMY)):
-                continue
-            yield mm.otuple(ep.me_key)
-            yield mm.otuple(ep.me_value)
+        return self._p_traverse_raw(self._p_mm,
+                                    ffi.cast('PObject *', self._body))
 
     def _p_substructures(self):
         return ((self._p_mm.otuple(self._body.ma_keys),
@@ -352,3 +368,27 @@ class PersistentDict(abc.MutableMapping):
     def _p_deallocate(self):
         self.clear()
         self._p_mm.free(self._body.ma_keys)
+
+    # Versions of the above that work directly on the PObject, so that the
+    # gc doesn't need to resurrect the dict.
+
+    @staticmethod
+    def _p_traverse_raw(manager, p_obj):
+        body = ffi.cast('PDictObject *', p_obj)
+        keys = ffi.cast('PDictKeysObject *', manager.direct(body.ma_keys))
+        ep0 = ffi.cast('PDictKeyEntry *', ffi.addressof(keys.dk_entries[0]))
+        for i in range(keys.dk_size):
+            ep = ep0[i]
+            if (ep.me_hash == ffi.NULL
+                    or manager.otuple(ep.me_key) in (manager.OID_NULL, DUMMY)):
+                continue
+            yield manager.otuple(ep.me_key)
+            yield manager.otuple(ep.me_value)
+
+    @staticmethod
+    def _p_deallocate_raw(manager, p_obj):
+        # Unlike clear, this doesn't delete the items one at a time.
+        body = ffi.cast('PDictObject *', p_obj)
+        for oid in PersistentDict._p_traverse_raw(manager, p_obj):
+            manager.decref(oid)
+        manager.free(body.ma_keys)
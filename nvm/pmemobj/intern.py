@@ -0,0 +1,166 @@
+import sys
+
+from _pmem import ffi
+from .dict import fixed_hash
+from .set import (HASH_DUMMY, HASH_UNUSED, PERM_SET_MINSIZE, LINEAR_PROBES,
+                  PERTURB_SHIFT)
+
+INTERN_TABLE_ARRAY_TYPE_NUM = 70
+
+HASH_DUMMY = int(HASH_DUMMY)
+
+# The types whose (non-inline) values get interned.
+if sys.version_info[0] > 2:
+    internable_types = frozenset((str, bytes, int, float))
+else:
+    internable_types = frozenset((str, unicode, int, long, float))
+
+
+class InternTable(object):
+    """Persistent index of immutable values, so equal values share an oid.
+
+    The table maps a value's fixed_hash to the oid it is stored at.  It does
+    not hold references to the values it indexes: the MemoryManager removes a
+    value from the table when the value is deallocated.  The layout is that of
+    a PersistentSet, using the same open addressing scheme.
+    """
+
+    def _p_new(self, manager):
+        mm = self._p_mm = manager
+        with mm.transaction():
+            self._p_oid = mm.zalloc(ffi.sizeof('PSetObject'))
+            ob = ffi.cast('PObject *', mm.direct(self._p_oid))
+            ob.ob_type = mm._get_type_code(self.__class__)
+            self._body = ffi.cast('PSetObject *', mm.direct(self._p_oid))
+            self._body.mask = PERM_SET_MINSIZE - 1
+            self._body.table = self._alloc_empty_table(PERM_SET_MINSIZE)
+
+    def _p_resurrect(self, manager, oid):
+        self._p_mm = manager
+        self._p_oid = oid
+        self._body = ffi.cast('PSetObject *', manager.direct(oid))
+
+    def _alloc_empty_table(self, tablesize):
+        return self._p_mm.zalloc(ffi.sizeof('PSetEntry') * tablesize,
+                                 type_num=INTERN_TABLE_ARRAY_TYPE_NUM)
+
+    @staticmethod
+    def _hash(value):
+        # Keep clear of the hash values used as table markers.
+        h = fixed_hash(value)
+        if h == HASH_UNUSED or h == HASH_DUMMY:
+            h = 1
+        return h
+
+    def _probe(self, h):
+        """Yield the table indexes to visit looking for hash h."""
+        mask = self._body.mask
+        perturb = h
+        i = h & mask
+        while True:
+            yield i
+            for j in range(i + 1, min(i + LINEAR_PROBES, mask) + 1):
+                yield j
+            perturb >>= PERTURB_SHIFT
+            i = (i * 5 + 1 + perturb) & mask
+
+    def lookup(self, value):
+        """Return the oid at which an equal value is stored, or None."""
+        mm = self._p_mm
+        h = self._hash(value)
+        table = ffi.cast('PSetEntry *', mm.direct(self._body.table))
+        for i in self._probe(h):
+            entry = table[i]
+            if entry.hash == HASH_UNUSED:
+                return None
+            if entry.hash == h:
+                oid = mm.otuple(entry.key)
+                candidate = mm.resurrect(oid)
+                if isinstance(candidate, memoryview):
+                    candidate = candidate.tobytes()
+                # 1 == 1.0, but they aren't interchangeable.
+                if type(candidate) is type(value) and candidate == value:
+                    return oid
+
+    def add(self, oid, value):
+        """Record that value is stored at oid."""
+        mm = self._p_mm
+        h = self._hash(value)
+        with mm.transaction():
+            if (self._body.fill + 1) * 3 >= (self._body.mask + 1) * 2:
+                self._resize(self._body.used + 1)
+            table = ffi.cast('PSetEntry *', mm.direct(self._body.table))
+            for i in self._probe(h):
+                entry_hash = table[i].hash
+                if entry_hash == HASH_UNUSED or entry_hash == HASH_DUMMY:
+                    break
+            mm.snapshot_range(ffi.addressof(table, i), ffi.sizeof('PSetEntry'))
+            table[i].key = oid
+            table[i].hash = h
+            mm.snapshot_range(ffi.addressof(self._body, 'fill'),
+                              ffi.sizeof('size_t') * 2)
+            if entry_hash == HASH_UNUSED:
+                self._body.fill += 1
+            self._body.used += 1
+
+    def discard(self, oid, value):
+        """Remove the entry for value stored at oid, if there is one."""
+        mm = self._p_mm
+        oid = mm.otuple(oid)
+        h = self._hash(value)
+        table = ffi.cast('PSetEntry *', mm.direct(self._body.table))
+        for i in self._probe(h):
+            entry = table[i]
+            if entry.hash == HASH_UNUSED:
+                return
+            if entry.hash == h and mm.otuple(entry.key) == oid:
+                break
+        with mm.transaction():
+            mm.snapshot_range(ffi.addressof(table, i), ffi.sizeof('PSetEntry'))
+            table[i].key = mm.OID_NULL
+            table[i].hash = HASH_DUMMY
+            mm.snapshot_range(ffi.addressof(self._body, 'used'),
+                              ffi.sizeof('size_t'))
+            self._body.used -= 1
+
+    def _resize(self, minused):
+        mm = self._p_mm
+        newsize = PERM_SET_MINSIZE
+        while newsize <= minused * 2:
+            newsize <<= 1
+        with mm.transaction():
+            oldtable = mm.otuple(self._body.table)
+            old = ffi.cast('PSetEntry *', mm.direct(oldtable))
+            oldsize = self._body.mask + 1
+            mm.snapshot_range(ffi.addressof(self._body, 'fill'),
+                              ffi.sizeof('PSetObject') - ffi.sizeof('PObject'))
+            self._body.mask = newsize - 1
+            self._body.fill = self._body.used
+            self._body.table = self._alloc_empty_table(newsize)
+            # The new table was allocated in this transaction, so it doesn't
+            # need snapshotting.
+            new = ffi.cast('PSetEntry *', mm.direct(self._body.table))
+            for i in range(oldsize):
+                h = old[i].hash
+                if h == HASH_UNUSED or h == HASH_DUMMY:
+                    continue
+                for j in self._probe(h):
+                    if new[j].hash == HASH_UNUSED:
+                        break
+                new[j].key = old[i].key
+                new[j].hash = h
+            mm.free(oldtable)
+
+    # Persistent interface.  The table holds no references.
+
+    def _p_traverse(self):
+        return ()
+
+    def _p_substructures(self):
+        return ((self._body.table, INTERN_TABLE_ARRAY_TYPE_NUM),)
+
+    def _p_deallocate(self):
+        self._p_mm.free(self._body.table)
+
+    def __len__(self):
+        return self._body.used
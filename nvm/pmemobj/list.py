@@ -12,7 +12,6 @@ LIST_POBJPTR_ARRAY_TYPE_NUM = 30
 class PersistentList(abc.MutableSequence):
     """Persistent version of the 'list' type."""
 
-    # XXX locking!
     # XXX All bookkeeping attrs should be _v_xxxx so that all other attrs
     #     (other than _p_mm) can be made persistent.
 
@@ -27,7 +26,6 @@ class PersistentList(abc.MutableSequence):
     def _p_new(self, manager):
         mm = self._p_mm = manager
         with mm.transaction():
-            # XXX Will want to implement a freelist here, like CPython
             self._p_oid = mm.zalloc(ffi.sizeof('PListObject'))
             ob = ffi.cast('PObject *', mm.direct(self._p_oid))
             ob.ob_type = mm._get_type_code(PersistentList)
@@ -90,9 +88,10 @@ class PersistentList(abc.MutableSequence):
 
     def insert(self, index, value):
         mm = self._p_mm
-        size = self._size
-        newsize = size + 1
         with mm.transaction():
+            mm.lock(self)
+            size = self._size
+            newsize = size + 1
             self._resize(newsize)
             if index < 0:
                 index += size
@@ -102,7 +101,7 @@ class PersistentList(abc.MutableSequence):
                 index = size
             items = self._items
             mm.snapshot_range(items + index,
-                              ffi.offsetof('PObjPtr *', newsize))
+                              (newsize - index) * ffi.sizeof('PObjPtr'))
             for i in range(size, index, -1):
                 items[i] = items[i-1]
             v_oid = mm.persist(value)
@@ -110,56 +109,89 @@ class PersistentList(abc.MutableSequence):
             items[index] = v_oid
             ffi.cast('PVarObject *', self._body).ob_size = newsize
 
-    def _normalize_index(self, index):
+    def _int_index(self, index):
         try:
-            index = int(index)
+            return int(index)
         except TypeError:
             # Assume it is a slice
             # XXX fixme
             raise NotImplementedError("Slicing not yet implemented")
+
+    def _checked_index(self, index):
+        # Return the int index normalized to the list's size, or None if it
+        # is out of range.
         if index < 0:
             index += self._size
         if index < 0 or index >= self._size:
-            raise IndexError(index)
+            return None
         return index
 
+    def _normalize_index(self, index):
+        i = self._checked_index(self._int_index(index))
+        if i is None:
+            raise IndexError(index)
+        return i
+
+    # The mutating methods check the index once they hold the lock, but
+    # don't raise until they have left their transaction, since that would
+    # abort any enclosing transaction.
+
     def __setitem__(self, index, value):
         mm = self._p_mm
-        index = self._normalize_index(index)
-        items = self._items
+        index = self._int_index(index)
         with mm.transaction():
-            v_oid = mm.persist(value)
-            mm.snapshot_range(ffi.addressof(items, index),
-                              ffi.sizeof('PObjPtr *'))
-            mm.xdecref(items[index])
-            items[index] = v_oid
-            mm.incref(v_oid)
+            mm.lock(self)
+            i = self._checked_index(index)
+            if i is not None:
+                items = self._items
+                v_oid = mm.persist(value)
+                mm.snapshot_range(ffi.addressof(items, i),
+                                  ffi.sizeof('PObjPtr'))
+                mm.xdecref(items[i])
+                items[i] = v_oid
+                mm.incref(v_oid)
+        if i is None:
+            raise IndexError(index)
 
     def __delitem__(self, index):
         mm = self._p_mm
-        index = self._normalize_index(index)
+        index = self._int_index(index)
+        with mm.transaction():
+            mm.lock(self)
+            i = self._checked_index(index)
+            if i is not None:
+                self._delete(i)
+        if i is None:
+            raise IndexError(index)
+
+    def _delete(self, index):
+        # Called in a transaction, holding the lock.
+        mm = self._p_mm
         size = self._size
         newsize = size - 1
         items = self._items
-        with mm.transaction():
-            ffi.cast('PVarObject *', self._body).ob_size = newsize
-            # We can't completely hide the process of transformation...this
-            # really needs a lock (or translation to GIL-locked C).
-            mm.snapshot_range(ffi.addressof(items, index),
-                              ffi.offsetof('PObjPtr *', size))
-            oid = mm.otuple(items[index])
-            for i in range(index, newsize):
-                items[i] = items[i+1]
-            mm.decref(oid)
-            self._resize(newsize)
+        ob = ffi.cast('PVarObject *', self._body)
+        mm.snapshot_range(ffi.addressof(ob, 'ob_size'),
+                          ffi.sizeof('size_t'))
+        ob.ob_size = newsize
+        mm.snapshot_range(ffi.addressof(items, index),
+                          (size - index) * ffi.sizeof('PObjPtr'))
+        oid = mm.otuple(items[index])
+        for i in range(index, newsize):
+            items[i] = items[i+1]
+        mm.decref(oid)
+        self._resize(newsize)
 
     def __getitem__(self, index):
-        index = self._normalize_index(index)
-        items = self._items
-        return self._p_mm.resurrect(items[index])
+        mm = self._p_mm
+        with mm.object_lock(self).shared():
+            index = self._normalize_index(index)
+            items = self._items
+            return mm.resurrect(items[index])
 
     def __len__(self):
-        return self._size
+        with self._p_mm.object_lock(self).shared():
+            return self._size
 
     # Additional list methods not provided by the ABC.
 
@@ -187,11 +219,18 @@ class PersistentList(abc.MutableSequence):
         mm = self._p_mm
         if self._size == 0:
             return
-        items = self._items
         with mm.transaction():
+            mm.lock(self)
             size = self._size
+            if size == 0:
+                return
+            items = self._items
             # Set size to zero now so we never have an invalid state.
-            ffi.cast('PVarObject *', self._body).ob_size = 0
+            ob = ffi.cast('PVarObject *', self._body)
+            mm.snapshot_range(ffi.addressof(ob, 'ob_size'),
+                              ffi.sizeof('size_t'))
+            ob.ob_size = 0
+            mm.snapshot_range(items, size * ffi.sizeof('PObjPtr'))
             for i in range(size):
                 # Grab oid in tuple form so the assignment can't change it
                 oid = mm.otuple(items[i])
@@ -202,12 +241,36 @@ class PersistentList(abc.MutableSequence):
     # Additional methods required by the pmemobj API.
 
     def _p_traverse(self):
-        items = self._items
-        for i in range(len(self)):
-            yield items[i]
+        return self._p_traverse_raw(self._p_mm,
+                                    ffi.cast('PObject *', self._body))
 
     def _p_substructures(self):
         return ((self._body.ob_items, LIST_POBJPTR_ARRAY_TYPE_NUM),)
 
     def _p_deallocate(self):
         self.clear()
+
+    # Versions of the above that work directly on the PObject, so that the
+    # gc doesn't need to resurrect the list.  PTupleObject has the same
+    # layout up to ob_items, so PersistentTuple shares _p_traverse_raw.
+
+    @staticmethod
+    def _p_traverse_raw(manager, p_obj):
+        body = ffi.cast('PListObject *', p_obj)
+        size = body.ob_base.ob_size
+        if not size:
+            return
+        items = ffi.cast('PObjPtr *', manager.direct(body.ob_items))
+        for i in range(size):
+            yield manager.otuple(items[i])
+
+    @staticmethod
+    def _p_deallocate_raw(manager, p_obj):
+        # Like clear, but without emptying the list first, since its memory
+        # is about to be freed anyway.
+        body = ffi.cast('PListObject *', p_obj)
+        if not body.ob_base.ob_size:
+            return
+        for oid in PersistentList._p_traverse_raw(manager, p_obj):
+            manager.decref(oid)
+        manager.free(body.ob_items)
@@ -23,15 +23,18 @@ class PersistentObject(object):
         with self._p_mm.transaction()
             self.done.append(self.pending.pop())
 
-    """
+    If the MemoryManager's object_locks is true, the method can also call
+    self._p_mm.lock(self) in the transaction, to hold the object's lock until
+    the transaction ends.  Other threads that read both lists in a
+    "with self._p_mm.object_lock(self).shared():" block then see them change
+    together.
 
-    # XXX locking
+    """
 
     def _p_new(self, manager):
         self._p_dict = {}    # This makes __getattribute__ simpler
         mm = self._p_mm = manager
         with mm.transaction():
-            # XXX will want to implement a freelist here.
             self._p_oid = mm.zalloc(ffi.sizeof('PObjectObject'))
             ob = ffi.cast('PObject *', mm.direct(self._p_oid))
             ob.ob_type = mm._get_type_code(self.__class__)
@@ -86,5 +89,17 @@ class PersistentObject(object):
     def _p_deallocate(self):
         self._p_mm.decref(self._p_body.ob_dict)
 
+    # Versions of the above that work directly on the PObject, so that the
+    # gc doesn't need to resurrect the object.  These are only used for
+    # subclasses that don't override _p_traverse or _p_deallocate.
+
+    @staticmethod
+    def _p_traverse_raw(manager, p_obj):
+        yield manager.otuple(ffi.cast('PObjectObject *', p_obj).ob_dict)
+
+    @staticmethod
+    def _p_deallocate_raw(manager, p_obj):
+        manager.decref(ffi.cast('PObjectObject *', p_obj).ob_dict)
+
     def _p_substructures(self):
         return []
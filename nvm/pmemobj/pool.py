@@ -1,28 +1,91 @@
 import collections
 import errno
+import io
 if not hasattr(errno, 'ECANCELED'):
     errno.ECANCELED = 125  # 2.7 errno doesn't define this, so guess.
 import logging
+import mmap
+import multiprocessing
 import os
+import re
+import shutil
+import struct
 import sys
+import time
+import weakref
+from array import array
+from bisect import bisect_left, bisect_right
 from pickle import whichmodule, dumps, loads
-from threading import RLock
+from threading import (Condition, Event, Lock, RLock, Thread, current_thread,
+                       local)
 
 from _pmem import lib, ffi
 from .list import PersistentList
-from .compat import _coerce_fn, ErrChecker
+from .intern import InternTable, internable_types
+from .compat import (_coerce_fn, ErrChecker, int_to_bytes, int_from_bytes,
+                     get_ident)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 log = logging.getLogger('nvm.pmemobj')
 tlog = logging.getLogger('nvm.pmemobj.trace')
 
+_clock = getattr(time, 'monotonic', time.time)
+
 # If we ever need to change how we make use of the persistent store, having a
 # version as the layout will allow us to provide backward compatibility.
-layout_info = (0, 0, 1)
-layout_version = 'pypmemobj-{}.{}.{}'.format(*layout_info).encode()
+#   0.0.2: small ints, floats and strs are stored inline in oids, and other
+#          ints in binary rather than as decimal strings.
+#   0.0.3: strs are stored with a length instead of NUL terminated, and bytes
+#          have a type of their own.
+#   0.0.4: the pool may have an intern table, which older versions would not
+#          keep up to date.
+layout_info = (0, 0, 4)
+def _layout_version(info):
+    return 'pypmemobj-{}.{}.{}'.format(*info).encode()
+layout_version = _layout_version(layout_info)
+# Older layouts that we can still open, newest first.
+legacy_layout_infos = ((0, 0, 3), (0, 0, 2), (0, 0, 1))
 
 MIN_POOL_SIZE = lib.PMEMOBJ_MIN_POOL
+# The number of immutable objects kept in the volatile object cache.
+DEFAULT_CACHE_SIZE = 100000
+# Freed PObject headers no bigger than FREELIST_MAX_SIZE are kept for reuse,
+# up to FREELIST_MAX of each size.
+FREELIST_MAX = 80
+FREELIST_MAX_SIZE = 128
+# Allocations no bigger than ALLOC_CLASS_MAX_SIZE are made from allocation
+# classes registered when the pool is opened, which use a compact 16 byte
+# object header and are sized to our object layouts.
+ALLOC_CLASS_MAX_SIZE = 128
+ALLOC_CLASS_HEADER_SIZE = 16
+ALLOC_CLASS_UNITS_PER_BLOCK = 1024
+ALLOC_CLASS_STRUCTS = ('PObject', 'PVarObject', 'PFloatObject', 'PListObject',
+                       'PTupleObject', 'PDictObject', 'PObjectObject',
+                       'PSetObject')
+# Background recovery after a crash collects garbage this many objects at a
+# time, pausing for RECOVERY_PAUSE seconds in between to let others at the
+# pool.
+RECOVERY_STEP_SIZE = 1000
+RECOVERY_PAUSE = 0.001
+# The default gc_step budget, and generational collection thresholds (which
+# have the same meaning as for the gc module).
+GC_STEP_SIZE = 1000
+DEFAULT_GC_THRESHOLD = (700, 10, 10)
+# By default run_transaction retries a transaction that runs out of memory
+# this many times, sleeping TRANSACTION_BACKOFF seconds before the first retry
+# and twice as long before each one after that.
+TRANSACTION_RETRIES = 3
+TRANSACTION_BACKOFF = 0.01
+# The default number of transactions a batch runs before committing.
+BATCH_MAX_OPS = 1000
 MAX_OBJ_SIZE = lib.PMEMOBJ_MAX_ALLOC_SIZE
 OID_NULL = (lib.OID_NULL.pool_uuid_lo, lib.OID_NULL.off)
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
 # Arbitrary numbers.
 POBJECT_TYPE_NUM = 20
 INTERNAL_ABORT_ERRNO = 99999
@@ -31,9 +94,189 @@ INTERNAL_ABORT_ERRNO = 99999
 class PICKLE_SENTINEL:
     pass
 
+# An oid whose pool_uuid_lo is zero can never point into a pool, so we use
+# that space to store small immutable values directly in the pointer slot,
+# avoiding an allocation (and refcounting) for each of them.  The top four
+# bits of the off field are a tag, the rest is the payload.  Tag 0 is used for
+# constants: the None, True, and False singletons, and flag values such as the
+# PersistentDict DUMMY.  Since oid[0] is zero for all of these, code that
+# skips refcounting for singletons skips it for inline values as well.
+INLINE_TAG_SHIFT = 60
+INLINE_PAYLOAD_MASK = (1 << INLINE_TAG_SHIFT) - 1
+INLINE_CONST = 0
+INLINE_INT = 1
+INLINE_FLOAT = 2
+INLINE_STR = 3
+INLINE_BYTES = 4
+# Ints are stored as 60 bit two's complement.
+INLINE_INT_MIN = -(1 << (INLINE_TAG_SHIFT - 1))
+INLINE_INT_MAX = (1 << (INLINE_TAG_SHIFT - 1)) - 1
+# Floats are stored as their IEEE 754 bits shifted right by four, so only
+# floats whose four low order mantissa bits are zero (which includes all
+# integral and most "round" values) can be inlined.
+INLINE_FLOAT_SHIFT = 64 - INLINE_TAG_SHIFT
+INLINE_FLOAT_LOST_MASK = (1 << INLINE_FLOAT_SHIFT) - 1
+# Strings are stored as up to seven bytes of UTF-8 in the low order bytes,
+# with the length in the four bits just below the tag.  Bytes (on python3)
+# are stored the same way.
+INLINE_STR_MAX = 7
+INLINE_STR_LEN_SHIFT = 56
+
+if sys.version_info[0] < 3:
+    _inline_int_types = (int, long)
+else:
+    _inline_int_types = (int,)
+
+
+def _inline_oid(obj, layout_info=layout_info):
+    """Return the inline oid representing obj, or None if there isn't one.
+
+    There is never one in pools whose layout_info predates inline values.
+    """
+    if layout_info < (0, 0, 2):
+        return None
+    typ = type(obj)
+    if typ in _inline_int_types:
+        if INLINE_INT_MIN <= obj <= INLINE_INT_MAX:
+            return (0, (INLINE_INT << INLINE_TAG_SHIFT)
+                       | (obj & INLINE_PAYLOAD_MASK))
+    elif typ is float:
+        bits = struct.unpack('<Q', struct.pack('<d', obj))[0]
+        if not bits & INLINE_FLOAT_LOST_MASK:
+            return (0, (INLINE_FLOAT << INLINE_TAG_SHIFT)
+                       | (bits >> INLINE_FLOAT_SHIFT))
+    elif typ is str:
+        if sys.version_info[0] > 2:
+            obj = obj.encode('utf-8')
+        if len(obj) <= INLINE_STR_MAX:
+            payload = struct.unpack('<Q', obj.ljust(8, b'\0'))[0]
+            return (0, (INLINE_STR << INLINE_TAG_SHIFT)
+                       | (len(obj) << INLINE_STR_LEN_SHIFT) | payload)
+    elif typ is bytes and layout_info >= (0, 0, 3):
+        # On python2 bytes is str, so we only get here on python3.
+        if len(obj) <= INLINE_STR_MAX:
+            payload = struct.unpack('<Q', obj.ljust(8, b'\0'))[0]
+            return (0, (INLINE_BYTES << INLINE_TAG_SHIFT)
+                       | (len(obj) << INLINE_STR_LEN_SHIFT) | payload)
+    return None
+
+def _inline_value(oid):
+    """Return the value encoded in the (non-constant) inline oid."""
+    tag = oid[1] >> INLINE_TAG_SHIFT
+    payload = oid[1] & INLINE_PAYLOAD_MASK
+    if tag == INLINE_INT:
+        if payload > INLINE_INT_MAX:
+            payload -= 1 << INLINE_TAG_SHIFT
+        return int(payload)
+    if tag == INLINE_FLOAT:
+        return struct.unpack('<d', struct.pack(
+                                '<Q', payload << INLINE_FLOAT_SHIFT))[0]
+    if tag == INLINE_STR or tag == INLINE_BYTES:
+        size = payload >> INLINE_STR_LEN_SHIFT
+        s = struct.pack('<Q', payload)[:size]
+        if tag == INLINE_STR and sys.version_info[0] > 2:
+            s = s.decode('utf-8')
+        return s
+    raise ValueError("Invalid inline oid {}".format(oid))
+
 
 _err_check = ErrChecker(lib.pmemobj_errormsg)
 
+# The C types of the arguments of the pmemobj_ctl entry points we know about.
+ctl_types = {
+    'prefault.at_create': 'int',
+    'prefault.at_open': 'int',
+    'tx.cache.size': 'long long',
+    'tx.cache.threshold': 'long long',
+    'tx.debug.skip_expensive_checks': 'int',
+    'tx.post_commit.queue_depth': 'int',
+    'heap.size.granularity': 'uint64_t',
+    'heap.size.extend': 'uint64_t',
+    'heap.arena.create': 'unsigned',
+    'heap.narenas.total': 'unsigned',
+    'heap.narenas.max': 'unsigned',
+    'heap.thread.arena_id': 'unsigned',
+    'heap.alloc_class.new.desc': 'struct pobj_alloc_class_desc',
+    'stats.enabled': 'int',
+    'stats.heap.curr_allocated': 'uint64_t',
+    'stats.heap.run_allocated': 'uint64_t',
+    'stats.heap.run_active': 'uint64_t',
+    'debug.heap.alloc_pattern': 'int',
+    }
+
+def _ctl_type(name):
+    ctype = ctl_types.get(name)
+    if ctype is None:
+        parts = name.split('.')
+        if parts[:2] == ['heap', 'alloc_class'] and parts[-1] == 'desc':
+            ctype = 'struct pobj_alloc_class_desc'
+        else:
+            raise ValueError("Unknown ctl entry {!r}".format(name))
+    return ctype
+
+def _ctl_value(arg, ctype):
+    if ctype.startswith('struct '):
+        return dict((field, getattr(arg, field))
+                    for field, _ in ffi.typeof(ctype).fields)
+    return arg[0]
+
+def _ctl(func, pool_ptr, name, value=None):
+    """Call the pmemobj_ctl function func, returning the resulting value."""
+    ctype = _ctl_type(name)
+    arg = ffi.new(ctype + ' *', value)
+    _err_check.check_errno(func(pool_ptr, name.encode(), arg))
+    return _ctl_value(arg, ctype)
+
+# The ctl entry points that control prefaulting a pool when it is opened.
+_prefault_ctls = ('prefault.at_open', 'prefault.at_create')
+
+# The Linux ioctl that makes a file share the blocks of another (a reflink).
+FICLONE = 0x40049409
+SNAPSHOT_COPY_BUFSIZE = 1 << 20
+
+
+def _clone_file(src, dst):
+    """Copy file src to the new file dst, as a reflink if possible.
+
+    Return True if dst was made a reflink of src, False if it was copied.
+    """
+    with io.open(src, 'rb') as fsrc:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                     os.fstat(fsrc.fileno()).st_mode & 0o777)
+        try:
+            with io.open(fd, 'wb') as fdst:
+                cloned = False
+                if fcntl is not None:
+                    try:
+                        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                        cloned = True
+                    except (IOError, OSError) as e:
+                        log.debug('snapshot: no reflink (%s), copying', e)
+                if not cloned:
+                    shutil.copyfileobj(fsrc, fdst, SNAPSHOT_COPY_BUFSIZE)
+                fdst.flush()
+                os.fsync(fdst.fileno())
+        except BaseException:
+            os.remove(dst)
+            raise
+    return cloned
+
+def ctl_get(name):
+    """Return the value of the global pmemobj ctl entry point name.
+
+    Global settings (such as 'prefault.at_open') apply to pools opened
+    afterward.  See :meth:`PersistentObjectPool.ctl_get`.
+    """
+    return _ctl(lib.pmemobj_ctl_get, ffi.NULL, name)
+
+def ctl_set(name, value):
+    """Set the global pmemobj ctl entry point name to value."""
+    return _ctl(lib.pmemobj_ctl_set, ffi.NULL, name, value)
+
+def ctl_exec(name, value=None):
+    """Execute the global pmemobj ctl entry point name."""
+    return _ctl(lib.pmemobj_ctl_exec, ffi.NULL, name, value)
+
 _class_string_cache = {}
 def _class_string(cls):
     """Return a string we can use later to find the base class of cls.
@@ -95,6 +338,19 @@ def _find_class_from_string(cls_string):
     log.debug('new class_from_string: %r', res)
     return res
 
+def _raw_method(cls, name):
+    """Return cls's '<name>_raw' static method, if it is current.
+
+    A raw method only stands in for method name if both are defined by the
+    same class, so that a subclass overriding name isn't bypassed.
+    """
+    for klass in cls.__mro__:
+        if name in vars(klass):
+            if name + '_raw' in vars(klass):
+                return getattr(cls, name + '_raw')
+            return None
+    return None
+
 
 class ObjKey(object):
 
@@ -113,20 +369,39 @@ class ObjKey(object):
         return str(self.id)
 
 
-class _ObjCache(object):
+class _TransactionCaches(local):
+    # The objects resurrected and persisted by a thread's transaction.
 
     def __init__(self):
-        # XXX WeakValueDictionary?
-        self._resurrect = {}
+        self.resurrect = {}
+        self.persist = {}
+
+
+class _ObjCache(object):
+
+    # Persistent objects are cached via weak references, so that they stay
+    # unique while in use but don't accumulate.  Other (immutable) objects
+    # are cached in a least recently used order, and the least recently used
+    # are evicted once there are more than max_size of them.  The singletons
+    # are pinned.  Objects from a transaction are cached separately, per
+    # thread, until it commits.  Objects are resurrected outside of
+    # transactions by any thread, so the shared caches have a lock.
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._lock = RLock()
+        self._resurrect = collections.OrderedDict()
         self._persist = {}
-        self._trans_resurrect = {}
-        self._trans_persist = {}
+        self._weak = weakref.WeakValueDictionary()
+        self._trans = _TransactionCaches()
         self._singletons = {
             None: (0, 1),
             True: (0, 2),
             False: (0, 3),
             }
         self._singleton_ids = {id(k): v for k, v in self._singletons.items()}
+        self._pinned = {v: k for k, v in self._singletons.items()}
+        self.hits = self.misses = self.evictions = 0
 
     def pkey(self, obj):
         # Use the object as the key if it is immutable (hashable) because we
@@ -135,30 +410,65 @@ class _ObjCache(object):
         # otherwise equal.
         return obj if getattr(obj, '__hash__', None) else ObjKey(obj)
 
+    @property
+    def _trans_resurrect(self):
+        return self._trans.resurrect
+
+    @property
+    def _trans_persist(self):
+        return self._trans.persist
+
     def clear(self):
-        self._resurrect.clear()
-        self._persist.clear()
+        with self._lock:
+            self._resurrect.clear()
+            self._persist.clear()
+            self._weak.clear()
         self.clear_transaction_cache()
-        # Map the singletons.
-        for obj, oid in self._singletons.items():
-            self._resurrect[oid] = obj
 
     def clear_transaction_cache(self):
         tlog.debug("clearing transaction cache: %s", self._trans_resurrect)
         self._trans_resurrect.clear()
         self._trans_persist.clear()
 
+    def stats(self):
+        """Return a dict of counts describing the cache and its use."""
+        with self._lock:
+            return dict(hits=self.hits,
+                        misses=self.misses,
+                        evictions=self.evictions,
+                        size=len(self._resurrect),
+                        max_size=self.max_size,
+                        persistent=len(self._weak))
+
+    def oids(self):
+        """Return a set of the oids of the (shared) cached objects."""
+        with self._lock:
+            oids = set(self._resurrect)
+            oids.update(self._weak.keys())
+        return oids
+
     def obj_from_oid(self, oid):
         """Return object cached for oid, or raise KeyError."""
         try:
             obj = self._trans_resurrect[oid]
             tlog.debug('found in transaction cache: %r %r', oid, obj)
+            self.hits += 1
             return obj
         except KeyError:
             pass
-        obj = self._resurrect[oid]
-        tlog.debug('found in cache: %r %r', oid, obj)
-        return obj
+        if oid in self._pinned:
+            return self._pinned[oid]
+        with self._lock:
+            obj = self._weak.get(oid)
+            if obj is None:
+                try:
+                    obj = self._touch(oid)
+                except KeyError:
+                    self.misses += 1
+                    raise
+            tlog.debug('found in cache: %r %r', oid, obj)
+            self.hits += 1
+            return obj
 
     def oid_from_obj(self, obj):
         """Return oid cached for obj, or raise KeyError."""
@@ -169,47 +479,280 @@ class _ObjCache(object):
         try:
             oid = self._trans_persist[key]
             tlog.debug('found in transaction cache: %r %r', oid, obj)
+            self.hits += 1
             return oid
         except KeyError:
             pass
-        oid = self._persist[key]
-        tlog.debug('found in cache: %r %r (key %r)', oid, obj, key)
-        return oid
+        with self._lock:
+            try:
+                oid = self._persist[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self._touch(oid)
+            tlog.debug('found in cache: %r %r (key %r)', oid, obj, key)
+            self.hits += 1
+            return oid
 
-    def cache(self, oid, obj, in_transaction=False):
+    def _touch(self, oid):
+        # Move oid to the most recently used end.
+        obj = self._resurrect.pop(oid)
+        self._resurrect[oid] = obj
+        return obj
+
+    def _store(self, oid, obj):
+        if hasattr(obj, '_p_mm'):
+            self._weak[oid] = obj
+            return
+        self._resurrect.pop(oid, None)
+        self._resurrect[oid] = obj
+        self._persist[self.pkey(obj)] = oid
+        if self.max_size is None:
+            return
+        while len(self._resurrect) > self.max_size:
+            self._forget(*self._resurrect.popitem(last=False))
+            self.evictions += 1
+
+    def _forget(self, oid, obj):
+        # Equal values stored at different oids share a _persist key.
         key = self.pkey(obj)
-        tlog.debug('caching (in_trasaction=%s) %r %r (key %r)',
-                   in_transaction, oid, obj, key)
+        if self._persist.get(key) == oid:
+            del self._persist[key]
+
+    def cache(self, oid, obj, in_transaction=False):
+        tlog.debug('caching (in_trasaction=%s) %r %r',
+                   in_transaction, oid, obj)
         if in_transaction:
             self._trans_resurrect[oid] = obj
-            self._trans_persist[key] = oid
+            if not hasattr(obj, '_p_mm'):
+                self._trans_persist[self.pkey(obj)] = oid
         else:
-            self._resurrect[oid] = obj
-            self._persist[key] = oid
+            with self._lock:
+                self._store(oid, obj)
 
     def cache_transactionally(self, oid, obj):
         self.cache(oid, obj, in_transaction=True)
 
     def commit_transaction_cache(self):
         tlog.debug('committing transaction cache %s', self._trans_resurrect)
-        self._resurrect.update(self._trans_resurrect)
-        self._trans_resurrect.clear()
-        self._persist.update(self._trans_persist)
-        self._trans_persist.clear()
+        with self._lock:
+            for oid, obj in self._trans_resurrect.items():
+                self._store(oid, obj)
+        self.clear_transaction_cache()
 
     def purge(self, oid):
         if oid in self._trans_resurrect:
-            obj = self._trans_resurrect[oid]
+            obj = self._trans_resurrect.pop(oid)
             tlog.debug('purging %s %s from transaction caches', oid, obj)
-            del self._trans_resurrect[oid]
-            del self._trans_persist[self.pkey(obj)]
-        elif oid in self._resurrect:
-            obj = self._resurrect[oid]
-            tlog.debug('purging %s %s from caches', oid, obj)
-            del self._resurrect[oid]
-            del self._persist[self.pkey(obj)]
-        else:
-            tlog.debug('not in cache: %r', oid)
+            if not hasattr(obj, '_p_mm'):
+                self._trans_persist.pop(self.pkey(obj), None)
+            return
+        with self._lock:
+            if oid in self._resurrect:
+                obj = self._resurrect.pop(oid)
+                tlog.debug('purging %s %s from caches', oid, obj)
+                self._forget(oid, obj)
+            elif self._weak.pop(oid, None) is not None:
+                tlog.debug('purging %s from caches', oid)
+            else:
+                tlog.debug('not in cache: %r', oid)
+
+
+class _HeldLocks(local):
+    # The number of holds a thread has on object locks, counting reentrant
+    # ones.
+
+    def __init__(self):
+        self.count = 0
+
+_held_locks = _HeldLocks()
+
+# The object lock each waiting thread is waiting for, and whether it wants it
+# exclusively.
+_waiting = {}
+
+
+def _check_deadlock(lock, exclusive):
+    # Raise RuntimeError if waiting for lock would wait, through the threads
+    # holding or waiting for it and the locks they are waiting for in turn,
+    # for this thread: for example a reader holding one object's lock shared
+    # while reading a second object, and a transaction that has locked the
+    # second waiting to lock the first.
+    me = get_ident()
+    seen = set()
+    todo = [(lock, exclusive)]
+    while todo:
+        lock, exclusive = todo.pop()
+        blockers = list(lock._readers if exclusive else lock._writers)
+        owner = lock._owner
+        if owner is not None:
+            blockers.append(owner)
+        for thread in blockers:
+            if thread == me:
+                raise RuntimeError("waiting for the object lock would"
+                                   " deadlock")
+            if thread not in seen:
+                seen.add(thread)
+                waiting = _waiting.get(thread)
+                if waiting is not None:
+                    todo.append(waiting)
+
+
+class _ObjectLock(object):
+    """A readers-writer lock on a persistent object.
+
+    The lock is held exclusively by acquire and release (or by using it as a
+    context manager), reentrantly.  Within the context manager returned by
+    shared it is held shared with any other readers.  A thread that holds it
+    exclusively can also take it shared, but not the other way around.
+    Waiting writers take priority over new readers.  A thread whose wait
+    would deadlock with the threads it waits for gets a RuntimeError instead.
+    See MemoryManager.object_lock.
+    """
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._owner = None
+        self._count = 0
+        # Shared hold counts by thread, and the waiting writers.
+        self._readers = {}
+        self._writers = set()
+        self._shared = _SharedHold(self)
+
+    def acquire(self):
+        me = get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._count += 1
+                _held_locks.count += 1
+                return True
+            if me in self._readers:
+                raise RuntimeError("can't take an object's lock exclusively"
+                                   " while holding it shared")
+            self._writers.add(me)
+            _waiting[me] = (self, True)
+            try:
+                while self._owner is not None or self._readers:
+                    _check_deadlock(self, True)
+                    self._cond.wait()
+            finally:
+                self._writers.discard(me)
+                del _waiting[me]
+            self._owner = me
+            self._count = 1
+            _held_locks.count += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            if self._owner != get_ident():
+                raise RuntimeError("cannot release un-acquired lock")
+            self._count -= 1
+            _held_locks.count -= 1
+            if not self._count:
+                self._owner = None
+                self._cond.notify_all()
+
+    def acquire_shared(self):
+        me = get_ident()
+        with self._cond:
+            readers = self._readers
+            if me in readers:
+                readers[me] += 1
+                _held_locks.count += 1
+                return True
+            if self._owner != me and (self._owner is not None
+                                      or self._writers):
+                _waiting[me] = (self, False)
+                try:
+                    while self._owner is not None or self._writers:
+                        _check_deadlock(self, False)
+                        self._cond.wait()
+                finally:
+                    del _waiting[me]
+            readers[me] = 1
+            _held_locks.count += 1
+            return True
+
+    def release_shared(self):
+        me = get_ident()
+        with self._cond:
+            readers = self._readers
+            count = readers.get(me)
+            if not count:
+                raise RuntimeError("cannot release un-acquired lock")
+            _held_locks.count -= 1
+            if count > 1:
+                readers[me] = count - 1
+                return
+            del readers[me]
+            if not readers:
+                self._cond.notify_all()
+
+    def shared(self):
+        """Return a context manager that holds the lock shared."""
+        return self._shared
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class _SharedHold(object):
+    # The context manager returned by _ObjectLock.shared.
+
+    def __init__(self, lock):
+        self._lock = lock
+
+    def __enter__(self):
+        self._lock.acquire_shared()
+        return self
+
+    def __exit__(self, *args):
+        self._lock.release_shared()
+
+
+class _NoLock(object):
+    # Stands in for an object's lock when object locks are turned off.
+
+    def acquire(self):
+        return True
+
+    def release(self):
+        pass
+
+    def shared(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_NO_LOCK = _NoLock()
+
+
+class _TransactionState(local):
+    # The state of a thread's transaction.  libpmemobj transactions belong to
+    # the thread that started them, and so does all of this.
+
+    def __init__(self):
+        self.stack = []
+        # Net refcount changes, and oids freed, in the outermost transaction.
+        self.refcount_deltas = {}
+        self.freed = set()
+        # The address ranges that are already in the outermost transaction's
+        # undo log (or were allocated by it), as sorted disjoint intervals.
+        self.range_starts = []
+        self.range_ends = []
+        # The object locks held until the outermost transaction ends.
+        self.locks = set()
+        # The _Batch the outermost transaction belongs to, if any.
+        self.batch = None
 
 
 class _Transaction(object):
@@ -217,10 +760,44 @@ class _Transaction(object):
     _FREE = 'F'
     _CONTEXT = 'C'
 
-    def __init__(self, pool_ptr, obj_cache):
+    def __init__(self, pool_ptr, obj_cache, precommit=None, end=None,
+                 lock=None, read_only=False):
         self.pool_ptr = pool_ptr
+        self.read_only = read_only
         self._obj_cache = obj_cache
-        self._trans_stack = []
+        self._state = _TransactionState()
+        # Called just before the outermost transaction commits, and with
+        # whether it committed once it has ended.
+        self._precommit = precommit
+        self._on_end = end
+        # Held for the duration of the outermost transaction, so only one
+        # thread at a time is in a transaction, and other threads can wait
+        # for the pool to be in a consistent state.
+        self.lock = RLock() if lock is None else lock
+
+    @property
+    def _trans_stack(self):
+        return self._state.stack
+
+    @property
+    def refcount_deltas(self):
+        return self._state.refcount_deltas
+
+    @property
+    def freed(self):
+        return self._state.freed
+
+    @property
+    def _range_starts(self):
+        return self._state.range_starts
+
+    @property
+    def _range_ends(self):
+        return self._state.range_ends
+
+    @property
+    def locks(self):
+        return self._state.locks
 
     @property
     def depth(self):
@@ -229,8 +806,18 @@ class _Transaction(object):
     def begin(self):
         """Start a new (sub)transaction."""
         tlog.debug('start_transaction %s', self._trans_stack)
-        _err_check.check_errno(
-            lib.pmemobj_tx_begin(self.pool_ptr, ffi.NULL, ffi.NULL))
+        if not self._trans_stack:
+            self._check_can_begin()
+            self.lock.acquire()
+        elif self._state.batch is not None:
+            self._state.batch._check()
+        try:
+            _err_check.check_errno(
+                lib.pmemobj_tx_begin(self.pool_ptr, ffi.NULL, ffi.NULL))
+        except BaseException:
+            if not self._trans_stack:
+                self.lock.release()
+            raise
         self._trans_stack.append(self._FREE)
 
     def commit(self):
@@ -240,9 +827,33 @@ class _Transaction(object):
             raise RuntimeError("commit called outside of transaction")
         if self._trans_stack[-1] != self._FREE:
             raise RuntimeError("Non-context commit inside a context")
+        if len(self._trans_stack) == 1 and self._precommit is not None:
+            try:
+                self._precommit()
+            except BaseException:
+                # Roll back and pass on the precommit error, rather than the
+                # one abort would raise for our errno.
+                self._trans_stack.pop()
+                lib.pmemobj_tx_abort(INTERNAL_ABORT_ERRNO)
+                lib.pmemobj_tx_end()
+                try:
+                    self._obj_cache.clear_transaction_cache()
+                    self._end()
+                finally:
+                    self.lock.release()
+                raise
         self._trans_stack.pop()
         lib.pmemobj_tx_commit()
-        _err_check.check_errno(lib.pmemobj_tx_end())
+        err = lib.pmemobj_tx_end()
+        if not self._trans_stack:
+            try:
+                if not err:
+                    self._obj_cache.commit_transaction_cache()
+                self._end(committed=not err)
+            finally:
+                self.lock.release()
+        _err_check.check_errno(err)
+        self._batch_op_done()
 
     def abort(self, errno=errno.ECANCELED):
         """Abort the current (sub)transaction."""
@@ -251,20 +862,99 @@ class _Transaction(object):
             raise RuntimeError("abort called outside of transaction")
         lib.pmemobj_tx_abort(errno)
         self._obj_cache.clear_transaction_cache()
+        self._end()
         if self._trans_stack[-1] == self._FREE:
             self._trans_stack.pop()
+            err = lib.pmemobj_tx_end()
+            if not self._trans_stack:
+                self.lock.release()
             # This will raise ECANCELED.
-            _err_check.check_errno(lib.pmemobj_tx_end())
+            _err_check.check_errno(err)
+
+    def _end(self, committed=False):
+        # Forget the outermost transaction's pending state.
+        if self._on_end is not None:
+            self._on_end(committed)
+        self.refcount_deltas.clear()
+        self.freed.clear()
+        del self._range_starts[:]
+        del self._range_ends[:]
+        locks = self.locks
+        while locks:
+            locks.pop().release()
+
+    def covers(self, start, end):
+        """Return True if [start, end) is already snapshotted or new."""
+        i = bisect_right(self._range_starts, start) - 1
+        return i >= 0 and self._range_ends[i] >= end
+
+    def add_range(self, start, end):
+        """Record that [start, end) is snapshotted or new."""
+        if not self._trans_stack:
+            return
+        starts, ends = self._range_starts, self._range_ends
+        # Merge with every interval that overlaps or touches the new one.
+        i = bisect_left(ends, start)
+        j = bisect_right(starts, end)
+        if i < j:
+            start = min(start, starts[i])
+            end = max(end, ends[j - 1])
+        starts[i:j] = [start]
+        ends[i:j] = [end]
+
+    def _check_can_begin(self):
+        if self.read_only:
+            raise RuntimeError("the pool is open read-only")
+        # The pool lock must be taken before any object lock, or we could
+        # wait for it while holding an object lock that its holder wants.
+        if _held_locks.count:
+            raise RuntimeError("transaction started while holding an object"
+                               " lock")
 
     def __enter__(self):
+        if not self._trans_stack:
+            self._check_can_begin()
+            self.lock.acquire()
+        elif self._state.batch is not None:
+            self._state.batch._check()
         self._trans_stack.append(self._CONTEXT)
         tlog.debug('__enter__ %s', self._trans_stack)
-        _err_check.check_errno(
-            lib.pmemobj_tx_begin(self.pool_ptr, ffi.NULL, ffi.NULL))
+        try:
+            _err_check.check_errno(
+                lib.pmemobj_tx_begin(self.pool_ptr, ffi.NULL, ffi.NULL))
+        except BaseException:
+            self._trans_stack.pop()
+            if not self._trans_stack:
+                self.lock.release()
+            raise
         return self
 
     def __exit__(self, *args):
+        try:
+            self._exit(*args)
+        finally:
+            if not self._trans_stack:
+                self.lock.release()
+        if args[0] is None:
+            self._batch_op_done()
+
+    def _batch_op_done(self):
+        # A transaction inside a batch's transaction has committed.
+        batch = self._state.batch
+        if batch is not None and len(self._trans_stack) == 1:
+            batch._op_done()
+
+    def _exit(self, *args):
         tlog.debug('__exit__: %s, %r', self._trans_stack, args[1])
+        error = None
+        if (args[0] is None and self._trans_stack == [self._CONTEXT]
+                and self._precommit is not None
+                and lib.pmemobj_tx_stage() == lib.TX_STAGE_WORK):
+            try:
+                self._precommit()
+            except BaseException as e:
+                error = e
+                args = (type(e), e, None)
         if self._trans_stack.pop() == self._FREE:
             while self._trans_stack.pop() == self._FREE:
                 lib.pmemobj_tx_end()
@@ -284,10 +974,87 @@ class _Transaction(object):
         err = lib.pmemobj_tx_end()
         if err:
             self._obj_cache.clear_transaction_cache()
+            self._end()
+            if error is not None:
+                raise error
             if err != INTERNAL_ABORT_ERRNO:
                 _err_check.raise_per_errno()
         elif not self._trans_stack:
             self._obj_cache.commit_transaction_cache()
+            self._end(committed=True)
+
+
+class _Batch(object):
+    """Run the transactions of a block in a few larger transactions.
+
+    See PersistentObjectPool.batch.
+    """
+
+    def __init__(self, transaction, max_ops, max_latency_ms):
+        self._transaction = transaction
+        self.max_ops = max_ops
+        self.max_latency = (None if max_latency_ms is None
+                            else max_latency_ms / 1000.0)
+        # Transactions since the last commit, and the number of commits.
+        self.ops = 0
+        self.commits = 0
+        self._start = None
+
+    def _begin(self):
+        trans = self._transaction
+        trans.__enter__()
+        trans._state.batch = self
+        self.ops = 0
+        self._start = _clock()
+
+    def __enter__(self):
+        if self._transaction.depth:
+            raise RuntimeError("batch called inside a transaction")
+        self._begin()
+        return self
+
+    def __exit__(self, *args):
+        trans = self._transaction
+        # If a commit failed there is no transaction left to end.
+        if trans.depth and args[0] is None:
+            try:
+                self._check()
+            except RuntimeError as e:
+                trans._state.batch = None
+                trans.__exit__(type(e), e, None)
+                raise
+        trans._state.batch = None
+        if trans.depth:
+            trans.__exit__(*args)
+            if args[0] is None:
+                self.commits += 1
+
+    def _check(self):
+        # A transaction inside ours that fails aborts ours as well, after
+        # which libpmemobj won't start or commit any in it.
+        if lib.pmemobj_tx_stage() != lib.TX_STAGE_WORK:
+            raise RuntimeError("the batch was aborted by an earlier error,"
+                               " rolling back the changes since its last"
+                               " commit")
+
+    def commit(self):
+        """Commit the changes made so far, and carry on in a new transaction.
+        """
+        trans = self._transaction
+        if trans.depth != 1 or trans._state.batch is not self:
+            raise RuntimeError("batch commit called inside a transaction")
+        self._check()
+        trans._state.batch = None
+        trans.__exit__(None, None, None)
+        self.commits += 1
+        self._begin()
+
+    def _op_done(self):
+        self.ops += 1
+        if (self.ops >= self.max_ops or self.max_latency is not None
+                and _clock() - self._start >= self.max_latency):
+            tlog.debug('committing batch of %d', self.ops)
+            self.commit()
 
 
 class MemoryManager(object):
@@ -298,14 +1065,49 @@ class MemoryManager(object):
     """
 
     # XXX create should be a keyword-only arg but we don't have those in 2.7.
-    def __init__(self, pool_ptr, type_table=None):
+    def __init__(self, pool_ptr, type_table=None, layout_info=layout_info,
+                       cache_size=DEFAULT_CACHE_SIZE, lock=None,
+                       read_only=False):
         log.debug('MemoryManager.__init__: %r', pool_ptr)
         self._pool_ptr = pool_ptr
+        self._layout_info = layout_info
+        # If true, transactions (and so all changes) are refused.
+        self.read_only = read_only
         self._track_free = None
-        self._obj_cache = _ObjCache()
-        self._transaction = _Transaction(self._pool_ptr, self._obj_cache)
+        self._obj_cache = _ObjCache(cache_size)
+        self._transaction = _Transaction(self._pool_ptr, self._obj_cache,
+                                         precommit=self._apply_refcounts,
+                                         end=self._end_transaction,
+                                         lock=lock, read_only=read_only)
+        # Zeroed PObject headers available for reuse, by usable size, and
+        # the usable size of the headers allocated for each requested size.
+        self._freelists = {}
+        self._usable_sizes = {}
+        # Headers freed and reused by the current transaction.
+        self._recycled = collections.defaultdict(list)
+        self._reused = []
+        self._recycle = True
+        # The number of transactions committed since the pool was opened,
+        # and sets that the oids freed by each one are added to.
+        self._commits = 0
+        self._freed_watchers = []
+        # Whether there may be garbage that only gc can find, and the
+        # incremental collector to tell about new references, if any.
+        self._may_have_garbage = False
+        self._collector = None
+        # Tracks new objects for generational collection, once it is in use.
+        self._generations = None
+        # Allocation class unit sizes (sorted) and the matching xalloc flags.
+        self._class_sizes = []
+        self._class_flags = []
         self._init_caches()
         self._pickleable = set()
+        self._intern_table = None
+        self.buffer_views = False
+        # If true, the Persistent containers lock themselves; see object_lock.
+        self.object_locks = False
+        self._object_locks = weakref.WeakValueDictionary()
+        self._object_locks_lock = RLock()
 
     def transaction(self):
         """Return a (context manager) object that represents a transaction."""
@@ -329,9 +1131,15 @@ class MemoryManager(object):
         log.debug('alloc: %r', size)
         if size == 0:
             return OID_NULL
-        oid = self.otuple(lib.pmemobj_tx_alloc(size, type_num))
+        flags = self._alloc_class_flags(size)
+        if flags:
+            oid = self.otuple(lib.pmemobj_tx_xalloc(size, type_num, flags))
+        else:
+            oid = self.otuple(lib.pmemobj_tx_alloc(size, type_num))
         if oid == self.OID_NULL:
             _err_check.raise_per_errno()
+        self._new_range(oid, size)
+        self._note_new(oid, type_num)
         log.debug('alloced oid: %s', oid)
         return oid
 
@@ -345,12 +1153,75 @@ class MemoryManager(object):
         log.debug('zalloc: %r', size)
         if size == 0:
             return OID_NULL
-        oid = self.otuple(lib.pmemobj_tx_zalloc(size, type_num))
+        if type_num == POBJECT_TYPE_NUM:
+            oid = self._reuse_header(size)
+            if oid is not None:
+                self._note_new(oid, type_num)
+                return oid
+        flags = self._alloc_class_flags(size)
+        if flags:
+            oid = self.otuple(lib.pmemobj_tx_xalloc(
+                size, type_num, flags | lib.POBJ_XALLOC_ZERO))
+        else:
+            oid = self.otuple(lib.pmemobj_tx_zalloc(size, type_num))
         if oid == self.OID_NULL:
             _err_check.raise_per_errno()
+        self._new_range(oid, size)
+        self._note_new(oid, type_num)
+        if (type_num == POBJECT_TYPE_NUM and size <= FREELIST_MAX_SIZE
+                and size not in self._usable_sizes):
+            usable = lib.pmemobj_alloc_usable_size(oid)
+            self._usable_sizes[size] = usable
+            self._freelists.setdefault(usable, [])
         log.debug('zalloced oid: %s', oid)
         return oid
 
+    def _note_new(self, oid, type_num):
+        # A new PObject is garbage until something references it.
+        if type_num == POBJECT_TYPE_NUM:
+            self._may_have_garbage = True
+            if self._collector is not None:
+                self._collector.note_new(oid)
+            if self._generations is not None:
+                self._generations.note_new(oid)
+
+    def _register_alloc_classes(self):
+        """Register allocation classes for our small object sizes.
+
+        Allocation classes are not persistent, so this is done each time the
+        pool is opened.  If libpmemobj won't create them (for example because
+        it doesn't support the heap.alloc_class ctl), allocations simply use
+        the default classes.
+        """
+        sizes = set(ffi.sizeof(name) for name in ALLOC_CLASS_STRUCTS)
+        sizes.update(range(32, ALLOC_CLASS_MAX_SIZE + 1, 16))
+        for size in sorted(sizes):
+            try:
+                desc = _ctl(lib.pmemobj_ctl_set, self._pool_ptr,
+                            'heap.alloc_class.new.desc',
+                            dict(unit_size=size + ALLOC_CLASS_HEADER_SIZE,
+                                 units_per_block=ALLOC_CLASS_UNITS_PER_BLOCK,
+                                 header_type=lib.POBJ_HEADER_COMPACT))
+            except (ValueError, OSError) as e:
+                log.debug('allocation class for size %d not registered: %s',
+                          size, e)
+                continue
+            log.debug('allocation class %d: size %d', desc['class_id'], size)
+            self._class_sizes.append(size)
+            # This is the POBJ_CLASS_ID macro.
+            self._class_flags.append(desc['class_id'] << 48)
+
+    def _alloc_class_flags(self, size):
+        """Return the xalloc flags selecting the class to allocate size from.
+
+        This is the class with the smallest unit that size fits in, or 0
+        (meaning let libpmemobj choose) if there is none.
+        """
+        i = bisect_left(self._class_sizes, size)
+        if i == len(self._class_sizes):
+            return 0
+        return self._class_flags[i]
+
     def realloc(self, oid, size, type_num=None):
         """Copy oid contents into size bytes of new persistent memory.
 
@@ -394,6 +1265,68 @@ class MemoryManager(object):
         log.debug('free: %r', oid)
         _err_check.check_errno(lib.pmemobj_tx_free(oid))
         self._obj_cache.purge(oid)
+        self._transaction.freed.add(oid)
+        self._transaction.refcount_deltas.pop(oid, None)
+
+    #
+    # PObject header freelists.
+    #
+    # Rather than being freed, the memory of a deallocated PObject is zeroed
+    # and queued for reuse by zalloc.  A zeroed PObject has a refcount of zero
+    # and the type code of PersistentList, so if we crash it looks like an
+    # empty list orphan, which gc knows how to free.  Queued headers become
+    # available when the transaction that freed them commits.
+
+    def _reuse_header(self, size):
+        usable = self._usable_sizes.get(size)
+        if usable is None or not self._freelists[usable]:
+            return None
+        oid = self._freelists[usable].pop()
+        log.debug('reusing header: %s', oid)
+        self.snapshot_range(self.direct(oid), usable)
+        self._reused.append((usable, oid))
+        return oid
+
+    def _free_header(self, oid):
+        """Free a PObject header, or zero it and queue it for reuse."""
+        if self._recycle:
+            usable = lib.pmemobj_alloc_usable_size(oid)
+            freelist = self._freelists.get(usable)
+            if (freelist is not None and
+                    len(freelist) + len(self._recycled[usable]) < FREELIST_MAX):
+                log.debug('recycling header: %s', oid)
+                ptr = self.direct(oid)
+                self.snapshot_range(ptr, usable)
+                ffi.memmove(ptr, b'\0' * usable, usable)
+                self._obj_cache.purge(oid)
+                self._transaction.freed.add(oid)
+                self._transaction.refcount_deltas.pop(oid, None)
+                self._recycled[usable].append(oid)
+                return
+        self.free(oid)
+
+    def _end_transaction(self, committed):
+        if self._generations is not None:
+            self._generations.end_transaction(committed)
+        if committed:
+            self._commits += 1
+            for watcher in self._freed_watchers:
+                watcher.update(self._transaction.freed)
+            for usable, oids in self._recycled.items():
+                self._freelists[usable].extend(oids)
+        else:
+            # The abort restored the reused headers to their zeroed state.
+            for usable, oid in self._reused:
+                self._freelists[usable].append(oid)
+        self._recycled.clear()
+        del self._reused[:]
+
+    def _drain_freelists(self):
+        """Really free all the headers in the freelists."""
+        with self.transaction():
+            for freelist in self._freelists.values():
+                while freelist:
+                    self.free(freelist.pop())
 
     def direct(self, oid):
         """Return the real memory address where oid lives."""
@@ -402,8 +1335,64 @@ class MemoryManager(object):
         return _err_check.check_null(lib.pmemobj_direct(oid))
 
     def snapshot_range(self, ptr, size):
+        start = int(ffi.cast('uintptr_t', ptr))
+        if self._transaction.covers(start, start + size):
+            tlog.debug('already snapshotted %s %s', ptr, size)
+            return
         tlog.debug('snapshot %s %s', ptr, size)
         lib.pmemobj_tx_add_range_direct(ptr, size)
+        self._transaction.add_range(start, start + size)
+
+    def _new_range(self, oid, size):
+        # Memory allocated in a transaction is freed if it aborts, so it never
+        # needs snapshotting.
+        start = int(ffi.cast('uintptr_t', self.direct(oid)))
+        self._transaction.add_range(start, start + size)
+
+    #
+    # Object locks
+    #
+    # Each Persistent object can have a lock, which its methods hold shared
+    # while they read it, and exclusively from when they first change it until
+    # the outermost transaction ends.  Threads that read the object outside
+    # of a transaction therefore only ever see committed states of it, and
+    # don't have to wait for transactions that don't touch it.  Transactions
+    # themselves are still serialized by the pool's lock, which is always
+    # taken before any object's lock, so a thread holding an object's lock
+    # can't start one.  Locks only exist while they are in use.
+
+    def object_lock(self, obj):
+        """Return the lock for the Persistent object obj.
+
+        The lock is a reentrant readers-writer lock (see _ObjectLock) whose
+        shared method gives a context manager for a batch of reads.  If
+        object_locks is false, a lock that does nothing is returned.
+        """
+        if not self.object_locks:
+            return _NO_LOCK
+        oid = obj._p_oid
+        lock = self._object_locks.get(oid)
+        if lock is None:
+            with self._object_locks_lock:
+                lock = self._object_locks.get(oid)
+                if lock is None:
+                    lock = self._object_locks[oid] = _ObjectLock()
+        return lock
+
+    def lock(self, obj):
+        """Hold obj's lock until the outermost transaction ends.
+
+        Persistent types call this in a transaction before changing obj, so
+        that nobody else sees the change until it is committed.
+        """
+        trans = self._transaction
+        if not trans.depth:
+            raise RuntimeError("lock called outside of transaction")
+        lock = self.object_lock(obj)
+        if lock is _NO_LOCK or lock in trans.locks:
+            return
+        lock.acquire()
+        trans.locks.add(lock)
 
     #
     # Object Management
@@ -412,6 +1401,7 @@ class MemoryManager(object):
     def _init_caches(self):
         # We have a couple of special cases to avoid infinite regress.
         self._type_code_cache = {PersistentList: 0, str: 1}
+        self._type_infos = {}
         self._obj_cache.clear()
 
     def _resurrect_type_table(self, oid):
@@ -473,14 +1463,28 @@ class MemoryManager(object):
     def persist(self, obj):
         """Store obj in persistent memory and return its oid."""
         log.debug('persist: %r', obj)
-        try:
-            return self._obj_cache.oid_from_obj(obj)
-        except KeyError:
-            pass
+        if (isinstance(obj, (bytearray, memoryview))
+                and self._layout_info >= (0, 0, 3)):
+            # We store a snapshot of the contents of mutable buffers.
+            obj = obj.tobytes() if isinstance(obj, memoryview) else bytes(obj)
+        oid = _inline_oid(obj, self._layout_info)
+        if oid is not None:
+            return oid
         if hasattr(obj, '_p_mm'):
             tlog.debug('Persistent object: %s %s', obj._p_oid, obj)
             self._obj_cache.cache(obj._p_oid, obj)
             return obj._p_oid
+        try:
+            return self._obj_cache.oid_from_obj(obj)
+        except KeyError:
+            pass
+        intern = (self._intern_table is not None
+                  and type(obj) in internable_types)
+        if intern:
+            oid = self._intern_table.lookup(obj)
+            if oid is not None:
+                log.debug('interned %r: %r', obj, oid)
+                return oid
         cls_str = _class_string(obj.__class__)
         persister = '_persist_' + cls_str.replace(':', '_').replace('.', ':')
         if hasattr(self, persister):
@@ -489,6 +1493,8 @@ class MemoryManager(object):
             oid = self._persist_nvm_pmemobj_pool_PICKLE_SENTINEL(obj)
         else:
             raise TypeError("Don't know how to persist {!r}".format(cls_str))
+        if intern:
+            self._intern_table.add(oid, obj)
         self._obj_cache.cache(oid, obj, in_transaction=self._transaction.depth)
         log.debug('new %s object: %r', cls_str, oid)
         return oid
@@ -497,10 +1503,15 @@ class MemoryManager(object):
         """Return python object representing the data stored at oid."""
         oid = self.otuple(oid)
         tlog.debug('resurrect: %r', oid)
+        if not oid[0] and oid[1] >> INLINE_TAG_SHIFT:
+            return _inline_value(oid)
         try:
-            return self._obj_cache.obj_from_oid(oid)
+            obj = self._obj_cache.obj_from_oid(oid)
         except KeyError:
             pass
+        else:
+            if not (self.buffer_views and type(obj) is bytes):
+                return obj
         obj_ptr = ffi.cast('PObject *', self.direct(oid))
         type_code = obj_ptr.ob_type
         # The special cases are to avoid infinite regress in the type table.
@@ -516,6 +1527,10 @@ class MemoryManager(object):
             obj = getattr(self, resurrector)(obj_ptr)
             log.debug('resurrect %r: immutable type (%r): %r',
                       oid, resurrector, obj)
+            if isinstance(obj, memoryview):
+                # Views are only valid while the object is alive, and
+                # depend on buffer_views, so they don't go in the cache.
+                return obj
         else:
             # It must be a Persistent type.
             cls = _find_class_from_string(cls_str)
@@ -546,10 +1561,43 @@ class MemoryManager(object):
         obj = loads(s)
         return obj
 
+    def _persist_bytes(self, b, type_code):
+        # Store b after a PVarObject header whose ob_size is its length.
+        with self.transaction():
+            p_bytes_oid = self.alloc(ffi.sizeof('PVarObject') + len(b))
+            p_bytes = ffi.cast('PVarObject *', self.direct(p_bytes_oid))
+            p_bytes.ob_base.ob_refcnt = 0
+            p_bytes.ob_base.ob_type = type_code
+            p_bytes.ob_size = len(b)
+            body = ffi.cast('char *', p_bytes) + ffi.sizeof('PVarObject')
+            ffi.buffer(body, len(b))[:] = b
+        return p_bytes_oid
+
+    def _bytes_buffer(self, obj_ptr):
+        obj_ptr = ffi.cast('PVarObject *', obj_ptr)
+        body = ffi.cast('char *', obj_ptr) + ffi.sizeof('PVarObject')
+        return ffi.buffer(body, obj_ptr.ob_size)
+
     def _persist_builtins_str(self, s):
         type_code = self._get_type_code(s.__class__)
         if sys.version_info[0] > 2:
             s = s.encode('utf-8')
+        if self._layout_info < (0, 0, 3):
+            return self._persist_str_nul_terminated(s, type_code)
+        return self._persist_bytes(s, type_code)
+
+    def _resurrect_builtins_str(self, obj_ptr):
+        if self._layout_info < (0, 0, 3):
+            body = ffi.cast('char *', obj_ptr) + ffi.sizeof('PObject')
+            s = ffi.string(body)
+        else:
+            s = self._bytes_buffer(obj_ptr)[:]
+        if sys.version_info[0] > 2:
+            s = s.decode('utf-8')
+        return s
+
+    def _persist_str_nul_terminated(self, s, type_code):
+        # Pools with a layout older than 0.0.3 store NUL terminated strs.
         with self.transaction():
             p_str_oid = self.zalloc(ffi.sizeof('PObject') + len(s) + 1)
             p_str = ffi.cast('PObject *', self.direct(p_str_oid))
@@ -558,12 +1606,25 @@ class MemoryManager(object):
             ffi.buffer(body, len(s))[:] = s
         return p_str_oid
 
-    def _resurrect_builtins_str(self, obj_ptr):
-        body = ffi.cast('char *', obj_ptr) + ffi.sizeof('PObject')
-        s = ffi.string(body)
-        if sys.version_info[0] > 2:
-            s = s.decode('utf-8')
-        return s
+    def _persist_builtins_bytes(self, b):
+        if self._layout_info < (0, 0, 3):
+            # Older layouts have no bytes type, so as before bytes can only
+            # be pickled.
+            cls_str = _class_string(b.__class__)
+            if cls_str not in self._pickleable:
+                raise TypeError(
+                    "Don't know how to persist {!r}".format(cls_str))
+            return self._persist_nvm_pmemobj_pool_PICKLE_SENTINEL(b)
+        return self._persist_bytes(b, self._get_type_code(b.__class__))
+
+    def _resurrect_builtins_bytes(self, obj_ptr):
+        buf = self._bytes_buffer(obj_ptr)
+        if not self.buffer_views:
+            return buf[:]
+        view = memoryview(buf)
+        if hasattr(view, 'toreadonly'):
+            view = view.toreadonly()
+        return view
 
     def _persist_builtins_float(self, f):
         type_code = self._get_type_code(f.__class__)
@@ -581,8 +1642,41 @@ class MemoryManager(object):
     def _persist_builtins_int(self, i):
         # Make sure we get the int type even on python2.  The space is needed.
         type_code = self._get_type_code(1 .__class__)
-        # In theory we could copy the actual CPython data directly here,
-        # but that would mean we'd break on PyPy, etc.  So we serialize.
+        if self._layout_info < (0, 0, 2):
+            return self._persist_int_as_str(i, type_code)
+        # Ints are stored as two's complement after a PVarObject header whose
+        # ob_size is the number of bytes.  Anything that fits is stored as a
+        # native int64, so the common case is a single struct copy; only
+        # values outside that range go through the byte conversion.
+        if INT64_MIN <= i <= INT64_MAX:
+            size = ffi.sizeof('int64_t')
+        else:
+            size = (i.bit_length() + 8) // 8
+        with self.transaction():
+            p_int_oid = self.zalloc(ffi.sizeof('PVarObject') + size)
+            p_int = ffi.cast('PVarObject *', self.direct(p_int_oid))
+            p_int.ob_base.ob_type = type_code
+            p_int.ob_size = size
+            body = ffi.cast('char *', p_int) + ffi.sizeof('PVarObject')
+            if size == ffi.sizeof('int64_t'):
+                ffi.cast('int64_t *', body)[0] = i
+            else:
+                ffi.buffer(body, size)[:] = int_to_bytes(i, size)
+        return p_int_oid
+    _persist_builtins_long = _persist_builtins_int
+
+    def _resurrect_builtins_int(self, obj_ptr):
+        if self._layout_info < (0, 0, 2):
+            return int(self._resurrect_builtins_str(obj_ptr))
+        obj_ptr = ffi.cast('PVarObject *', obj_ptr)
+        body = ffi.cast('char *', obj_ptr) + ffi.sizeof('PVarObject')
+        size = obj_ptr.ob_size
+        if size == ffi.sizeof('int64_t'):
+            return ffi.cast('int64_t *', body)[0]
+        return int_from_bytes(ffi.buffer(body, size)[:])
+
+    def _persist_int_as_str(self, i, type_code):
+        # Pools with a layout older than 0.0.2 store ints as decimal strings.
         i = repr(i)
         if sys.version_info[0] < 3:
             i = i.rstrip('L')
@@ -592,43 +1686,74 @@ class MemoryManager(object):
             p_int = ffi.cast('PObject *', self.direct(p_int_oid))
             p_int.ob_type = type_code
         return p_int_oid
-    _persist_builtins_long = _persist_builtins_int
-
-    def _resurrect_builtins_int(self, obj_ptr):
-        i_str = self._resurrect_builtins_str(obj_ptr)
-        return int(i_str)
 
     def incref(self, oid):
-        """Increment the reference count of oid if it is not a singleton"""
+        """Increment the reference count of oid if it is not a constant.
+
+        Constants are the singletons and values stored inline in the oid.
+        """
         oid = self.otuple(oid)
         assert oid != self.OID_NULL
         if not oid[0]:
             # Unlike CPython, we don't ref-track our constants.
             log.debug('not increfing %s', oid)
             return
-        p_obj = ffi.cast('PObject *', self.direct(oid))
-        log.debug('incref %r %r', oid, p_obj.ob_refcnt + 1)
-        with self.transaction():
-            self.snapshot_range(ffi.addressof(p_obj, 'ob_refcnt'),
-                                ffi.sizeof('size_t'))
-            p_obj.ob_refcnt += 1
+        log.debug('incref %r', oid)
+        self._adjust_refcount(oid, 1)
 
     def decref(self, oid):
-        """Decrement the reference count of oid, and free it if zero."""
+        """Decrement the reference count of oid, and free it if zero.
+
+        As with incref, constants are not reference counted.
+        """
         oid = self.otuple(oid)
         if not oid[0]:
             # Unlike CPython we do not ref-track our constants.
             log.debug('not decrefing %s', oid)
             return
-        p_obj = ffi.cast('PObject *', self.direct(oid))
-        log.debug('decref %r %r', oid, p_obj.ob_refcnt - 1)
-        with self.transaction():
-            self.snapshot_range(ffi.addressof(p_obj, 'ob_refcnt'),
-                                ffi.sizeof('size_t'))
-            assert p_obj.ob_refcnt > 0, "{} oid refcount {}".format(
-                                        oid, p_obj.ob_refcnt)
-            p_obj.ob_refcnt -= 1
-            if p_obj.ob_refcnt < 1:
+        log.debug('decref %r', oid)
+        self._adjust_refcount(oid, -1)
+
+    def _adjust_refcount(self, oid, delta):
+        # Refcount changes are accumulated per transaction, and the net change
+        # for each oid is written when the outermost transaction commits; see
+        # _apply_refcounts.
+        trans = self._transaction
+        if not trans.depth:
+            with trans:
+                self._adjust_refcount(oid, delta)
+            return
+        if oid in trans.freed:
+            # A cycle being deallocated pointing back to a freed object.
+            log.debug('ignoring refcount change for freed oid %s', oid)
+            return
+        if delta < 0:
+            # Dropping a reference can leave unreachable cycles behind.
+            self._may_have_garbage = True
+        elif self._collector is not None:
+            self._collector.note_ref(oid)
+        deltas = trans.refcount_deltas
+        deltas[oid] = deltas.get(oid, 0) + delta
+
+    def _apply_refcounts(self):
+        """Write the pending refcount changes, deallocating zero counts.
+
+        This is called just before the outermost transaction commits.
+        Deallocation may queue further changes, so we continue until there are
+        none left.
+        """
+        deltas = self._transaction.refcount_deltas
+        while deltas:
+            oid, delta = deltas.popitem()
+            p_obj = ffi.cast('PObject *', self.direct(oid))
+            refcnt = p_obj.ob_refcnt + delta
+            log.debug('refcount %r %r', oid, refcnt)
+            assert refcnt >= 0, "{} oid refcount {}".format(oid, refcnt)
+            if delta:
+                self.snapshot_range(ffi.addressof(p_obj, 'ob_refcnt'),
+                                    ffi.sizeof('size_t'))
+                p_obj.ob_refcnt = refcnt
+            if refcnt < 1:
                 self._deallocate(oid)
 
     def xdecref(self, oid):
@@ -636,17 +1761,60 @@ class MemoryManager(object):
         if self.otuple(oid) != self.OID_NULL:
             self.decref(oid)
 
+    def _type_info(self, type_code):
+        """Return the class for type_code, and its raw methods.
+
+        The raw methods are the class's _p_traverse_raw and _p_deallocate_raw
+        static methods, or None if it doesn't have current ones.  They do the
+        same job as _p_traverse and _p_deallocate, but take the manager and
+        the 'PObject *' instead of needing the object to be resurrected.
+        """
+        try:
+            return self._type_infos[type_code]
+        except KeyError:
+            pass
+        cls = _find_class_from_string(self._type_table[type_code])
+        info = self._type_infos[type_code] = (
+            cls,
+            _raw_method(cls, '_p_traverse'),
+            _raw_method(cls, '_p_deallocate'),
+            )
+        return info
+
+    def _traverse(self, oid):
+        """Return an iterable of the oids referenced by the object at oid.
+
+        Objects whose type has a raw traversal method are not resurrected.
+        """
+        p_obj = ffi.cast('PObject *', self.direct(oid))
+        cls, traverse, deallocate = self._type_info(p_obj.ob_type)
+        if traverse is not None:
+            return traverse(self, p_obj)
+        if hasattr(cls, '_p_traverse'):
+            return self.resurrect(oid)._p_traverse()
+        return ()
+
     def _deallocate(self, oid):
         """Deallocate the memory occupied by oid."""
         log.debug("deallocating %s", oid)
         with self.transaction():
-            # XXX could have a type cache so we don't have to resurrect here.
-            obj = self.resurrect(oid)
-            if hasattr(obj, '_p_deallocate'):
-                obj._p_deallocate()
-            self.free(oid)
+            p_obj = ffi.cast('PObject *', self.direct(oid))
+            cls, traverse, deallocate = self._type_info(p_obj.ob_type)
+            if deallocate is not None:
+                deallocate(self, p_obj)
+            elif hasattr(cls, '_p_deallocate'):
+                self.resurrect(oid)._p_deallocate()
+            elif (self._intern_table is not None
+                    and cls in internable_types):
+                obj = self.resurrect(oid)
+                if isinstance(obj, memoryview):
+                    obj = obj.tobytes()
+                self._intern_table.discard(oid, obj)
+            self._free_header(oid)
         if self._track_free is not None:
             self._track_free.add(oid)
+        if self._generations is not None:
+            self._generations.note_freed(oid)
 
     #
     # Utility methods
@@ -670,6 +1838,463 @@ class MemoryManager(object):
     OID_NULL = OID_NULL
 
 
+class _OidSet(object):
+    """A set of the PObject oids of one pool, kept as a bitmap.
+
+    Every PObject is at least 16 bytes long, so no two of them have the same
+    offset // 16, which is used as the bit index.  This takes a bit for every
+    16 bytes of the pool, instead of the hundred or more bytes per member
+    that a set of oid tuples takes.  Oids from elsewhere (inline values and
+    constants) are never members.
+    """
+
+    _set_bytes = re.compile(b'[^\x00]+')
+
+    def __init__(self, uuid_lo):
+        self.uuid_lo = uuid_lo
+        self._bits = bytearray()
+        self._len = 0
+        # No bits are set before this byte; see pop.
+        self._first = 0
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, oid):
+        if oid[0] != self.uuid_lo:
+            return False
+        index = oid[1] >> 4
+        byte = index >> 3
+        return (byte < len(self._bits)
+                and bool(self._bits[byte] & (1 << (index & 7))))
+
+    def add(self, oid):
+        assert oid[0] == self.uuid_lo, "{} is not from this pool".format(oid)
+        index = oid[1] >> 4
+        byte = index >> 3
+        bits = self._bits
+        if byte >= len(bits):
+            # Grow geometrically, the pool is likely to be densely used.
+            bits.extend(bytearray(byte + 1 - len(bits) + len(bits) // 2))
+        bit = 1 << (index & 7)
+        if not bits[byte] & bit:
+            bits[byte] |= bit
+            self._len += 1
+            self._first = min(self._first, byte)
+
+    def discard(self, oid):
+        if oid in self:
+            index = oid[1] >> 4
+            self._bits[index >> 3] &= ~(1 << (index & 7)) & 0xff
+            self._len -= 1
+
+    def clear(self):
+        self._bits = bytearray()
+        self._len = 0
+        self._first = 0
+
+    def remove(self, oid):
+        if oid not in self:
+            raise KeyError(oid)
+        self.discard(oid)
+
+    def pop(self):
+        """Remove and return the lowest oid in the set."""
+        if not self._len:
+            raise KeyError('pop from an empty set')
+        byte = self._set_bytes.search(self._bits, self._first).start()
+        self._first = byte
+        value = self._bits[byte]
+        bit = (value & -value).bit_length() - 1
+        self._bits[byte] = value & (value - 1)
+        self._len -= 1
+        return (self.uuid_lo, ((byte << 3) | bit) << 4)
+
+    def __iter__(self):
+        # Iterate over a copy, so that the set can be changed meanwhile.
+        bits = bytearray(self._bits)
+        uuid_lo = self.uuid_lo
+        for match in self._set_bytes.finditer(bits, self._first):
+            for byte in range(match.start(), match.end()):
+                value = bits[byte]
+                for bit in range(8):
+                    if value & (1 << bit):
+                        yield (uuid_lo, ((byte << 3) | bit) << 4)
+
+
+class _MappedObjects(object):
+    """The part of the MemoryManager API that the raw traversal methods use,
+    for reading a pool mapped at base in a gc worker process."""
+
+    OID_NULL = OID_NULL
+
+    def __init__(self, base):
+        self._base = ffi.cast('char *', base)
+
+    def otuple(self, oid):
+        if isinstance(oid, tuple):
+            return oid
+        return (oid.pool_uuid_lo, oid.off)
+
+    def direct(self, oid):
+        return self._base + self.otuple(oid)[1]
+
+
+# What a gc marking worker process needs; set by _parallel_mark while it
+# forks the workers.
+_mark_state = None
+
+
+def _set_mark(bits, size, off):
+    # Set the _OidSet style bit for offset off in a bitmap, returning
+    # whether it was already set.
+    index = off >> 4
+    byte = index >> 3
+    if byte >= size:
+        return True
+    bit = 1 << (index & 7)
+    if bits[byte] & bit:
+        return True
+    bits[byte] |= bit
+    return False
+
+
+def _mark_worker(offsets):
+    """Trace the containers at offsets and everything they lead to.
+
+    Return the offsets of the containers and other objects reached, and of
+    the reached containers that we couldn't trace because their type has no
+    raw traversal method.
+    """
+    manager, traversers, containers, other, reached, size = _mark_state
+    uuid_lo = containers.uuid_lo
+    marked = array('Q')
+    marked_other = array('Q')
+    deferred = array('Q')
+    stack = array('Q', offsets)
+    while stack:
+        off = stack.pop()
+        p_obj = ffi.cast('PObject *', manager.direct((uuid_lo, off)))
+        traverse = traversers.get(p_obj.ob_type)
+        if traverse is None:
+            deferred.append(off)
+            continue
+        for sub_oid in traverse(manager, p_obj):
+            sub_oid = manager.otuple(sub_oid)
+            if sub_oid in containers:
+                if not _set_mark(reached, size, sub_oid[1]):
+                    marked.append(sub_oid[1])
+                    stack.append(sub_oid[1])
+            elif sub_oid in other:
+                marked_other.append(sub_oid[1])
+    return marked, marked_other, deferred
+
+
+class _IncrementalCollector(object):
+    """Find and free unreachable objects, a bounded amount of work at a time.
+
+    This does the same job as PersistentObjectPool.gc, but in steps that can
+    be interleaved with the program's use of the pool.  Each step must be run
+    holding the pool lock, outside of any transaction.  Between steps the
+    object graph may change: the MemoryManager reports every new object and
+    every new reference (see note_new and note_ref), new objects are never
+    collected, and newly referenced objects are treated as live and traced.
+    So are the objects in the object cache, which the program may be using.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.mm = pool.mm
+        self.done = False
+        self.counts = collections.defaultdict(int)
+        self._cursor = None
+        # The pool's objects are all tracked by offset.
+        uuid_lo = self._uuid_lo = self.mm._type_table._p_oid[0]
+        self._orphans = array('Q')
+        self._containers = _OidSet(uuid_lo)
+        self._other = _OidSet(uuid_lo)
+        self._new = _OidSet(uuid_lo)
+        self._freed = _OidSet(uuid_lo)
+        # Oids known to be live, and the offsets of the ones whose references
+        # we have yet to trace.
+        self._reached = _OidSet(uuid_lo)
+        self._grey = array('Q')
+        self._phase = self._catalog
+
+    def start(self):
+        mm = self.mm
+        # Headers waiting for reuse look like orphans, so really free them,
+        # and don't queue any more while we work.
+        mm._drain_freelists()
+        mm._recycle = False
+        mm._track_free = self._freed
+        mm._collector = self
+
+    def stop(self):
+        """Stop collecting, whether or not the collection is complete."""
+        mm = self.mm
+        if mm._collector is self:
+            mm._collector = None
+            mm._track_free = None
+            mm._recycle = True
+
+    def note_new(self, oid):
+        self._new.add(oid)
+
+    def note_ref(self, oid):
+        self._reach(oid)
+
+    def _reach(self, oid):
+        if oid[0] and oid not in self._reached:
+            self._reached.add(oid)
+            self._grey.append(oid[1])
+
+    def _gone(self, oid):
+        # Freed since we started, or allocated since we started (which
+        # includes memory that was freed and allocated again).
+        return oid in self._freed or oid in self._new
+
+    def step(self, budget):
+        """Process about budget objects; return True when the collection
+        is complete."""
+        while budget > 0 and not self.done:
+            budget -= self._phase(budget)
+        return self.done
+
+    def _catalog(self, budget):
+        # Sort the objects that existed when we started into orphans
+        # (refcount 0), containers, and other objects.
+        mm = self.mm
+        if self._cursor is None:
+            oid = mm.otuple(lib.pmemobj_first(self.pool._pool_ptr))
+        elif self._cursor in self._freed:
+            # We can't continue the walk from a freed object, so start over.
+            log.debug('gc: restarting catalog')
+            self.counts['restarts'] += 1
+            self._cursor = None
+            self._orphans = array('Q')
+            self._containers.clear()
+            self._other.clear()
+            return 1
+        else:
+            oid = mm.otuple(lib.pmemobj_next(self._cursor))
+        work = 0
+        while work < budget:
+            if oid == mm.OID_NULL:
+                self.counts['containers-total'] = len(self._containers)
+                self.counts['other-total'] = len(self._other)
+                self._phase = self._free_orphans
+                break
+            work += 1
+            self._cursor = oid
+            if (lib.pmemobj_type_num(oid) == POBJECT_TYPE_NUM
+                    and oid not in self._new):
+                p_obj = ffi.cast('PObject *', mm.direct(oid))
+                if not p_obj.ob_refcnt:
+                    self._orphans.append(oid[1])
+                elif hasattr(mm._type_info(p_obj.ob_type)[0], '_p_traverse'):
+                    self._containers.add(oid)
+                else:
+                    self._other.add(oid)
+            oid = mm.otuple(lib.pmemobj_next(oid))
+        return max(work, 1)
+
+    def _free_orphans(self, budget):
+        mm = self.mm
+        cached = mm._obj_cache.oids()
+        work = 0
+        while self._orphans and work < budget:
+            oid = (self._uuid_lo, self._orphans.pop())
+            work += 1
+            if self._gone(oid) or oid in self._reached or oid in cached:
+                continue
+            if ffi.cast('PObject *', mm.direct(oid)).ob_refcnt:
+                continue
+            log.debug('gc: deallocating orphan (refcount 0): %s', oid)
+            mm._deallocate(oid)
+            self.counts['orphans0-gced'] += 1
+        if not self._orphans:
+            # Start tracing from the roots.
+            if mm._intern_table is not None:
+                # It is live, but doesn't keep what it points to alive.
+                self._containers.discard(mm._intern_table._p_oid)
+            self._reach(mm._type_table._p_oid)
+            self._reach(mm.otuple(self.pool._pmem_root.root_object))
+            for oid in cached:
+                self._reach(oid)
+            self._phase = self._mark
+        return max(work, 1)
+
+    def _mark(self, budget):
+        mm = self.mm
+        work = 0
+        while self._grey and work < budget:
+            oid = (self._uuid_lo, self._grey.pop())
+            work += 1
+            self._containers.discard(oid)
+            self._other.discard(oid)
+            if oid in self._freed and oid not in self._new:
+                continue
+            for sub_oid in mm._traverse(oid):
+                self._reach(mm.otuple(sub_oid))
+        if not self._grey and self._phase == self._mark:
+            self.counts['containers-live'] = len(self._reached)
+            self._phase = self._sweep
+        return max(work, 1)
+
+    def _sweep(self, budget):
+        # Everything not reached is garbage.
+        mm = self.mm
+        if self._grey:
+            # Something we were about to free got referenced again, so trace
+            # what it refers to before freeing anything else.
+            return self._mark(budget)
+        work = 0
+        while self._containers and work < budget:
+            oid = self._containers.pop()
+            work += 1
+            if self._gone(oid) or oid in self._reached:
+                continue
+            log.debug('gc: deallocating container %s', oid)
+            # Our own incref must not make the container live.
+            mm._collector = None
+            try:
+                with mm.transaction():
+                    # incref so we don't try to deallocate us during cycle
+                    # clear.
+                    mm.incref(oid)
+                    mm._deallocate(oid)
+            finally:
+                mm._collector = self
+            self.counts['collections-gced'] += 1
+        while self._other and work < budget:
+            oid = self._other.pop()
+            work += 1
+            if self._gone(oid) or oid in self._reached:
+                continue
+            log.warning("Orphaned with postive refcount: %s: %s",
+                        oid, mm.resurrect(oid))
+            mm._deallocate(oid)
+            self.counts['orphans1-gced'] += 1
+        if not (self._containers or self._other or self._grey):
+            self.stop()
+            self.done = True
+        return max(work, 1)
+
+
+class _Generations(object):
+    """Generational collection of the objects created since the pool opened.
+
+    Objects created while this is in use start out in generation 0.  Those
+    that survive a collection of their generation move to the next one, and
+    objects that survive a generation 1 collection (and all the objects that
+    were in the pool when it was opened) are in the oldest generation, 2,
+    which is only collected by a full collection.  As in CPython, a young
+    collection treats any reference to an object that doesn't come from
+    another object being collected as keeping it alive, which it works out
+    by subtracting the references found among the objects being collected
+    from their refcounts.  Objects with a refcount of zero, and those in the
+    object cache, may be in use by the program and are never collected here.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.mm = pool.mm
+        self.young = (set(), set())
+        # Objects created by the current transaction.
+        self._uncommitted = []
+
+    def note_new(self, oid):
+        self.young[0].add(oid)
+        self._uncommitted.append(oid)
+
+    def note_freed(self, oid):
+        self.young[0].discard(oid)
+        self.young[1].discard(oid)
+
+    def end_transaction(self, committed):
+        if not committed:
+            # The objects no longer exist.
+            self.young[0].difference_update(self._uncommitted)
+        del self._uncommitted[:]
+
+    def clear(self):
+        self.young[0].clear()
+        self.young[1].clear()
+
+    def due(self, state):
+        """Return the generation that needs collecting, or None."""
+        if not state.threshold[0] or len(self.young[0]) <= state.threshold[0]:
+            return None
+        for generation in (2, 1):
+            if state.count[generation] > state.threshold[generation]:
+                if (generation == 2 and state.long_lived_pending
+                        < state.long_lived_total // 4):
+                    # Full collections are expensive, so wait until the
+                    # oldest generation has grown significantly.
+                    continue
+                return generation
+        return 0
+
+    def collect(self, generation):
+        """Collect generation (0 or 1) and the younger ones.
+
+        Return the number of objects examined, the number of them that
+        survived, and the number of containers deallocated.
+        """
+        mm = self.mm
+        objs = set(self.young[0])
+        if generation:
+            objs.update(self.young[1])
+        refs = {}
+        containers = set()
+        for oid in objs:
+            refs[oid] = ffi.cast('PObject *', mm.direct(oid)).ob_refcnt
+        for oid in objs:
+            p_obj = ffi.cast('PObject *', mm.direct(oid))
+            if hasattr(mm._type_info(p_obj.ob_type)[0], '_p_traverse'):
+                containers.add(oid)
+                for sub_oid in mm._traverse(oid):
+                    sub_oid = mm.otuple(sub_oid)
+                    if sub_oid in refs:
+                        refs[sub_oid] -= 1
+        # Whatever is referenced from outside, or may be in use by the
+        # program, is reachable, as is everything it refers to.  (A negative
+        # count would mean a refcount is wrong; be conservative.)
+        reachable = set(oid for oid, count in refs.items()
+                        if count or not ffi.cast('PObject *',
+                                                 mm.direct(oid)).ob_refcnt)
+        reachable.update(objs.intersection(mm._obj_cache.oids()))
+        work = list(reachable)
+        for oid in work:
+            if oid in containers:
+                for sub_oid in mm._traverse(oid):
+                    sub_oid = mm.otuple(sub_oid)
+                    if sub_oid in objs and sub_oid not in reachable:
+                        reachable.add(sub_oid)
+                        work.append(sub_oid)
+        young = self.young
+        freed = 0
+        for oid in containers:
+            if oid in reachable or not (oid in young[0] or oid in young[1]):
+                # Reachable, or already freed along with other garbage.
+                continue
+            log.debug('gc: deallocating young container %s', oid)
+            with mm.transaction():
+                # incref so we don't try to deallocate us during cycle clear.
+                mm.incref(oid)
+                mm._deallocate(oid)
+            freed += 1
+        survivors = set(oid for oid in objs
+                        if oid in young[0] or oid in young[1])
+        young[0].clear()
+        if generation:
+            young[1].clear()
+        else:
+            young[1].update(survivors)
+        return len(objs), len(survivors), freed
+
+
 class PersistentObjectPool(object):
     """This class represents the persistent object pool created using
     :func:`~nvm.pmemobj.create` or :func:`~nvm.pmemobj.open`.
@@ -677,19 +2302,29 @@ class PersistentObjectPool(object):
 
     # This class  provides the API that will be used by most programs.
 
-    lock = RLock()
     closed = False
+    read_only = False
+    _warm_thread = None
+    _recovery_thread = None
+    _collection = None
+    _generations = None
 
     # XXX create should be a keyword-only arg but we don't have those in 2.7.
     def __init__(self, filename, flag='w',
-                       pool_size=MIN_POOL_SIZE, mode=0o666, debug=False):
+                       pool_size=MIN_POOL_SIZE, mode=0o666, debug=False,
+                       cache_size=DEFAULT_CACHE_SIZE, prefault=False,
+                       warm_cache=0, recovery='sync'):
         """Open or create a persistent object pool backed by filename.
 
         If flag is 'w', raise an OSError if the file does not exist and
         otherwise open it for reading and writing.  If flag is 'x', raise an
         OSError if the file *does* exist, otherwise create it and open it for
         reading and writing.  If flag is 'c', create the file if it does not
-        exist, otherwise use the existing file.
+        exist, otherwise use the existing file.  If flag is 'r', open the
+        existing file read-only: the pool's objects can be read, but
+        transactions, and so any changes to the pool, raise a RuntimeError.
+        A read-only pool is never garbage collected, on open or on close,
+        even if it was not shut down cleanly.
 
         If the file gets created, use pool_size as the size of the new pool in
         bytes and mode as its access mode, otherwise ignore these parameters
@@ -699,32 +2334,77 @@ class PersistentObjectPool(object):
         on some additional sanity-check warnings.  This may have an impact
         on performance.
 
+        Python objects representing persistent objects are cached while they
+        are in use.  In addition up to cache_size immutable values (strings,
+        ints, etc) are cached, discarding the least recently used ones once
+        there are more than that.  If cache_size is None the immutable cache
+        is unbounded.
+
+        If prefault is True, libpmemobj faults in all of the pool's pages when
+        it is opened, so that the first accesses to objects don't pay for page
+        faults.  If warm_cache is non-zero, start a background thread that
+        loads up to that many objects reachable from the root into the cache
+        (see the warm method).
+
         When the pool is opened, if the previous shutdown was not clean the
-        pool is cleaned up, including running the 'gc' method.
+        pool is cleaned up, including running the 'gc' method.  If recovery
+        is 'background', the cleanup is instead done incrementally by a
+        background thread while the pool is in use.
 
         See also the open and create functions of nvm.pmemobj, which are
         convenience functions for the 'w' and 'x' flags, respectively.
         """
         log.debug('PersistentObjectPool.__init__: %r, %r %r, %r',
                   filename, flag, pool_size, mode)
+        # Held by transactions, gc, and everything else that needs the pool
+        # to be in a consistent state.
+        self.lock = RLock()
+        self._run_stats = {'retries': 0, 'failures': 0}
+        self._run_stats_lock = Lock()
         self.filename = filename
         self.debug = debug
+        self._warm_objects = []
+        self._stop = Event()
+        if recovery not in ('sync', 'background'):
+            raise ValueError("Invalid recovery value {!r}".format(recovery))
         exists = os.path.exists(filename)
-        if flag == 'w' or (flag == 'c' and exists):
-            self._pool_ptr = _err_check.check_null(
-                lib.pmemobj_open(_coerce_fn(filename),
-                                 layout_version))
-        elif flag == 'x' or (flag == 'c' and not exists):
-            self._pool_ptr = _err_check.check_null(
-                lib.pmemobj_create(_coerce_fn(filename),
-                                   layout_version,
-                                   pool_size,
-                                   mode))
-        elif flag == 'r':
-            raise ValueError("Read-only mode is not supported")
-        else:
-            raise ValueError("Invalid flag value {}".format(flag))
-        mm = self.mm = MemoryManager(self._pool_ptr)
+        if prefault:
+            # These are global settings, so only change them while we open.
+            saved = [(name, ctl_get(name)) for name in _prefault_ctls]
+            for name, _ in saved:
+                ctl_set(name, 1)
+        try:
+            info = layout_info
+            if flag in ('w', 'r') or (flag == 'c' and exists):
+                # Try our layout first, then fall back to the older ones.
+                for info in (layout_info,) + legacy_layout_infos:
+                    pool_ptr = lib.pmemobj_open(_coerce_fn(filename),
+                                                _layout_version(info))
+                    if pool_ptr != ffi.NULL or ffi.errno != errno.EINVAL:
+                        break
+                self._pool_ptr = _err_check.check_null(pool_ptr)
+            elif flag == 'x' or (flag == 'c' and not exists):
+                self._pool_ptr = _err_check.check_null(
+                    lib.pmemobj_create(_coerce_fn(filename),
+                                       layout_version,
+                                       pool_size,
+                                       mode))
+            else:
+                raise ValueError("Invalid flag value {}".format(flag))
+        finally:
+            if prefault:
+                for name, value in saved:
+                    ctl_set(name, value)
+        log.debug('layout: %s', _layout_version(info))
+        if flag == 'r':
+            self.read_only = True
+            self._open_read_only(info, cache_size)
+            if warm_cache:
+                self.warm(warm_cache, background=True)
+            return
+        mm = self.mm = MemoryManager(self._pool_ptr, layout_info=info,
+                                     cache_size=cache_size, lock=self.lock)
+        mm._register_alloc_classes()
         pmem_root = lib.pmemobj_root(self._pool_ptr, ffi.sizeof('PRoot'))
         pmem_root = ffi.cast('PRoot *', mm.direct(pmem_root))
         type_table_oid = mm.otuple(pmem_root.type_table)
@@ -740,28 +2420,133 @@ class PersistentObjectPool(object):
             mm._resurrect_type_table(type_table_oid)
             gc_needed = not self.mm.resurrect(pmem_root.clean_shutdown)
         self._pmem_root = pmem_root
+        if mm.otuple(pmem_root.intern_table) != mm.OID_NULL:
+            if info < (0, 0, 4):
+                self._drop_intern_table()
+            else:
+                mm._intern_table = mm.resurrect(pmem_root.intern_table)
+        if not pmem_root.gc_state.initialized:
+            self._update_gc_state(initialized=1,
+                                  threshold=list(DEFAULT_GC_THRESHOLD))
         # Make sure any objects orphaned by a crash are cleaned up.
         if gc_needed:
-            self.gc()
+            if recovery == 'sync':
+                self.gc()
+            else:
+                self._start_recovery()
+        # Until we are closed, a crash leaves the pool needing cleanup.
+        self._set_clean_shutdown(False)
+        if warm_cache:
+            self.warm(warm_cache, background=True)
+
+    def _open_read_only(self, info, cache_size):
+        # Like the rest of __init__, but without writing anything: the root
+        # isn't extended to the current PRoot size, and there is no gc.
+        mm = self.mm = MemoryManager(self._pool_ptr, layout_info=info,
+                                     cache_size=cache_size, lock=self.lock,
+                                     read_only=True)
+        root_size = lib.pmemobj_root_size(self._pool_ptr)
+        if root_size < ffi.offsetof('PRoot', 'intern_table'):
+            raise ValueError("{} is not an initialized object pool".format(
+                self.filename))
+        pmem_root = lib.pmemobj_root(self._pool_ptr, root_size)
+        pmem_root = ffi.cast('PRoot *', mm.direct(pmem_root))
+        mm._resurrect_type_table(mm.otuple(pmem_root.type_table))
+        if (info >= (0, 0, 4)
+                and mm.otuple(pmem_root.intern_table) != mm.OID_NULL):
+            mm._intern_table = mm.resurrect(pmem_root.intern_table)
+        self._pmem_root = pmem_root
 
-    def close(self):
+    def close(self, force_gc=True):
         """Close the object pool, calling 'gc' to free any unreferenced objects.
 
         The object pool itself lives on in the file that contains it and may be
         reopened at a later date, and all the objects in it accessed, using
         nvm.pmemobj.open.
 
+        If force_gc is False, gc is only called if objects have been created
+        or references dropped since the last gc (or since the pool was opened),
+        since otherwise there can't be any new garbage.  If background
+        recovery is still in progress it is abandoned, and will be done again
+        the next time the pool is opened.
         """
+        self._stop.set()
+        for thread in (self._warm_thread, self._recovery_thread):
+            if thread is not None and thread is not current_thread():
+                thread.join()
         with self.lock:
             if self.closed:
                 log.debug('already closed')
                 return
             log.debug('close')
             self.closed = True     # doing this early helps with debugging
-            # Clean up unreferenced object cycles.
-            self.gc()
+            del self._warm_objects[:]
+            if self.read_only:
+                pass
+            elif force_gc or self.mm._may_have_garbage:
+                # Clean up unreferenced object cycles.
+                self.gc()
+            elif self._collection is not None:
+                self._collection.stop()
+                self._collection = None
+                log.debug('close: recovery abandoned')
+            else:
+                log.debug('close: no gc needed')
+                self._set_clean_shutdown(True)
             lib.pmemobj_close(self._pool_ptr)
 
+    def _set_clean_shutdown(self, value):
+        with self.mm.transaction():
+            self.mm.snapshot_range(
+                ffi.addressof(self._pmem_root, 'clean_shutdown'),
+                ffi.sizeof('PObjPtr'))
+            self._pmem_root.clean_shutdown = self.mm.persist(value)
+
+    def _update_gc_state(self, **fields):
+        with self.mm.transaction():
+            self.mm.snapshot_range(ffi.addressof(self._pmem_root, 'gc_state'),
+                                   ffi.sizeof('PGCState'))
+            for name, value in fields.items():
+                setattr(self._pmem_root.gc_state, name, value)
+
+    def _full_collection_done(self, live):
+        # Everything that survived is now in the oldest generation.
+        if self._generations is not None:
+            self._generations.clear()
+        self._update_gc_state(count=[0, 0, 0], long_lived_total=live,
+                              long_lived_pending=0)
+
+    def _step_collection(self, budget):
+        # Do a step of the incremental collection, returning True if it is
+        # complete.
+        collector = self._collection
+        if not collector.step(budget):
+            return False
+        log.debug('gc: incremental collection done: %s',
+                  dict(collector.counts))
+        self._collection = None
+        self._full_collection_done(len(collector._reached))
+        return True
+
+    def _start_recovery(self):
+        log.debug('recovery: starting in background')
+        collector = self._collection = _IncrementalCollector(self)
+        collector.start()
+        thread = Thread(target=self._recover, name='pmemobj-recovery')
+        thread.daemon = True
+        self._recovery_thread = thread
+        thread.start()
+
+    def _recover(self):
+        while not self._stop.is_set():
+            with self.lock:
+                if self._collection is None:
+                    return
+                if self._step_collection(RECOVERY_STEP_SIZE):
+                    log.debug('recovery: done')
+                    return
+            self._stop.wait(RECOVERY_PAUSE)
+
     def __del__(self):
         if hasattr(self, '_pmem_root'):
             # Initialization was complete, do a full close.
@@ -777,6 +2562,80 @@ class PersistentObjectPool(object):
         """Return a (context manager) object that represents a transaction."""
         return self.mm.transaction()
 
+    def run_transaction(self, fn, retries=TRANSACTION_RETRIES,
+                        backoff=TRANSACTION_BACKOFF, compact=True):
+        """Call fn in a transaction and return its result.
+
+        If the transaction is aborted because the pool ran out of memory
+        (fn, or the commit, raised a MemoryError), it is retried up to
+        retries times.  Before each retry, if compact is true, garbage is
+        collected to free up memory, and the thread sleeps for backoff
+        seconds, doubled for every retry after the first.  fn should only
+        change the pool, since changes to anything else aren't rolled back
+        before it is called again.  Must not be called inside a transaction,
+        which the abort would end.  The retries are counted in
+        transaction_stats.
+        """
+        if self.mm.transaction().depth:
+            raise RuntimeError("run_transaction called inside a transaction")
+        attempt = 0
+        while True:
+            try:
+                with self.mm.transaction():
+                    return fn()
+            except MemoryError:
+                with self._run_stats_lock:
+                    if attempt >= retries:
+                        self._run_stats['failures'] += 1
+                        raise
+                    self._run_stats['retries'] += 1
+                log.debug('transaction out of memory, retry %d', attempt + 1)
+            if compact:
+                self.gc()
+            if backoff:
+                time.sleep(backoff * (1 << attempt))
+            attempt += 1
+
+    def batch(self, max_ops=BATCH_MAX_OPS, max_latency_ms=None):
+        """Return a context manager that batches transactions together.
+
+        Inside the context, the transactions that changes to the pool are
+        made in (including the ones each Persistent container method makes
+        for itself) become part of a batch transaction, which is committed
+        once max_ops of them have committed, or once max_latency_ms
+        milliseconds have passed since the batch began, whichever comes
+        first, and then replaced by a new one.  Whatever is left is committed
+        when the context exits normally.  This saves the cost of committing
+        each small transaction on its own.
+
+        Each batch transaction is atomic, but the context as a whole is not:
+        a crash or an exception undoes only the changes since the last batch
+        commit, so each change that needs to be atomic should still be made
+        in a transaction of its own.  Those are never split between batches.
+        The pool is locked for the life of each batch transaction, and the
+        thresholds are only checked when a transaction inside it commits.
+        The context manager's commit method commits the batch early.  Must
+        not be called inside a transaction.
+
+        A transaction that fails inside the batch aborts the batch
+        transaction too, even if the exception is caught.  After that,
+        starting a transaction, committing, or leaving the context normally
+        raises a RuntimeError.
+        """
+        return _Batch(self.mm.transaction(), max_ops, max_latency_ms)
+
+    def transaction_stats(self):
+        """Return a dictionary of statistics about transactions.
+
+        The keys are 'commits' (outermost transactions committed since the
+        pool was opened), 'retries' (transactions retried by run_transaction)
+        and 'failures' (run_transaction calls that ran out of retries).
+        """
+        with self._run_stats_lock:
+            stats = dict(self._run_stats)
+        stats['commits'] = self.mm._commits
+        return stats
+
     @property
     def root(self):
         """The root object of the pool's persistent object tree.
@@ -813,6 +2672,123 @@ class PersistentObjectPool(object):
         """
         return self.mm.new(typ, *args, **kw)
 
+    def cache_stats(self):
+        """Return a dictionary of statistics about the volatile object cache.
+
+        The keys are 'hits' and 'misses' (lookups in the cache), 'evictions'
+        (immutables dropped because the cache was full), 'size' (immutables
+        currently cached), 'max_size' (the cache_size the pool was opened
+        with), and 'persistent' (Persistent objects currently in use).
+        """
+        return self.mm._obj_cache.stats()
+
+    def ctl_get(self, name):
+        """Return the value of the pmemobj ctl entry point name for this pool.
+
+        name is a libpmemobj ctl name such as 'tx.cache.size' or
+        'stats.heap.curr_allocated' (see pmemobj_ctl_get(3)).  Names the
+        pool doesn't know how to convert, or that libpmemobj rejects, raise
+        a ValueError.  Structure values are returned as dictionaries.
+        """
+        return _ctl(lib.pmemobj_ctl_get, self._pool_ptr, name)
+
+    def ctl_set(self, name, value):
+        """Set the pmemobj ctl entry point name for this pool to value.
+
+        Structure values are given as dictionaries; the modified structure is
+        returned, so that for example the class_id assigned by
+        'heap.alloc_class.new.desc' is available.
+        """
+        return _ctl(lib.pmemobj_ctl_set, self._pool_ptr, name, value)
+
+    def ctl_exec(self, name, value=None):
+        """Execute the pmemobj ctl entry point name for this pool.
+
+        Return the argument as modified by libpmemobj.
+        """
+        return _ctl(lib.pmemobj_ctl_exec, self._pool_ptr, name, value)
+
+    def snapshot(self, path):
+        """Save a consistent copy of the pool, as it is now, in file path.
+
+        The copy is made while holding the pool's lock, between
+        transactions, so no changes are in progress.  It shares the pool
+        file's blocks (a reflink) if the filesystem supports that, and is a
+        full copy otherwise.  path must not exist.
+
+        The snapshot is meant to be opened read-only, for example by any
+        number of reader processes, with open(path, read_only=True).  Like
+        any pool that was open when it was copied, it would be garbage
+        collected if it was opened for writing.  A pool's copies share its
+        identity, so libpmemobj will not open a snapshot in a process that
+        has the original (or another copy) open.
+        """
+        with self.lock:
+            if self.mm.transaction().depth:
+                raise RuntimeError("snapshot called inside a transaction")
+            if self.closed:
+                raise RuntimeError("snapshot of a closed pool")
+            cloned = _clone_file(self.filename, path)
+        log.debug('snapshot: %s %s to %s',
+                  'cloned' if cloned else 'copied', self.filename, path)
+
+    def warm(self, n, background=False):
+        """Load up to n objects reachable from the root into the cache.
+
+        The object tree is walked breadth first starting at the root, so the
+        objects nearest the root are loaded first.  The Persistent objects
+        loaded are held until the pool is closed, so that they stay cached
+        even if the program isn't using them yet.  The pool can be used while
+        warming is in progress; objects freed in the meantime are skipped.
+
+        If background is True do the work in a daemon thread and return the
+        thread, otherwise return the number of objects loaded.
+        """
+        if background:
+            thread = Thread(target=self._warm, args=(n,),
+                            name='pmemobj-warm')
+            thread.daemon = True
+            self._warm_thread = thread
+            thread.start()
+            return thread
+        return self._warm(n)
+
+    def _warm(self, n):
+        mm = self.mm
+        # Holding the transaction lock means no objects are freed while we
+        # are looking at them.  In between, transactions may free the oids
+        # in the queue, and they tell us which through freed.
+        lock = mm.transaction().lock
+        freed = set()
+        with lock:
+            mm._freed_watchers.append(freed)
+            queue = collections.deque(
+                [mm.otuple(self._pmem_root.root_object)])
+        seen = set()
+        count = 0
+        try:
+            while queue and count < n:
+                oid = queue.popleft()
+                if not oid[0] or oid in seen:
+                    continue
+                seen.add(oid)
+                with lock:
+                    if self.closed or self._stop.is_set():
+                        break
+                    if oid in freed:
+                        continue
+                    obj = mm.resurrect(oid)
+                    if hasattr(obj, '_p_traverse'):
+                        self._warm_objects.append(obj)
+                        queue.extend(mm.otuple(sub_oid)
+                                     for sub_oid in obj._p_traverse())
+                count += 1
+        finally:
+            with lock:
+                mm._freed_watchers.remove(freed)
+        log.debug('warm: loaded %d objects', count)
+        return count
+
     def persist_via_pickle(self, *types):
         """Nominate types to be persisted by pickling them.
 
@@ -827,8 +2803,217 @@ class PersistentObjectPool(object):
         for t in types:
             self.mm._pickleable.add(_class_string(t))
 
+    def gc_step(self, max_objects=GC_STEP_SIZE):
+        """Do a bounded amount of generational garbage collection.
+
+        Objects created after the first call are collected generationally,
+        much like the gc module does for Python objects: once more than the
+        first threshold (see set_gc_threshold) new objects exist, the
+        youngest generations are collected, and once enough of those
+        collections have happened the whole pool is collected.  A whole pool
+        collection is done incrementally, about max_objects objects per
+        call, and the pool can be used normally in between.  Young
+        collections are done in a single call; the thresholds keep them
+        small.
+
+        Return the generation whose collection was completed by this call,
+        or None.  Must not be called inside a transaction.
+        """
+        with self.lock:
+            if self.mm.transaction().depth:
+                raise RuntimeError("gc_step called inside a transaction")
+            gens = self._generations
+            if gens is None:
+                gens = self._generations = _Generations(self)
+                self.mm._generations = gens
+            state = self._pmem_root.gc_state
+            if self._collection is None:
+                generation = gens.due(state)
+                if generation is None:
+                    return None
+                if generation < 2:
+                    examined, survived, freed = gens.collect(generation)
+                    log.debug('gc: generation %s: %s examined, %s survived,'
+                              ' %s containers freed',
+                              generation, examined, survived, freed)
+                    count = list(state.count)
+                    count[generation] = 0
+                    count[generation + 1] += 1
+                    pending = state.long_lived_pending
+                    if generation == 1:
+                        pending += survived
+                    self._update_gc_state(count=count,
+                                          long_lived_pending=pending)
+                    return generation
+                log.debug('gc: starting incremental collection')
+                gens.clear()
+                self._collection = _IncrementalCollector(self)
+                self._collection.start()
+            if self._step_collection(max_objects):
+                return 2
+            return None
+
+    def get_gc_threshold(self):
+        """Return the generational collection thresholds as a tuple."""
+        return tuple(self._pmem_root.gc_state.threshold)
+
+    def set_gc_threshold(self, threshold0, threshold1=None, threshold2=None):
+        """Set the generational collection thresholds used by gc_step.
+
+        The thresholds have the same meaning as those of gc.set_threshold:
+        generation 0 is collected when it holds more than threshold0
+        objects, and generation 1 (2) is collected instead once generation 0
+        (1) has been collected more than threshold1 (threshold2) times since
+        it was last collected.  A threshold0 of zero disables collection.
+        The thresholds are stored in the pool.
+        """
+        old = self.get_gc_threshold()
+        new = [threshold0,
+               old[1] if threshold1 is None else threshold1,
+               old[2] if threshold2 is None else threshold2]
+        with self.lock:
+            self._update_gc_state(threshold=new)
+
+    def get_gc_count(self):
+        """Return the current generational collection counts as a tuple.
+
+        These are the number of objects in generation 0, and the number of
+        collections of generations 0 and 1 since generations 1 and 2 were
+        last collected.
+        """
+        young = 0 if self._generations is None else len(
+                                                self._generations.young[0])
+        return (young,) + tuple(self._pmem_root.gc_state.count)[1:]
+
+    def enable_interning(self):
+        """Store equal str, bytes, int and float values only once.
+
+        Create a persistent index of the values of those types stored in the
+        pool, so that persisting a value equal to one already in the pool
+        reuses the existing copy, even across program runs.  Values are
+        removed from the index when they are freed.  Once enabled, interning
+        stays enabled for the life of the pool.  Only values stored after it
+        is enabled are interned.
+
+        Versions that don't know about interning would leave the index
+        pointing at freed memory, so only pools with the current layout,
+        which they can't open, can have one: for pools with an older layout
+        raise a RuntimeError.
+        """
+        with self.lock:
+            if self.mm._intern_table is not None:
+                return
+            if self.mm._layout_info < (0, 0, 4):
+                raise RuntimeError("interning needs a pool with layout"
+                                   " pypmemobj-0.0.4 or later")
+            with self.mm.transaction():
+                table = self.mm.new(InternTable)
+                self.mm.incref(table._p_oid)
+                self.mm.snapshot_range(
+                    ffi.addressof(self._pmem_root, 'intern_table'),
+                    ffi.sizeof('PObjPtr'))
+                self._pmem_root.intern_table = table._p_oid
+            self.mm._intern_table = table
+
+    def _drop_intern_table(self):
+        # A pool with a layout that predates interning may have been changed
+        # by a version that doesn't keep the table up to date, so its entries
+        # can't be trusted.  The table holds no references, so freeing it
+        # doesn't touch them.
+        log.warning('dropping the intern table of a pool with layout %s',
+                    _layout_version(self.mm._layout_info))
+        mm = self.mm
+        with mm.transaction():
+            mm.snapshot_range(ffi.addressof(self._pmem_root, 'intern_table'),
+                              ffi.sizeof('PObjPtr'))
+            oid = mm.otuple(self._pmem_root.intern_table)
+            self._pmem_root.intern_table = mm.OID_NULL
+            mm.decref(oid)
+
     # If I didn't have to support python2 I'd make debug keyword only.
-    def gc(self, debug=None):
+    def _trace(self, oid, containers, other, live, gc_counts, debug=False):
+        # Mark the objects oid refers to as live, removing them from
+        # containers and other, and appending the offsets of the containers
+        # to live so that they get traced in turn.
+        for sub_oid in self.mm._traverse(oid):
+            sub_key = self.mm.otuple(sub_oid)
+            if sub_key in containers:
+                if debug:
+                    log.debug('gc: refed container %s %r',
+                               sub_key, self.mm.resurrect(sub_oid))
+                containers.remove(sub_key)
+                live.append(sub_key[1])
+            elif sub_key in other:
+                if debug:
+                    log.debug('gc: refed oid %s %r',
+                              sub_key, self.mm.resurrect(sub_oid))
+                other.remove(sub_key)
+                gc_counts['other-live'] += 1
+
+    def _parallel_mark(self, workers, containers, other, live, gc_counts):
+        # Trace from the containers in live, like _trace, using worker
+        # processes.  The workers are forked, so they see the pool mapped
+        # just as we do, along with the catalog of containers and other
+        # objects; they only read the pool, using the raw traversal methods.
+        # We trace the containers that don't have one.  The workers share
+        # a bitmap of the containers that have been reached, so they
+        # mostly don't duplicate each other's work.  Updates to it can race,
+        # but that only means some duplicated work: what is live is decided
+        # here, from the offsets the workers send back.
+        global _mark_state
+        mm = self.mm
+        uuid_lo = containers.uuid_lo
+        traversers = {}
+        for type_code in range(len(mm._type_table)):
+            traversers[type_code] = mm._type_info(type_code)[1]
+        type_table_oid = mm._type_table._p_oid
+        base = (int(ffi.cast('uintptr_t', mm.direct(type_table_oid)))
+                - type_table_oid[1])
+        reached = mmap.mmap(-1, max(len(containers._bits), 1))
+        reached_bits = ffi.cast('unsigned char *', ffi.from_buffer(reached))
+        for off in live:
+            _set_mark(reached_bits, len(reached), off)
+        _mark_state = (_MappedObjects(base), traversers, containers, other,
+                       reached_bits, len(reached))
+        try:
+            if hasattr(multiprocessing, 'get_context'):
+                worker_pool = multiprocessing.get_context('fork').Pool(workers)
+            else:
+                worker_pool = multiprocessing.Pool(workers)
+        finally:
+            _mark_state = None
+        try:
+            frontier = array('Q', live)
+            while frontier:
+                log.debug('gc: marking from %s containers', len(frontier))
+                chunks = [frontier[i::workers] for i in range(workers)]
+                frontier = array('Q')
+                results = worker_pool.map(_mark_worker, chunks)
+                for marked, marked_other, deferred in results:
+                    for off in marked:
+                        oid = (uuid_lo, off)
+                        if oid in containers:
+                            containers.remove(oid)
+                            live.append(off)
+                    for off in marked_other:
+                        oid = (uuid_lo, off)
+                        if oid in other:
+                            other.remove(oid)
+                            gc_counts['other-live'] += 1
+                for marked, marked_other, deferred in results:
+                    for off in deferred:
+                        start = len(live)
+                        self._trace((uuid_lo, off), containers, other, live,
+                                    gc_counts)
+                        for new in live[start:]:
+                            _set_mark(reached_bits, len(reached), new)
+                        frontier.extend(live[start:])
+        finally:
+            worker_pool.terminate()
+            worker_pool.join()
+            reached.close()
+
+    def gc(self, debug=None, workers=None):
         # XXX add debug flag to constructor, and a test that orphans
         # generate warning messages when debug=True.
         """Free all unreferenced objects (cyclic garbage).
@@ -844,23 +3029,35 @@ class PersistentObjectPool(object):
         additional checks will be done for orphaned or invalid data structures
         (those reported by a Persistent object's _p_substructures method).
 
+        If workers is more than one, the tracing is shared among that many
+        forked worker processes (so this needs a platform with fork).
+        Freeing the garbage is still done by this process.
+
         """
-        # XXX CPython uses a three generation GC in order to obtain more or
-        # less linear performance against the total number of objects.
-        # Currently we are not doing generations; we can get more complicated
-        # later if we want to run the GC periodically.
+        # This always collects the whole pool; gc_step does generational
+        # collection for running periodically.
 
         debug = self.debug if debug is None else debug
         log.debug('gc: start')
-        containers = set()
-        other = set()
-        orphans = set()
-        types = {}
+        # All the pool's objects have the same uuid_lo, so we track them by
+        # offset, which takes a lot less memory than sets of oids.
+        uuid_lo = self.mm._type_table._p_oid[0]
+        containers = _OidSet(uuid_lo)
+        other = _OidSet(uuid_lo)
+        orphans = _OidSet(uuid_lo)
         substructures = collections.defaultdict(dict)
         type_counts = collections.defaultdict(int)
         gc_counts = collections.defaultdict(int)
 
         with self.lock:
+            if self._collection is not None:
+                # We are going to do a complete collection anyway.
+                self._collection.stop()
+                self._collection = None
+            # Headers waiting for reuse look like orphans, so really free
+            # them, and don't queue any more while we work.
+            self.mm._drain_freelists()
+            self.mm._recycle = False
             # Catalog all pmem objects.
             oid = self.mm.otuple(lib.pmemobj_first(self._pool_ptr))
             while oid != self.mm.OID_NULL:
@@ -873,12 +3070,7 @@ class PersistentObjectPool(object):
                             log.error("Negative refcount (%s): %s %r",
                                       obj.ob_refcnt, oid, self.mm.resurrect(oid))
                     assert obj.ob_refcnt >= 0, '%s has negative refcnt' % oid
-                    # XXX move this cache to the POP?
-                    type_code = obj.ob_type
-                    if type_code not in types:
-                        types[type_code] = _find_class_from_string(
-                                                self.mm._type_table[type_code])
-                    typ = types[type_code]
+                    typ = self.mm._type_info(obj.ob_type)[0]
                     type_counts[typ.__name__] += 1
                     assert obj.ob_refcnt >= 0, "{} refcount is {}".format(
                                                 oid, obj.ob_refcnt)
@@ -944,41 +3136,35 @@ class PersistentObjectPool(object):
 
             # Trace the object tree, removing objects that are referenced.
             containers.remove(self.mm._type_table._p_oid)
-            live = [self.mm._type_table._p_oid]
+            if self.mm._intern_table is not None:
+                # It is live, but doesn't keep what it points to alive.
+                containers.remove(self.mm._intern_table._p_oid)
+            live = array('Q', [self.mm._type_table._p_oid[1]])
             root_oid = self.mm.otuple(self._pmem_root.root_object)
-            root = self.mm.resurrect(root_oid)
-            if hasattr(root, '_p_traverse'):
+            if root_oid in containers:
                 containers.remove(root_oid)
-                live.append(root_oid)
-            elif root is not None:
+                live.append(root_oid[1])
+            elif root_oid in other:
                 if debug:
-                    log.debug('gc: non-container root: %s %r', root_oid, root)
-                if root_oid[0]:
-                    # It's not a singleton, so it should be in other.
-                    other.remove(root_oid)
-            for oid in live:
-                if debug:
-                    log.debug('gc: checking live %s %r',
-                              oid, self.mm.resurrect(oid))
-                for sub_oid in self.mm.resurrect(oid)._p_traverse():
-                    sub_key = self.mm.otuple(sub_oid)
-                    if sub_key in containers:
-                        if debug:
-                            log.debug('gc: refed container %s %r',
-                                       sub_key, self.mm.resurrect(sub_oid))
-                        containers.remove(sub_key)
-                        live.append(sub_key)
-                    elif sub_key in other:
-                        if debug:
-                            log.debug('gc: refed oid %s %r',
-                                      sub_key, self.mm.resurrect(sub_oid))
-                        other.remove(sub_key)
-                        gc_counts['other-live'] += 1
+                    log.debug('gc: non-container root: %s %r',
+                              root_oid, self.mm.resurrect(root_oid))
+                other.remove(root_oid)
+            if workers is not None and workers > 1:
+                self._parallel_mark(workers, containers, other, live,
+                                    gc_counts)
+            else:
+                for off in live:
+                    oid = (uuid_lo, off)
+                    if debug:
+                        log.debug('gc: checking live %s %r',
+                                  oid, self.mm.resurrect(oid))
+                    self._trace(oid, containers, other, live, gc_counts,
+                                debug)
             gc_counts['containers-live'] = len(live)
 
             # Everything left is unreferenced via the root, deallocate it.
             log.debug('gc: deallocating %s containers', len(containers))
-            self.mm._track_free = set()
+            self.mm._track_free = _OidSet(uuid_lo)
             for oid in containers:
                 if oid in self.mm._track_free:
                     continue
@@ -1001,14 +3187,20 @@ class PersistentObjectPool(object):
                 gc_counts['orphans1-gced'] += 1
             gc_counts['other-gced'] = len(other) - gc_counts['orphans1-gced']
             self.mm._track_free = None
+            self.mm._recycle = True
+            self.mm._may_have_garbage = False
+            self._full_collection_done(gc_counts['containers-live']
+                                       + gc_counts['other-live'])
             log.debug('gc: end')
 
-            # All cleaned up, so no need to gc on open.
-            self._pmem_root.clean_shutdown = self.mm.persist(True)
+            if self.closed:
+                # All cleaned up, so no need to gc on open.
+                self._set_clean_shutdown(True)
             return dict(type_counts), dict(gc_counts)
 
 
-def open(filename, debug=False):
+def open(filename, debug=False, cache_size=DEFAULT_CACHE_SIZE, prefault=False,
+         warm_cache=0, recovery='sync', read_only=False):
     """This function opens an existing object pool, returning a
     :class:`PersistentObjectPool`.
 
@@ -1021,13 +3213,27 @@ def open(filename, debug=False):
     :return: a :class:`PersistentObjectPool` instance that manages the pool.
 
     When the pool is opened, if the previous shutdown was not clean the
-    pool is cleaned up, including running the 'gc' method.
+    pool is cleaned up, including running the 'gc' method.  If recovery is
+    'background' the cleanup is done in a background thread instead, so that
+    the pool can be used right away.
+
+    If prefault is True the pool's pages are faulted in when it is opened.
+    If warm_cache is non-zero, up to that many objects reachable from the
+    root are loaded into the object cache by a background thread.
+
+    If read_only is True, the pool is opened read-only (flag 'r'): its
+    objects can be read but not changed, and it is never cleaned up.
+    libpmemobj still maps the file for reading and writing.
     """
     log.debug('open: %s, debug=%s', filename, debug)
     # Make sure the file exists.
-    return PersistentObjectPool(filename, flag='w', debug=debug)
+    return PersistentObjectPool(filename, flag='r' if read_only else 'w',
+                                debug=debug,
+                                cache_size=cache_size, prefault=prefault,
+                                warm_cache=warm_cache, recovery=recovery)
 
-def create(filename, pool_size=MIN_POOL_SIZE, mode=0o666, debug=False):
+def create(filename, pool_size=MIN_POOL_SIZE, mode=0o666, debug=False,
+           cache_size=DEFAULT_CACHE_SIZE, prefault=False):
     """The `create()` function creates an object pool with the given total
     `pool_size`.  Since the transactional nature of an object pool requires
     some space overhead, and immutable values are stored alongside the mutable
@@ -1048,4 +3254,5 @@ def create(filename, pool_size=MIN_POOL_SIZE, mode=0o666, debug=False):
     """
     log.debug('create: %s, %s, %s, debug=%s', filename, pool_size, mode, debug)
     return PersistentObjectPool(filename, flag='x',
-                                pool_size=pool_size, mode=mode, debug=debug)
+                                pool_size=pool_size, mode=mode, debug=debug,
+                                cache_size=cache_size, prefault=prefault)
@@ -194,6 +194,7 @@ class PersistentSet(abc.MutableSet):
         khash = fixed_hash(key)
         result = ADD_RESULT_RESTART
         with mm.transaction():
+            mm.lock(self)
             while result == ADD_RESULT_RESTART:
                 index, result = self._get_available_entry_slot(key, khash)
             if result == ADD_RESULT_FOUND_UNUSED or \
@@ -204,7 +205,6 @@ class PersistentSet(abc.MutableSet):
                                   ffi.sizeof('PSetEntry'))
                 oid = mm.persist(key)
                 mm.incref(oid)
-                p_obj = ffi.cast('PObject *', mm.direct(oid))
                 table_data[index].key = oid
                 table_data[index].hash = khash
                 mm.snapshot_range(
@@ -286,17 +286,33 @@ class PersistentSet(abc.MutableSet):
             elif entry.hash == HASH_DUMMY:
                 set_content += "<D>, "
             else:
-                p_obj = ffi.cast('PObject *', mm.direct(entry.key))
+                key_oid = mm.otuple(entry.key)
+                if key_oid[0]:
+                    p_obj = ffi.cast('PObject *', mm.direct(key_oid))
+                    refcnt = p_obj.ob_refcnt
+                else:
+                    # Constants (including inline values) aren't refcounted.
+                    refcnt = '-'
                 set_content += "(%s h:%s rct:%s), " % (
-                                mm.resurrect(entry.key),
+                                mm.resurrect(key_oid),
                                 entry.hash,
-                                p_obj.ob_refcnt)
+                                refcnt)
         return "%s:[%s]" % (self.__class__.__name__, set_content)
 
     def __contains__(self, key):
-        return self._lookkey(key, fixed_hash(key)) != -1
+        khash = fixed_hash(key)
+        with self._p_mm.object_lock(self).shared():
+            return self._lookkey(key, khash) != -1
 
     def __iter__(self):
+        mm = self._p_mm
+        if mm.object_locks:
+            # Rather than holding the lock between items, take a copy.
+            with mm.object_lock(self).shared():
+                return iter(list(self._iter_keys()))
+        return self._iter_keys()
+
+    def _iter_keys(self):
         mm = self._p_mm
         table_data = ffi.cast('PSetEntry *', mm.direct(self._body.table))
         for i in range(0, self._body.mask + 1):
@@ -424,11 +440,13 @@ class PersistentSet(abc.MutableSet):
         return self.symmetric_difference(other)
 
     def __len__(self):
-        return self._body.used
+        with self._p_mm.object_lock(self).shared():
+            return self._body.used
 
     def _discard(self, key):
         mm = self._p_mm
         with mm.transaction():
+            mm.lock(self)
             keyindex = self._lookkey(key, fixed_hash(key))
             if keyindex != -1:
                 table_data = ffi.cast('PSetEntry *',
@@ -444,22 +462,33 @@ class PersistentSet(abc.MutableSet):
         self._discard(key)
 
     def _p_traverse(self):
-        mm = self._p_mm
-        table_data = ffi.cast('PSetEntry *', mm.direct(self._body.table))
-        for i in range(0, self._body.mask + 1):
-            entry = table_data[i]
-            if entry.hash in (HASH_UNUSED, HASH_DUMMY):
-                continue
-            yield entry.key
+        return self._p_traverse_raw(self._p_mm,
+                                    ffi.cast('PObject *', self._body))
 
     def _p_substructures(self):
         return ((self._body.table, SET_POBJPTR_ARRAY_TYPE_NUM),)
 
     def _p_deallocate(self):
-        mm = self._p_mm
-        for key_oid in self._p_traverse():
-            mm.decref(key_oid)
-        mm.free(self._body.table)
+        self._p_deallocate_raw(self._p_mm, ffi.cast('PObject *', self._body))
+
+    # Versions of the above that work directly on the PObject, so that the
+    # gc doesn't need to resurrect the set.
+
+    @staticmethod
+    def _p_traverse_raw(manager, p_obj):
+        body = ffi.cast('PSetObject *', p_obj)
+        table_data = ffi.cast('PSetEntry *', manager.direct(body.table))
+        for i in range(0, body.mask + 1):
+            entry = table_data[i]
+            if entry.hash in (HASH_UNUSED, HASH_DUMMY):
+                continue
+            yield manager.otuple(entry.key)
+
+    @staticmethod
+    def _p_deallocate_raw(manager, p_obj):
+        for key_oid in PersistentSet._p_traverse_raw(manager, p_obj):
+            manager.decref(key_oid)
+        manager.free(ffi.cast('PSetObject *', p_obj).table)
 
     def _p_resurrect(self, manager, oid):
         mm = self._p_mm = manager
@@ -17,23 +17,28 @@ class PersistentTuple(PersistentList):
         if len(args) != 1:
             raise TypeError("PersistentTuple takes at most 1"
                             " argument, {} given".format(len(args)))
-        item_count = len(args[0])
+        values = args[0]
+        item_count = len(values)
         mm = self._p_mm
         with mm.transaction():
+            # Every slot gets written below, so there is no need to zero it.
+            items_oid = mm.alloc(item_count * ffi.sizeof('PObjPtr'),
+                                 type_num=TUPLE_POBJPTR_ARRAY_TYPE_NUM)
             mm.snapshot_range(
                 ffi.addressof(self._body, 'ob_items'), ffi.sizeof('PObjPtr'))
-            self._body.ob_items = mm.zalloc(
-                                    item_count * ffi.sizeof('PObjPtr'),
-                                    type_num=TUPLE_POBJPTR_ARRAY_TYPE_NUM)
+            self._body.ob_items = items_oid
+            if item_count:
+                items = ffi.cast('PObjPtr *', mm.direct(items_oid))
+                for index, value in enumerate(values):
+                    v_oid = mm.persist(value)
+                    items[index] = v_oid
+                    mm.incref(v_oid)
 
             ob = ffi.cast('PVarObject *', self._body)
             mm.snapshot_range(ffi.addressof(ob, 'ob_size'),
                               ffi.sizeof('size_t'))
             ob.ob_size = item_count
 
-            for index, value in enumerate(args[0]):
-                super(self.__class__, self).__setitem__(index, value)
-
     def _p_new(self, manager):
         mm = self._p_mm = manager
         with mm.transaction():
@@ -92,3 +97,16 @@ class PersistentTuple(PersistentList):
 
     def _p_substructures(self):
         return ((self._body.ob_items, TUPLE_POBJPTR_ARRAY_TYPE_NUM),)
+
+    def _p_deallocate(self):
+        mm = self._p_mm
+        with mm.transaction():
+            self._p_deallocate_raw(mm, ffi.cast('PObject *', self._body))
+
+    @staticmethod
+    def _p_deallocate_raw(manager, p_obj):
+        body = ffi.cast('PTupleObject *', p_obj)
+        for oid in PersistentTuple._p_traverse_raw(manager, p_obj):
+            manager.decref(oid)
+        if manager.otuple(body.ob_items) != manager.OID_NULL:
+            manager.free(body.ob_items)
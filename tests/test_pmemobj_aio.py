@@ -0,0 +1,108 @@
+# -*- coding: utf8 -*-
+import threading
+import unittest
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from nvm import pmemobj
+
+from tests.support import TestCase
+
+
+@unittest.skipIf(asyncio is None, "asyncio is not available")
+class TestAsyncPool(TestCase):
+
+    def _make_pool(self, **kw):
+        from nvm.pmemobj.aio import AsyncPool
+        self.fn = self._test_fn()
+        self.pop = pmemobj.create(self.fn)
+        self.addCleanup(self.pop.close)
+        self.pop.root = self.pop.new(pmemobj.PersistentDict)
+        apool = AsyncPool(self.pop, **kw)
+        self.addCleanup(apool.close)
+        return apool
+
+    def _wait(self, *awaitables):
+        # Run an event loop until the awaitables are done, and return their
+        # results and exceptions.
+        return self.loop.run_until_complete(
+            asyncio.gather(*awaitables, return_exceptions=True))
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+
+    def test_run(self):
+        apool = self._make_pool()
+        root = self.pop.root
+        def store(key, value):
+            root[key] = value
+            return threading.current_thread()
+        def fail():
+            root['b'] = 2
+            raise ValueError('boo')
+        thread, error = self._wait(apool.run(store, 'a', 1), apool.run(fail))
+        self.assertIsInstance(thread, threading.Thread)
+        self.assertIsNot(thread, threading.current_thread())
+        self.assertIsInstance(error, ValueError)
+        self.assertEqual(dict(root), {'a': 1})
+        # Even exceptions that aren't Exceptions are passed on, and the
+        # thread carries on.
+        def exit():
+            root['c'] = 3
+            raise SystemExit(1)
+        error, size = self._wait(apool.run(exit), apool.run(len, root))
+        self.assertIsInstance(error, SystemExit)
+        self.assertEqual(size, 1)
+        apool.close()
+        with self.assertRaises(RuntimeError):
+            apool.run(store, 'c', 3)
+
+    def test_group_commit(self):
+        apool = self._make_pool(group_commit=True)
+        root = self.pop.root
+        started = threading.Event()
+        release = threading.Event()
+        def block():
+            started.set()
+            release.wait()
+        def store(key):
+            root[key] = key
+            return key
+        def fail():
+            root['x'] = 'x'
+            raise ValueError('boo')
+        # While the thread is busy, queue up a group, with one failure.
+        first = apool.run(block)
+        started.wait()
+        commits = self.pop.transaction_stats()['commits']
+        futures = [apool.run(store, i) for i in range(5)] + [apool.run(fail)]
+        release.set()
+        results = self._wait(first, *futures)
+        self.assertEqual(results[:-1], [None, 0, 1, 2, 3, 4])
+        self.assertIsInstance(results[-1], ValueError)
+        self.assertEqual(sorted(root), list(range(5)))
+        # The failure rolled back the group, so each function was rerun in
+        # its own transaction.
+        self.assertEqual(self.pop.transaction_stats()['commits'],
+                         commits + 1 + 5)
+        # Without a failure the group is committed at once.
+        started.clear()
+        release.clear()
+        first = apool.run(block)
+        started.wait()
+        futures = [apool.run(store, i) for i in range(5, 10)]
+        release.set()
+        self._wait(first, *futures)
+        self.assertEqual(sorted(root), list(range(10)))
+        self.assertEqual(self.pop.transaction_stats()['commits'],
+                         commits + 1 + 5 + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
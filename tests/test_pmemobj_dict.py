@@ -87,6 +87,29 @@ class TestPersistentDict(TestCase):
         with self.assertRaises(KeyError):
             del d['a']
 
+    def test_changes_are_rolled_back_on_abort(self):
+        expected = {'a': 1, 'b': 'a string that is not inline'}
+        d = self._make_dict(expected)
+        with self.assertRaisesRegex(Exception, 'boo'):
+            with self.pop.transaction():
+                d['a'] = 2
+                del d['b']
+                for i in range(20):
+                    d[i] = 'value {}'.format(i)
+                raise Exception('boo')
+        self.assertEqual(dict(d), expected)
+        d = self._reload_root()
+        self.assertEqual(dict(d), expected)
+
+    def test_delitem_bad_key_in_transaction(self):
+        # The error doesn't abort the enclosing transaction.
+        d = self._make_dict()
+        with self.pop.transaction():
+            with self.assertRaises(KeyError):
+                del d['a']
+            d['b'] = 1
+        self.assertEqual(dict(d), {'b': 1})
+
     def test_constructor(self):
         kw = dict(a=1, b=2, c=3)
         arg = (('z', 5), ('a', 7))
@@ -118,6 +118,17 @@ class TestPersistentList(TestCase):
         with self.assertRaises(IndexError):
             del lst[-10]
 
+    def test_index_errors_in_transaction(self):
+        # The error doesn't abort the enclosing transaction.
+        lst = self._make_list(['a', 'b', 'c'])
+        with self.pop.transaction():
+            with self.assertRaises(IndexError):
+                del lst[3]
+            with self.assertRaises(IndexError):
+                lst[-4] = 'z'
+            lst.append('d')
+        self.assertEqual(lst, ['a', 'b', 'c', 'd'])
+
     def test_len(self):
         lst = self._make_list([])
         for i in range(6):
@@ -134,6 +145,19 @@ class TestPersistentList(TestCase):
         lst.append(1)
         self.assertEqual(lst, [1])
 
+    def test_changes_are_rolled_back_on_abort(self):
+        lst = self._make_list(list(range(10)))
+        changes = (lambda: lst.__setitem__(3, 'a string that is not inline'),
+                   lambda: lst.insert(5, 'x'),
+                   lambda: lst.__delitem__(3),
+                   lst.clear)
+        for change in changes:
+            with self.assertRaisesRegex(Exception, 'boo'):
+                with self.pop.transaction():
+                    change()
+                    raise Exception('boo')
+            self.assertEqual(lst, list(range(10)))
+
     def test_eq(self):
         lst = self._make_list([])
         self.assertEqual(lst, [])
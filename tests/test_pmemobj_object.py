@@ -20,6 +20,11 @@ class Foo3(pmemobj.PersistentObject):
         self.bar = None
         self.bing = 'this is a test'
 
+class Foo4(pmemobj.PersistentObject):
+    def _p_traverse(self):
+        for oid in super(Foo4, self)._p_traverse():
+            yield oid
+
 
 class TestPersistentObject(TestCase):
 
@@ -130,6 +135,17 @@ class TestPersistentObject(TestCase):
         self.assertEqual(o.bar, None)
         self.assertEqual(o.bing, 'this is a test')
 
+    def test_overridden_traverse_is_used_by_gc(self):
+        d = self._make_object(Foo)
+        o = d.other = self.pop.new(Foo4)
+        mm = self.pop.mm
+        self.assertIsNotNone(mm._type_info(mm._get_type_code(Foo))[1])
+        cls, traverse, deallocate = mm._type_info(mm._get_type_code(Foo4))
+        self.assertIs(cls, Foo4)
+        self.assertIsNone(traverse)
+        self.assertIsNotNone(deallocate)
+        self.assertEqual(list(mm._traverse(o._p_oid)), [o._p_dict._p_oid])
+
 
 if __name__ == '__main__':
     unittest.main()
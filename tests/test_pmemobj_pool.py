@@ -1,6 +1,8 @@
 # -*- coding: utf8 -*-
+import gc
 import logging
 import sys
+import threading
 import unittest
 import re
 
@@ -13,6 +15,18 @@ class TestFoo(object):
     pass
 
 
+class TracedObject(pmemobj.PersistentObject):
+    # Has no raw traversal method, so gc has to resurrect it.
+
+    def __init__(self):
+        self.items = self._p_mm.new(pmemobj.PersistentDict,
+                                    n='long string 19')
+
+    def _p_traverse(self):
+        for oid in super(TracedObject, self)._p_traverse():
+            yield oid
+
+
 class TestPersistentObjectPool(TestCase):
 
     def assertMsgBits(self, msg, *bits):
@@ -98,6 +112,53 @@ class TestPersistentObjectPool(TestCase):
         pop = pmemobj.PersistentObjectPool(fn)
         self.assertEqual(pop.root, 10)
 
+    def _read_only_pool(self):
+        fn = self._test_fn()
+        pop = pmemobj.create(fn)
+        pop.root = pop.new(pmemobj.PersistentDict,
+                           a=pop.new(pmemobj.PersistentList, ['long string']))
+        pop.close()
+        pop = pmemobj.open(fn, read_only=True)
+        self.addCleanup(pop.close)
+        return pop
+
+    def test_constructor_flag_r(self):
+        pop = self._read_only_pool()
+        self.assertTrue(pop.read_only)
+        self.assertEqual(pop.root['a'], ['long string'])
+        with self.assertRaises(RuntimeError):
+            pop.root = 10
+        with self.assertRaises(RuntimeError):
+            pop.root['a'].append(1)
+        with self.assertRaises(RuntimeError):
+            pop.new(pmemobj.PersistentList)
+        with self.assertRaises(RuntimeError):
+            with pop.transaction():
+                pass
+        self.assertEqual(pop.root['a'], ['long string'])
+
+    def test_snapshot(self):
+        fn = self._test_fn()
+        snapshot_fn = self._test_fn()
+        pop = pmemobj.create(fn)
+        self.addCleanup(pop.close)
+        pop.root = pop.new(pmemobj.PersistentList, ['long string'])
+        with pop.transaction():
+            pop.root.append(2)
+            self.assertRaises(RuntimeError, pop.snapshot, snapshot_fn)
+        pop.snapshot(snapshot_fn)
+        with self.assertRaises(OSError):
+            pop.snapshot(snapshot_fn)
+        pop.root.append(3)
+        pop.close()
+        # libpmemobj won't open a copy of an open pool in the same process.
+        snap = pmemobj.open(snapshot_fn, read_only=True)
+        self.assertEqual(snap.root, ['long string', 2])
+        snap.close()
+        pop = pmemobj.open(fn)
+        self.addCleanup(pop.close)
+        self.assertEqual(pop.root, ['long string', 2, 3])
+
     @unittest.skipIf(sys.version_info[0] < 3, 'test only runs on python3')
     def test_debug(self):
         # When debug is on, orphans are logged as warnings (in production
@@ -142,6 +203,26 @@ class TestPersistence(TestCase):
                        float=10.5,
                        string='abcde',
                        ustring='abő',
+                       negative_int=-5,
+                       inline_int_max=2**59 - 1,
+                       inline_int_min=-2**59,
+                       big_int=2**59,
+                       big_negative_int=-2**59 - 1,
+                       int64_max=2**63 - 1,
+                       int64_min=-2**63,
+                       huge_int=2**63,
+                       huge_negative_int=-2**63 - 1,
+                       enormous_int=3**200,
+                       enormous_negative_int=-3**200,
+                       zero_float=0.0,
+                       inexact_float=0.1,
+                       empty_string='',
+                       string7='abcdefg',
+                       string8='abcdefgh',
+                       long_ustring='őőőő',
+                       nul_string='ab\0cd\0' * 3,
+                       bytes=(b'abc',),
+                       long_bytes=(b'\0\xff' * 100,),
                        )
     if sys.version_info[0] < 3:
         objs_params['long_int'] = sys.maxint * 2
@@ -162,10 +243,9 @@ class TestPersistence(TestCase):
         pop.root.append(pid)
         # pop.root gets resurrected from cache here.
         self.assertIs(pop.root, root)
-        # And the list's first element gets resurrected from cache here.  That
-        # 'is' works here is not actually an API requirement, but it is a
-        # reality of the current code that isn't likely to break.
-        self.assertIs(pop.root[0], pid)
+        # And the list's first element is stored inline, so it never goes
+        # through the cache at all.
+        self.assertEqual(pop.root[0], pid)
 
     singleton_params = dict(
                        none=None,
@@ -180,6 +260,158 @@ class TestPersistence(TestCase):
         pop = self._reopen_pop()
         self.assertIs(pop.root, obj)
 
+    def test_legacy_layout_is_opened_and_preserved(self):
+        # Pools created with the 0.0.1 layout store ints as decimal strings;
+        # we must still be able to open them and keep using that encoding.
+        from nvm.pmemobj.pool import lib, _layout_version
+        from nvm.pmemobj.compat import _coerce_fn
+        self.fn = self._test_fn()
+        lib.pmemobj_close(lib.pmemobj_create(_coerce_fn(self.fn),
+                                             _layout_version((0, 0, 1)),
+                                             pmemobj.MIN_POOL_SIZE, 0o666))
+        pop = self.pop = pmemobj.open(self.fn)
+        self.addCleanup(lambda: self.pop.close())
+        self.assertEqual(pop.mm._layout_info, (0, 0, 1))
+        values = [2**70, -2**62, 1, 2.0, 'abc']
+        pop.root = pop.new(pmemobj.PersistentList, values)
+        # That layout predates inline values, so nothing is stored inline.
+        with pop.transaction():
+            for value in values[2:]:
+                self.assertNotEqual(pop.mm.persist(value)[0], 0)
+        pop = self._reopen_pop()
+        self.assertEqual(pop.mm._layout_info, (0, 0, 1))
+        self.assertEqual(pop.root, values)
+
+    def test_legacy_strings_are_opened_and_preserved(self):
+        # Pools created with the 0.0.2 layout store NUL terminated strings.
+        from nvm.pmemobj.pool import lib, _layout_version
+        from nvm.pmemobj.compat import _coerce_fn
+        self.fn = self._test_fn()
+        lib.pmemobj_close(lib.pmemobj_create(_coerce_fn(self.fn),
+                                             _layout_version((0, 0, 2)),
+                                             pmemobj.MIN_POOL_SIZE, 0o666))
+        pop = self.pop = pmemobj.open(self.fn)
+        self.addCleanup(lambda: self.pop.close())
+        self.assertEqual(pop.mm._layout_info, (0, 0, 2))
+        pop.root = pop.new(pmemobj.PersistentList, ['abcdefghij', 'ő' * 10])
+        pop = self._reopen_pop()
+        self.assertEqual(pop.mm._layout_info, (0, 0, 2))
+        self.assertEqual(pop.root, ['abcdefghij', 'ő' * 10])
+
+    @unittest.skipIf(bytes is str, "bytes are strs on python2")
+    def test_legacy_bytes_are_pickled(self):
+        # Layouts older than 0.0.3 have no bytes type, so bytes are only
+        # persisted if they are pickled.
+        from nvm.pmemobj.pool import lib, _layout_version
+        from nvm.pmemobj.compat import _coerce_fn
+        self.fn = self._test_fn()
+        lib.pmemobj_close(lib.pmemobj_create(_coerce_fn(self.fn),
+                                             _layout_version((0, 0, 2)),
+                                             pmemobj.MIN_POOL_SIZE, 0o666))
+        pop = self.pop = pmemobj.open(self.fn)
+        self.addCleanup(lambda: self.pop.close())
+        with self.assertRaises(TypeError):
+            pop.root = b'ab'
+        with self.assertRaises(TypeError):
+            pop.root = bytearray(b'ab')
+        pop.persist_via_pickle(bytes)
+        pop.root = pop.new(pmemobj.PersistentList, [b'ab', b'x' * 20])
+        pop = self._reopen_pop()
+        self.assertEqual(pop.mm._layout_info, (0, 0, 2))
+        self.assertEqual(pop.root, [b'ab', b'x' * 20])
+
+    def mutable_buffers_as_persisted_bytes(self, factory):
+        pop = self._setup()
+        data = b'some bytes \0 with a NUL'
+        pop.root = factory(data)
+        pop = self._reopen_pop()
+        self.assertEqual(pop.root, data)
+        self.assertIs(type(pop.root), bytes)
+
+    mutable_buffers_params = dict(bytearray=(bytearray,),
+                                  memoryview=(memoryview,))
+
+    def test_buffer_views(self):
+        pop = self._setup()
+        data = b'x' * 100 + b'y'
+        pop.root = pop.new(pmemobj.PersistentList, [data, b'short'])
+        pop.mm.buffer_views = True
+        view = pop.root[0]
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view, data)
+        self.assertEqual(view[-1:].tobytes(), b'y')
+        if hasattr(view, 'toreadonly'):
+            self.assertTrue(view.readonly)
+        # Inline values have no persistent memory to point to.
+        self.assertEqual(pop.root[1], b'short')
+        pop.mm.buffer_views = False
+        self.assertIs(type(pop.root[0]), bytes)
+        self.assertEqual(pop.root[0], data)
+
+    def test_interning_shares_values_across_sessions(self):
+        pop = self._setup()
+        pop.enable_interning()
+        value = 'status: all systems go'
+        pop.root = pop.new(pmemobj.PersistentList, [value, 2**62, 0.1])
+        pop = self._reopen_pop()
+        before = pop.gc(debug=True)[0]
+        pop.root.extend(['status: all systems' + ' go', 2**62, 0.1])
+        oids = [pop.mm.otuple(pop.root._items[i]) for i in range(6)]
+        self.assertEqual(oids[:3], oids[3:])
+        self.assertEqual(pop.gc(debug=True)[0], before)
+
+    def test_interned_values_are_removed_when_freed(self):
+        pop = self._setup()
+        pop.enable_interning()
+        pop.root = pop.new(pmemobj.PersistentList, ['abcdefghij'] * 2)
+        table = pop.mm._intern_table
+        self.assertEqual(len(table), 1)
+        del pop.root[0]
+        self.assertEqual(len(table), 1)
+        del pop.root[0]
+        self.assertEqual(len(table), 0)
+        pop = self._reopen_pop()
+        self.assertEqual(len(pop.mm._intern_table), 0)
+        # Enough distinct values to make the table grow.
+        values = ['value number {}'.format(i) for i in range(200)]
+        pop.root.extend(values)
+        pop = self._reopen_pop()
+        pop.root.extend(values)
+        self.assertEqual(len(pop.mm._intern_table), 200)
+        self.assertEqual(list(pop.root), values * 2)
+
+    def test_legacy_layout_intern_table_is_dropped(self):
+        # Versions that can open pools with layouts before 0.0.4 don't keep
+        # intern tables up to date, so those pools can't have one.
+        from nvm.pmemobj.pool import lib, ffi, _layout_version
+        from nvm.pmemobj.intern import InternTable
+        from nvm.pmemobj.compat import _coerce_fn
+        self.fn = self._test_fn()
+        lib.pmemobj_close(lib.pmemobj_create(_coerce_fn(self.fn),
+                                             _layout_version((0, 0, 3)),
+                                             pmemobj.MIN_POOL_SIZE, 0o666))
+        pop = self.pop = pmemobj.open(self.fn)
+        self.addCleanup(lambda: self.pop.close())
+        with self.assertRaises(RuntimeError):
+            pop.enable_interning()
+        self.assertIsNone(pop.mm._intern_table)
+        # Should one have been created anyway, it is dropped on open.
+        value = 'abcdefghij'
+        with pop.transaction():
+            table = pop.mm.new(InternTable)
+            pop.mm.incref(table._p_oid)
+            pop.mm.snapshot_range(
+                ffi.addressof(pop._pmem_root, 'intern_table'),
+                ffi.sizeof('PObjPtr'))
+            pop._pmem_root.intern_table = table._p_oid
+            pop.root = pop.new(pmemobj.PersistentList, [value])
+            table.add(pop.root._items[0], value)
+        pop = self._reopen_pop()
+        self.assertIsNone(pop.mm._intern_table)
+        self.assertEqual(pop.mm.otuple(pop._pmem_root.intern_table),
+                         pop.mm.OID_NULL)
+        self.assertEqual(pop.root, [value])
+
     def test_persistence_via_pickle(self):
         from decimal import Decimal
         pop = self._setup()
@@ -213,6 +445,34 @@ class TestTransactions(TestCase):
         pop = self._reopen_pop()
         self.assertEqual(pop.root, 10)
 
+    def test_precommit_error_aborts(self):
+        pop = self._setup()
+        pop.root = pop.new(pmemobj.PersistentList, [1])
+        trans = pop.transaction()
+        def fail():
+            raise ValueError('boo')
+        precommit = trans._precommit
+        self.addCleanup(setattr, trans, '_precommit', precommit)
+        for context in (False, True):
+            trans._precommit = fail
+            with self.assertRaisesRegex(ValueError, 'boo'):
+                if context:
+                    with trans:
+                        pop.root.append(2)
+                else:
+                    trans.begin()
+                    pop.root.append(2)
+                    trans.commit()
+            self.assertEqual(trans.depth, 0)
+            trans._precommit = precommit
+            self.assertEqual(pop.root, [1])
+            # The pool lock was released.
+            t = threading.Thread(target=pop.root.append, args=(3,))
+            t.start()
+            t.join()
+            self.assertEqual(pop.root, [1, 3])
+            del pop.root[-1]
+
     def test_non_context_abort_raises_and_resets_state(self):
         pop = self._setup()
         # XXX what to do about the invalid message?
@@ -325,6 +585,697 @@ class TestTransactions(TestCase):
         self.assertEqual(pop.root, 10)
 
 
+    def test_alloc_classes(self):
+        from nvm.pmemobj.pool import ffi, lib, ALLOC_CLASS_MAX_SIZE
+        pop = self._setup()
+        mm = pop.mm
+        self.assertNotEqual(mm._alloc_class_flags(ffi.sizeof('PListObject')), 0)
+        self.assertNotEqual(mm._alloc_class_flags(1), 0)
+        self.assertEqual(mm._alloc_class_flags(ALLOC_CLASS_MAX_SIZE + 1), 0)
+        # Bigger sizes never get a smaller class.
+        flags = [mm._alloc_class_flags(size)
+                    for size in range(1, ALLOC_CLASS_MAX_SIZE + 1)]
+        self.assertEqual(flags, sorted(flags))
+        with pop.transaction():
+            oids = [mm.zalloc(size, type_num=99) for size in (24, 56, 200)]
+            oids.append(mm.alloc(40, type_num=99))
+        for oid in oids:
+            self.assertEqual(lib.pmemobj_type_num(oid), 99)
+        self.assertEqual(ffi.buffer(mm.direct(oids[1]), 56)[:], b'\0' * 56)
+        # Classes are registered again when the pool is reopened.
+        pop = self._reopen_pop()
+        self.assertNotEqual(pop.mm._alloc_class_flags(16), 0)
+
+    def _refcnt(self, pop, oid):
+        from nvm.pmemobj.pool import ffi
+        return ffi.cast('PObject *', pop.mm.direct(oid)).ob_refcnt
+
+    def test_refcounts_are_written_at_commit(self):
+        pop = self._setup()
+        value = 'a string that is not inline'
+        pop.root = pop.new(pmemobj.PersistentList, [value])
+        oid = pop.mm.persist(value)
+        self.assertEqual(self._refcnt(pop, oid), 1)
+        with pop.transaction():
+            for i in range(10):
+                pop.root.append(value)
+            pop.root[0] = value
+            self.assertEqual(self._refcnt(pop, oid), 1)
+        self.assertEqual(self._refcnt(pop, oid), 11)
+        pop = self._reopen_pop()
+        self.assertEqual(self._refcnt(pop, oid), 11)
+
+    def test_refcounts_are_discarded_on_abort(self):
+        pop = self._setup()
+        value = 'a string that is not inline'
+        pop.root = pop.new(pmemobj.PersistentList, [value])
+        oid = pop.mm.persist(value)
+        with self.assertRaisesRegex(Exception, 'boo'):
+            with pop.transaction():
+                pop.root.append(value)
+                del pop.root[0]
+                raise Exception('boo')
+        self.assertEqual(self._refcnt(pop, oid), 1)
+        self.assertEqual(pop.root, [value])
+        with pop.transaction():
+            pop.root.append(value)
+        self.assertEqual(self._refcnt(pop, oid), 2)
+
+    def test_net_zero_refcount_change_deallocates(self):
+        pop = self._setup()
+        pop.root = pop.new(pmemobj.PersistentList)
+        before = pop.gc(debug=True)
+        with pop.transaction():
+            pop.root.append(pop.new(pmemobj.PersistentList,
+                                    ['a string that is not inline']))
+            pop.root.pop()
+        after = pop.gc(debug=True)
+        self.assertEqual(before[0], after[0])
+        self.assertEqual(after[1].get('orphans0-gced'), 0)
+
+
+    def test_snapshot_ranges_are_merged(self):
+        pop = self._setup()
+        trans = pop.mm._transaction
+        with pop.transaction():
+            trans.add_range(100, 110)
+            trans.add_range(120, 130)
+            self.assertTrue(trans.covers(102, 108))
+            self.assertFalse(trans.covers(105, 115))
+            self.assertFalse(trans.covers(112, 118))
+            trans.add_range(110, 120)
+            self.assertTrue(trans.covers(100, 130))
+            trans.add_range(90, 140)
+            self.assertEqual(trans._range_starts, [90])
+            self.assertEqual(trans._range_ends, [140])
+        self.assertFalse(trans.covers(100, 110))
+
+    def test_overlapping_snapshots_are_restored_on_abort(self):
+        pop = self._setup()
+        pop.root = pop.new(pmemobj.PersistentList, range(20))
+        with self.assertRaisesRegex(Exception, 'boo'):
+            with pop.transaction():
+                for i in range(20):
+                    pop.root[i] = -i
+                pop.root.insert(5, 'x')
+                pop.root.reverse()
+                del pop.root[3]
+                pop.root.clear()
+                raise Exception('boo')
+        self.assertEqual(pop.root, list(range(20)))
+
+    def test_run_transaction(self):
+        pop = self._setup()
+        pop.root = pop.new(pmemobj.PersistentList)
+        collected = []
+        pop.gc = lambda: collected.append(True)
+        self.addCleanup(delattr, pop, 'gc')
+        attempts = []
+        def fn():
+            pop.root.append(len(attempts))
+            attempts.append(None)
+            if len(attempts) < 3:
+                raise MemoryError()
+            return 'done'
+        self.assertEqual(pop.run_transaction(fn, backoff=0), 'done')
+        # The failed attempts were rolled back.
+        self.assertEqual(pop.root, [2])
+        self.assertEqual(len(collected), 2)
+        stats = pop.transaction_stats()
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual(stats['failures'], 0)
+        del attempts[:]
+        with self.assertRaises(MemoryError):
+            pop.run_transaction(fn, retries=1, backoff=0, compact=False)
+        self.assertEqual(len(collected), 2)
+        self.assertEqual(pop.root, [2])
+        stats = pop.transaction_stats()
+        self.assertEqual(stats['retries'], 3)
+        self.assertEqual(stats['failures'], 1)
+        # Other errors aren't retried.
+        with self.assertRaises(ValueError):
+            pop.run_transaction(lambda: int('x'))
+        self.assertEqual(pop.transaction_stats()['retries'], 3)
+        commits = stats['commits']
+        pop.run_transaction(lambda: pop.root.append(3))
+        self.assertEqual(pop.transaction_stats()['commits'], commits + 1)
+        with pop.transaction():
+            with self.assertRaises(RuntimeError):
+                pop.run_transaction(fn)
+
+    def test_batch(self):
+        pop = self._setup()
+        pop.root = pop.new(pmemobj.PersistentList)
+        l = pop.root
+        commits = pop.transaction_stats()['commits']
+        with pop.batch(max_ops=10) as batch:
+            for i in range(15):
+                l.append(i)
+            # A transaction of our own is one operation, and isn't split.
+            with pop.transaction():
+                for i in range(15, 30):
+                    l.append(i)
+            self.assertEqual(batch.ops, 6)
+        self.assertEqual(batch.commits, 2)
+        self.assertEqual(pop.transaction_stats()['commits'], commits + 2)
+        self.assertEqual(l, list(range(30)))
+        self.assertEqual(pop.transaction().depth, 0)
+        # An exception only undoes the changes since the last commit.
+        with self.assertRaisesRegex(Exception, 'boo'):
+            with pop.batch(max_ops=10) as batch:
+                for i in range(15):
+                    l.append(i)
+                raise Exception('boo')
+        self.assertEqual(batch.commits, 1)
+        self.assertEqual(len(l), 40)
+        # Batches can be committed early, and by time.
+        with pop.batch() as batch:
+            l.append(1)
+            batch.commit()
+            l.append(2)
+            with pop.transaction():
+                with self.assertRaises(RuntimeError):
+                    batch.commit()
+        self.assertEqual(batch.commits, 2)
+        with pop.batch(max_latency_ms=0) as batch:
+            l.append(1)
+            l.append(2)
+        self.assertEqual(batch.commits, 3)
+        with pop.transaction():
+            with self.assertRaises(RuntimeError):
+                with pop.batch():
+                    pass
+
+    def test_batch_after_failed_transaction(self):
+        # A transaction that fails inside a batch aborts the whole batch
+        # transaction, even if the exception is caught.
+        pop = self._setup()
+        l = pop.root = pop.new(pmemobj.PersistentList, [0])
+        with self.assertRaisesRegex(RuntimeError, 'aborted'):
+            with pop.batch() as batch:
+                l.append(1)
+                with self.assertRaisesRegex(ValueError, 'boo'):
+                    with pop.transaction():
+                        l.append(2)
+                        raise ValueError('boo')
+                with self.assertRaisesRegex(RuntimeError, 'aborted'):
+                    l.append(3)
+                with self.assertRaisesRegex(RuntimeError, 'aborted'):
+                    batch.commit()
+        self.assertEqual(batch.commits, 0)
+        self.assertEqual(pop.transaction().depth, 0)
+        self.assertEqual(l, [0])
+        with pop.batch():
+            l.append(4)
+        self.assertEqual(l, [0, 4])
+
+
+class TestThreads(TestCase):
+
+    def _setup(self):
+        self.fn = self._test_fn()
+        pop = self.pop = pmemobj.create(self.fn)
+        self.addCleanup(lambda: self.pop.close())
+        return pop
+
+    def test_pools_have_their_own_locks(self):
+        pop = self._setup()
+        other = pmemobj.create(self._test_fn())
+        self.addCleanup(other.close)
+        self.assertIsNot(pop.lock, other.lock)
+        self.assertIs(pop.transaction().lock, pop.lock)
+
+    def test_transaction_state_is_per_thread(self):
+        pop = self._setup()
+        pop.root = pop.new(pmemobj.PersistentList)
+        entered = threading.Event()
+        release = threading.Event()
+        depths = []
+
+        def hold_transaction():
+            with pop.transaction():
+                pop.root.append('long string value')
+                depths.append(pop.transaction().depth)
+                entered.set()
+                release.wait()
+        thread = threading.Thread(target=hold_transaction)
+        thread.start()
+        entered.wait()
+        # The other thread's transaction is not ours...
+        self.assertEqual(pop.transaction().depth, 0)
+        # ...and ours waits for it to finish.
+        acquired = pop.lock.acquire(False)
+        release.set()
+        thread.join()
+        self.assertFalse(acquired)
+        self.assertEqual(depths, [1])
+        with pop.transaction():
+            self.assertEqual(pop.transaction().depth, 1)
+        self.assertEqual(pop.root, ['long string value'])
+
+    def test_concurrent_transactions(self):
+        pop = self._setup()
+        pop.root = pop.new(pmemobj.PersistentDict)
+        errors = []
+
+        def work(n):
+            try:
+                with pop.transaction():
+                    l = pop.root[n] = pop.new(pmemobj.PersistentList)
+                for i in range(30):
+                    with pop.transaction():
+                        l.append('value {} {}'.format(n, i))
+                        l.append(pop.new(pmemobj.PersistentDict, n=n))
+                    try:
+                        with pop.transaction():
+                            l.append('aborted')
+                            raise ValueError(n)
+                    except ValueError:
+                        pass
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        for n in range(4):
+            l = pop.root[n]
+            self.assertEqual(len(l), 60)
+            self.assertEqual(l[58], 'value {} 29'.format(n))
+            self.assertEqual(l[59]['n'], n)
+        type_counts, gc_counts = pop.gc()
+        for k in [k for k in gc_counts.keys() if k.endswith('-gced')]:
+            self.assertEqual(gc_counts[k], 0)
+
+
+    def _read_during_transaction(self, pop, change, read, abort=False):
+        # Make a change in a transaction and, while it is still open, read
+        # in another thread.  Return whether the read had to wait for the
+        # transaction to end, and what it read.
+        results = []
+        thread = threading.Thread(target=lambda: results.append(read()))
+        try:
+            with pop.transaction():
+                change()
+                thread.start()
+                thread.join(0.2)
+                waited = thread.is_alive()
+                if abort:
+                    raise ValueError()
+        except ValueError:
+            pass
+        thread.join()
+        return waited, results[0]
+
+    def test_object_locks(self):
+        pop = self._setup()
+        pop.mm.object_locks = True
+        pop.root = pop.new(pmemobj.PersistentList, ['old'])
+        other = pop.new(pmemobj.PersistentDict, a=1)
+        pop.root.append(other)
+        l = pop.root
+        def change():
+            l[0] = 'new'
+        # Readers of the list wait for the transaction that changed it...
+        self.assertEqual(
+            self._read_during_transaction(pop, change, lambda: l[0]),
+            (True, 'new'))
+        def change_again():
+            l[0] = 'aborted'
+        self.assertEqual(
+            self._read_during_transaction(pop, change_again, lambda: l[0],
+                                          abort=True),
+            (True, 'new'))
+        # ...but other objects can be read.
+        self.assertEqual(
+            self._read_during_transaction(pop, change, lambda: other['a']),
+            (False, 1))
+        def read_dict():
+            return sorted(other.items())
+        def change_dict():
+            other['b'] = 2
+        self.assertEqual(
+            self._read_during_transaction(pop, change_dict, read_dict),
+            (True, [('a', 1), ('b', 2)]))
+        self.assertEqual(pop.transaction().locks, set())
+
+    def test_shared_object_lock(self):
+        pop = self._setup()
+        pop.mm.object_locks = True
+        d = pop.root = pop.new(pmemobj.PersistentDict, a=1, b=2)
+        lock = pop.mm.object_lock(d)
+        self.assertIs(pop.mm.object_lock(d), lock)
+        reading = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def read():
+            with lock.shared():
+                results.append((d['a'], d['b']))
+                reading.set()
+                release.wait()
+        def write():
+            with pop.transaction():
+                d['a'] = d['b'] = 3
+        reader = threading.Thread(target=read)
+        reader.start()
+        reading.wait()
+        # Other readers don't wait for the first one...
+        with lock.shared():
+            self.assertEqual(len(d), 2)
+            self.assertIn('a', d)
+            self.assertEqual(sorted(d), ['a', 'b'])
+        # ...but writers do, and readers that come after a waiting writer
+        # wait for it.
+        writer = threading.Thread(target=write)
+        writer.start()
+        writer.join(0.2)
+        self.assertTrue(writer.is_alive())
+        late_reader = threading.Thread(target=read)
+        late_reader.start()
+        late_reader.join(0.2)
+        self.assertEqual(results, [(1, 2)])
+        release.set()
+        for thread in (reader, writer, late_reader):
+            thread.join()
+        self.assertEqual(results, [(1, 2), (3, 3)])
+        # The lock can't be upgraded from shared to exclusive.
+        with lock.shared():
+            with self.assertRaises(RuntimeError):
+                d['a'] = 4
+        self.assertEqual(d['a'], 3)
+        # But exclusive holders can read.
+        with pop.transaction():
+            d['a'] = 5
+            with lock.shared():
+                self.assertEqual(d['a'], 5)
+
+    def test_no_transaction_while_holding_object_lock(self):
+        # The pool lock comes before object locks, so a thread holding an
+        # object's lock can't start a transaction, and so can't deadlock
+        # with one waiting for that lock.
+        pop = self._setup()
+        pop.mm.object_locks = True
+        l = pop.root = pop.new(pmemobj.PersistentList)
+        lock = pop.mm.object_lock(l)
+        writer = threading.Thread(target=l.append, args=(1,))
+        with lock.shared():
+            writer.start()
+            while not lock._writers:
+                writer.join(0.01)
+            with self.assertRaises(RuntimeError):
+                with pop.transaction():
+                    pass
+        writer.join()
+        self.assertEqual(l, [1])
+        with lock:
+            with self.assertRaises(RuntimeError):
+                pop.transaction().begin()
+        # Once it is released, transactions can be started again.
+        with pop.transaction():
+            l.append(2)
+        self.assertEqual(l, [1, 2])
+
+    def test_nested_shared_object_locks(self):
+        # A reader holding d's lock shared reads l, which a transaction has
+        # changed and locked, while that transaction waits to change d.
+        from nvm.pmemobj.pool import _waiting
+        pop = self._setup()
+        pop.mm.object_locks = True
+        d = pop.root = pop.new(pmemobj.PersistentDict)
+        l = d['l'] = pop.new(pmemobj.PersistentList, [1])
+        lock = pop.mm.object_lock(d)
+        changed = threading.Event()
+        go = threading.Event()
+        errors = []
+        def write(value):
+            try:
+                with pop.transaction():
+                    l[0] = value
+                    changed.set()
+                    go.wait()
+                    d['b'] = value
+            except RuntimeError as err:
+                errors.append(err)
+        # If the writer waits first, the reader gets the error...
+        writer = threading.Thread(target=write, args=(2,))
+        writer.start()
+        changed.wait()
+        with lock.shared():
+            go.set()
+            while not lock._writers:
+                writer.join(0.01)
+            with self.assertRaises(RuntimeError):
+                d['l'][0]
+        writer.join()
+        self.assertEqual(errors, [])
+        self.assertEqual((d['b'], l[0]), (2, 2))
+        # ...and if the reader waits first, the writer does, and its
+        # transaction is rolled back.
+        changed.clear()
+        go.clear()
+        reading = threading.Event()
+        read_l = threading.Event()
+        results = []
+        def read():
+            with lock.shared():
+                reading.set()
+                read_l.wait()
+                results.append(d['l'][0])
+        reader = threading.Thread(target=read)
+        reader.start()
+        reading.wait()
+        writer = threading.Thread(target=write, args=(3,))
+        writer.start()
+        changed.wait()
+        read_l.set()
+        while reader.ident not in _waiting:
+            reader.join(0.01)
+        go.set()
+        writer.join()
+        reader.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(results, [2])
+        self.assertEqual((d['b'], l[0]), (2, 2))
+
+    def test_object_locks_off(self):
+        pop = self._setup()
+        pop.root = pop.new(pmemobj.PersistentList, ['old'])
+        l = pop.root
+        def change():
+            l[0] = 'new'
+        self.assertEqual(
+            self._read_during_transaction(pop, change, lambda: l[0]),
+            (False, 'new'))
+        self.assertEqual(pop.transaction().locks, set())
+
+    def test_lock_outside_transaction(self):
+        pop = self._setup()
+        pop.mm.object_locks = True
+        pop.root = pop.new(pmemobj.PersistentList)
+        with self.assertRaises(RuntimeError):
+            pop.mm.lock(pop.root)
+
+
+class TestCache(TestCase):
+
+    def _pop(self, **kw):
+        self.fn = self._test_fn()
+        pop = pmemobj.create(self.fn, **kw)
+        self.addCleanup(pop.close)
+        return pop
+
+    def test_immutable_cache_is_bounded(self):
+        pop = self._pop(cache_size=10)
+        values = ['long string {}'.format(i) for i in range(50)]
+        pop.root = pop.new(pmemobj.PersistentList, values)
+        stats = pop.cache_stats()
+        self.assertEqual(stats['max_size'], 10)
+        self.assertLessEqual(stats['size'], 10)
+        self.assertGreaterEqual(stats['evictions'], 40)
+        self.assertEqual(list(pop.root), values)
+        self.assertLessEqual(pop.cache_stats()['size'], 10)
+
+    def test_recently_used_values_stay_cached(self):
+        pop = self._pop(cache_size=2)
+        pop.root = pop.new(pmemobj.PersistentList,
+                           ['long string a', 'long string b'])
+        root = pop.root
+        a = root[0]
+        root[1]
+        self.assertIs(root[0], a)
+        root.append('long string c')
+        # 'b' was the least recently used, so 'a' is still cached.
+        self.assertIs(root[0], a)
+        hits = pop.cache_stats()['hits']
+        root[0]
+        self.assertEqual(pop.cache_stats()['hits'], hits + 1)
+
+    def test_persistent_objects_are_weakly_cached(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList,
+                           [pop.new(pmemobj.PersistentDict) for i in range(5)])
+        root = pop.root
+        dicts = list(root)
+        self.assertIs(root[3], dicts[3])
+        count = pop.cache_stats()['persistent']
+        self.assertGreaterEqual(count, 6)
+        del dicts
+        gc.collect()
+        self.assertEqual(pop.cache_stats()['persistent'], count - 5)
+        self.assertIs(pop.root, root)
+
+    def _warm_pool(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList,
+            [pop.new(pmemobj.PersistentList, ['long string {}'.format(i)])
+                for i in range(10)])
+        pop.close()
+
+    def test_prefault_settings_are_restored(self):
+        self._warm_pool()
+        before = pmemobj.ctl_get('prefault.at_open')
+        pop = pmemobj.open(self.fn, prefault=True)
+        self.addCleanup(pop.close)
+        self.assertEqual(pmemobj.ctl_get('prefault.at_open'), before)
+        self.assertEqual(len(pop.root), 10)
+
+    def test_warm(self):
+        self._warm_pool()
+        pop = pmemobj.open(self.fn)
+        self.addCleanup(pop.close)
+        # Breadth first: the root and its first five items.
+        self.assertEqual(pop.warm(6), 6)
+        held = pop._warm_objects
+        self.assertEqual(len(held), 6)
+        self.assertIs(held[0], pop.root)
+        self.assertIs(held[1], pop.root[0])
+        self.assertEqual(pop.cache_stats()['size'], 0)
+        self.assertEqual(pop.warm(100), 21)
+        self.assertEqual(pop.cache_stats()['size'], 10)
+
+    def test_warm_continues_after_commits(self):
+        self._warm_pool()
+        pop = pmemobj.open(self.fn)
+        self.addCleanup(pop.close)
+        mm = pop.mm
+        resurrect = mm.resurrect
+        calls = []
+        def resurrect_and_commit(oid):
+            calls.append(oid)
+            if len(calls) == 2:
+                # The root's items are queued; free the last one and its
+                # string, and commit.
+                del pop.root[-1]
+            return resurrect(oid)
+        mm.resurrect = resurrect_and_commit
+        self.addCleanup(delattr, mm, 'resurrect')
+        # The root, nine of its items, and their strings.
+        self.assertEqual(pop.warm(100), 19)
+        self.assertEqual(len(pop._warm_objects), 10)
+        self.assertEqual(len(mm._freed_watchers), 0)
+
+    def test_warm_in_background(self):
+        self._warm_pool()
+        pop = pmemobj.open(self.fn, warm_cache=100)
+        self.addCleanup(pop.close)
+        pop._warm_thread.join()
+        self.assertEqual(len(pop._warm_objects), 11)
+        self.assertIs(pop.root[9], pop._warm_objects[10])
+
+    def test_close_stops_warming(self):
+        self._warm_pool()
+        pop = pmemobj.open(self.fn, warm_cache=100)
+        pop.close()
+        self.assertFalse(pop._warm_thread.is_alive())
+        self.assertEqual(pop._warm_objects, [])
+
+
+class TestCtl(TestCase):
+
+    def _pop(self):
+        self.fn = self._test_fn()
+        pop = pmemobj.create(self.fn)
+        self.addCleanup(pop.close)
+        return pop
+
+    def test_get_and_set(self):
+        pop = self._pop()
+        size = pop.ctl_get('tx.cache.size')
+        self.addCleanup(pop.ctl_set, 'tx.cache.size', size)
+        pop.ctl_set('tx.cache.size', size * 2)
+        self.assertEqual(pop.ctl_get('tx.cache.size'), size * 2)
+
+    def test_global_get_and_set(self):
+        old = pmemobj.ctl_get('prefault.at_open')
+        self.addCleanup(pmemobj.ctl_set, 'prefault.at_open', old)
+        pmemobj.ctl_set('prefault.at_open', 1)
+        self.assertEqual(pmemobj.ctl_get('prefault.at_open'), 1)
+
+    def test_stats(self):
+        pop = self._pop()
+        before = pop.ctl_get('stats.heap.curr_allocated')
+        pop.root = pop.new(pmemobj.PersistentList, range(1000))
+        self.assertGreater(pop.ctl_get('stats.heap.curr_allocated'), before)
+
+    def test_alloc_class_desc(self):
+        pop = self._pop()
+        desc = pop.ctl_set('heap.alloc_class.new.desc',
+                           dict(unit_size=512, units_per_block=100))
+        self.assertEqual(desc['unit_size'], 512)
+        self.assertNotEqual(desc['class_id'], 0)
+
+    def test_unknown_name(self):
+        pop = self._pop()
+        with self.assertRaises(ValueError):
+            pop.ctl_get('no.such.entry')
+
+    def test_rejected_value(self):
+        pop = self._pop()
+        with self.assertRaises(ValueError):
+            pop.ctl_set('heap.alloc_class.new.desc', dict(unit_size=0))
+
+
+class TestOidSet(TestCase):
+
+    def _set(self, *offsets):
+        from nvm.pmemobj.pool import _OidSet
+        oids = _OidSet(42)
+        for off in offsets:
+            oids.add((42, off))
+        return oids
+
+    def test_membership(self):
+        oids = self._set(16, 4096, 16)
+        self.assertEqual(len(oids), 2)
+        self.assertIn((42, 16), oids)
+        self.assertIn((42, 4096), oids)
+        self.assertNotIn((42, 32), oids)
+        self.assertNotIn((42, 2**40), oids)
+        self.assertNotIn((0, 16), oids)
+        self.assertNotIn((43, 16), oids)
+        oids.discard((42, 16))
+        oids.discard((42, 16))
+        self.assertNotIn((42, 16), oids)
+        self.assertEqual(len(oids), 1)
+        self.assertRaises(KeyError, oids.remove, (42, 16))
+
+    def test_iteration_and_pop(self):
+        offsets = [48, 16, 10000, 128, 144, 1 << 20]
+        oids = self._set(*offsets)
+        self.assertEqual(list(oids), [(42, off) for off in sorted(offsets)])
+        popped = []
+        while oids:
+            popped.append(oids.pop()[1])
+            if len(popped) == 2:
+                oids.add((42, 32))
+        self.assertEqual(popped, [16, 48, 32, 128, 144, 10000, 1 << 20])
+        self.assertRaises(KeyError, oids.pop)
+
+
 class TestGC(TestCase):
 
     def _pop(self):
@@ -346,7 +1297,9 @@ class TestGC(TestCase):
             'PersistentList': 1,
             'str': 2,
             })
-        pop.root = pop.new(pmemobj.PersistentList, [1, 'a', 3.6, 3])
+        # Use values that are too large to be stored inline in the oid.
+        pop.root = pop.new(pmemobj.PersistentList,
+                           [2**60, 'abcdefgh', 3.6, 2**61])
         type_counts, gc_counts = pop.gc(debug=True)
         # Now we also have two additional types.
         self.assertEqual(type_counts, {
@@ -356,6 +1309,15 @@ class TestGC(TestCase):
             'float': 1,
             })
 
+    def test_inline_values_are_not_allocated(self):
+        pop = self._pop()
+        before = pop.gc(debug=True)
+        pop.root = pop.new(pmemobj.PersistentList, [1, 'a', 0.5, -3, 'abő'])
+        type_counts, gc_counts = pop.gc(debug=True)
+        # Only the list itself got allocated; no new types were registered.
+        before[0]['PersistentList'] += 1
+        self.assertEqual(type_counts, before[0])
+
     maxDiff = None
 
     def test_root_immutable_assignment_gcs(self):
@@ -457,6 +1419,57 @@ class TestGC(TestCase):
         self.assertNotIn('PersistentDict', type_counts)
         self.assertEqual(gc_counts['orphans0-gced'], 0)
 
+    def test_freed_headers_are_reused(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        oids = set()
+        for i in range(10):
+            pop.root.append(pop.new(pmemobj.PersistentDict, a=1))
+            oids.add(pop.root[0]._p_oid)
+            del pop.root[0]
+        self.assertEqual(len(oids), 1)
+        type_counts, gc_counts = pop.gc(debug=True)
+        self.assertNotIn('PersistentDict', type_counts)
+        self.assertGCCollectedNothing(gc_counts)
+
+    def test_reused_header_is_returned_on_abort(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        pop.root.append(pop.new(pmemobj.PersistentList))
+        del pop.root[0]
+        before = dict((k, len(v)) for k, v in pop.mm._freelists.items())
+        self.assertIn(1, before.values())
+        with self.assertRaisesRegex(Exception, 'boo'):
+            with pop.transaction():
+                pop.root.append(pop.new(pmemobj.PersistentList, [1]))
+                raise Exception('boo')
+        after = dict((k, len(v)) for k, v in pop.mm._freelists.items())
+        self.assertEqual(before, after)
+        pop.root.append(pop.new(pmemobj.PersistentList, [1]))
+        self.assertEqual(pop.root, [[1]])
+        type_counts, gc_counts = pop.gc(debug=True)
+        self.assertEqual(type_counts['PersistentList'], 3)
+        self.assertGCCollectedNothing(gc_counts)
+
+    def test_recycled_headers_are_freed_after_crash(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        for i in range(3):
+            pop.root.append(pop.new(pmemobj.PersistentDict))
+        pop.root.clear()
+        # Fake a crash by not letting the gc run.
+        try:
+            old_gc = pmemobj.PersistentObjectPool.gc
+            pmemobj.PersistentObjectPool.gc = lambda *args, **kw: None
+            pop.close()
+        finally:
+            pmemobj.PersistentObjectPool.gc = old_gc
+        pop = pmemobj.open(self.fn)
+        type_counts, gc_counts = pop.gc(debug=True)
+        self.assertEqual(type_counts['PersistentList'], 2)
+        self.assertNotIn('PersistentDict', type_counts)
+        self.assertGCCollectedNothing(gc_counts)
+
     def test_gc_does_not_run_on_startup_after_clean_shutdown(self):
         pop = self._pop()
         pop.root = pop.new(pmemobj.PersistentDict)
@@ -473,6 +1486,273 @@ class TestGC(TestCase):
             pmemobj.PersistentObjectPool.gc = old_gc
         self.assertFalse(self.called)
 
+    def _crash(self, pop):
+        # Fake a crash by not letting the gc run.
+        try:
+            old_gc = pmemobj.PersistentObjectPool.gc
+            pmemobj.PersistentObjectPool.gc = lambda *args, **kw: None
+            pop.close()
+        finally:
+            pmemobj.PersistentObjectPool.gc = old_gc
+
+    def _counting_gc(self, func, *args, **kw):
+        self.called = False
+
+        def fake_gc(*args, **kw):
+            self.called = True
+        try:
+            old_gc = pmemobj.PersistentObjectPool.gc
+            pmemobj.PersistentObjectPool.gc = fake_gc
+            return func(*args, **kw)
+        finally:
+            pmemobj.PersistentObjectPool.gc = old_gc
+
+    def _open_counting_gc(self, **kw):
+        pop = self._counting_gc(pmemobj.open, self.fn, **kw)
+        self.addCleanup(pop.close)
+        return pop
+
+    def test_read_only_open_and_close_do_not_gc(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList, ['long string value'])
+        pop.new(pmemobj.PersistentList)
+        self._crash(pop)
+        pop = self._counting_gc(pmemobj.open, self.fn, read_only=True)
+        self.assertFalse(self.called)
+        self.assertEqual(pop.root, ['long string value'])
+        self._counting_gc(pop.close)
+        self.assertFalse(self.called)
+        # The pool still needs cleaning up.
+        pop = self._open_counting_gc()
+        self.assertTrue(self.called)
+
+    def test_gc_runs_on_startup_after_crash_following_clean_shutdown(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        pop.close()
+        pop = pmemobj.open(self.fn)
+        pop.root.append(pop.new(pmemobj.PersistentDict))
+        self._crash(pop)
+        self._open_counting_gc()
+        self.assertTrue(self.called)
+
+    def _make_cycle(self, pop):
+        d = pop.new(pmemobj.PersistentDict, s='long string value')
+        d['self'] = d
+        return d
+
+    def test_background_recovery(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList,
+                           [self._make_cycle(pop) for i in range(5)])
+        pop.root.clear()
+        pop.root.append(pop.new(pmemobj.PersistentDict, a='kept value'))
+        self._crash(pop)
+        pop = self._open_counting_gc(recovery='background')
+        self.assertFalse(self.called)
+        pop._recovery_thread.join()
+        self.assertIsNone(pop._collection)
+        self.assertEqual(pop.root[0]['a'], 'kept value')
+        type_counts, gc_counts = pop.gc()
+        self.assertEqual(type_counts['PersistentDict'], 1)
+        self.assertGCCollectedNothing(gc_counts)
+
+    def test_invalid_recovery(self):
+        with self.assertRaises(ValueError):
+            pmemobj.open(self._test_fn(), recovery='later')
+
+    def test_incremental_collection_sees_concurrent_changes(self):
+        from nvm.pmemobj.pool import _IncrementalCollector
+        pop = self._pop()
+        a = pop.new(pmemobj.PersistentList)
+        b = pop.new(pmemobj.PersistentList)
+        pop.root = pop.new(pmemobj.PersistentList, [b, a])
+        for l in (a, b):
+            l.append(pop.new(pmemobj.PersistentDict, s='moved value'))
+        self._make_cycle(pop)
+        collector = _IncrementalCollector(pop)
+        collector.start()
+        # Trace one of the lists, but not yet the other.  The grey list
+        # holds offsets.
+        def traced(l):
+            return (l._p_oid in collector._reached
+                    and l._p_oid[1] not in collector._grey)
+        while not (traced(a) or traced(b)):
+            collector.step(1)
+        done, pending = (a, b) if traced(a) else (b, a)
+        self.assertIn(pending._p_oid[1], collector._grey)
+        # Move the other's dict to the one that has already been traced.
+        done.append(pending[0])
+        del pending[0]
+        done.append(pop.new(pmemobj.PersistentList, ['new value']))
+        while not collector.step(1):
+            pass
+        self.assertEqual(collector.counts['collections-gced'], 1)
+        self.assertEqual(done[1]['s'], 'moved value')
+        self.assertEqual(done[2][0], 'new value')
+        type_counts, gc_counts = pop.gc()
+        self.assertGCCollectedNothing(gc_counts)
+
+    def test_close_skips_gc_if_nothing_changed(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList, ['long string value'])
+        pop.close()
+        pop = self._open_counting_gc()
+        self.assertEqual(pop.root[0], 'long string value')
+        self._counting_gc(pop.close, force_gc=False)
+        self.assertFalse(self.called)
+        # It was still a clean shutdown.
+        self._open_counting_gc()
+        self.assertFalse(self.called)
+
+    def test_close_runs_gc_after_changes(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList, ['long string value'])
+        pop.close()
+        pop = self._open_counting_gc()
+        del pop.root[0]
+        self._counting_gc(pop.close, force_gc=False)
+        self.assertTrue(self.called)
+
+    def test_gc_does_not_resurrect_containers(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        l = pop.new(pmemobj.PersistentList)
+        d = pop.new(pmemobj.PersistentDict, l=l)
+        t = pop.new(pmemobj.PersistentTuple, [d, 'long string value'])
+        l.append(t)
+        l.append(pop.new(pmemobj.PersistentSet, ['another long string']))
+        pop.root.append(l)
+        del l, d, t
+        pop.gc()
+        pop.root.clear()
+        resurrected = []
+        resurrect = pop.mm.resurrect
+
+        def recording_resurrect(oid):
+            obj = resurrect(oid)
+            resurrected.append(obj)
+            return obj
+        pop.mm.resurrect = recording_resurrect
+        try:
+            type_counts, gc_counts = pop.gc(debug=False)
+        finally:
+            del pop.mm.resurrect
+        self.assertEqual(gc_counts['collections-gced'], 4)
+        self.assertEqual(
+            [x for x in resurrected if hasattr(x, '_p_traverse')], [])
+        type_counts, gc_counts = pop.gc(debug=True)
+        self.assertGCCollectedNothing(gc_counts)
+
+    def test_parallel_gc(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        for i in range(20):
+            l = pop.new(pmemobj.PersistentList,
+                        [i, 'long string {}'.format(i)])
+            d = pop.new(pmemobj.PersistentDict, l=l, s=pop.new(
+                            pmemobj.PersistentSet, ['set member {}'.format(i)]))
+            l.append(pop.new(pmemobj.PersistentTuple, [d, pop.root]))
+            l.append(pop.new(TracedObject))
+            pop.root.append(d)
+            self._make_cycle(pop)
+        del l, d
+        type_counts, gc_counts = pop.gc(workers=3)
+        self.assertEqual(gc_counts['collections-gced'], 20)
+        type_counts, serial_counts = pop.gc()
+        self.assertGCCollectedNothing(serial_counts)
+        self.assertEqual(gc_counts['containers-live'],
+                         serial_counts['containers-live'])
+        self.assertEqual(gc_counts['other-live'],
+                         serial_counts['other-live'])
+        self.assertEqual(pop.root[19]['l'][3].items['n'], 'long string 19')
+
+    def test_gc_threshold(self):
+        pop = self._pop()
+        self.assertEqual(pop.get_gc_threshold(), (700, 10, 10))
+        pop.set_gc_threshold(100, 5)
+        self.assertEqual(pop.get_gc_threshold(), (100, 5, 10))
+        pop.close()
+        pop = pmemobj.open(self.fn)
+        self.addCleanup(pop.close)
+        self.assertEqual(pop.get_gc_threshold(), (100, 5, 10))
+
+    def test_gc_step_collects_young_cycles(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        self.assertIsNone(pop.gc_step())
+        for i in range(5):
+            pop.root.append(self._make_cycle(pop))
+        pop.root.append(pop.new(pmemobj.PersistentDict, a='kept value'))
+        for i in range(5):
+            del pop.root[0]
+        # Not enough new objects to be worth a collection.
+        self.assertIsNone(pop.gc_step())
+        self.assertGreater(pop.get_gc_count()[0], 5)
+        pop.set_gc_threshold(5)
+        self.assertEqual(pop.gc_step(), 0)
+        self.assertEqual(pop.get_gc_count(), (0, 1, 0))
+        self.assertEqual(pop.root[0]['a'], 'kept value')
+        type_counts, gc_counts = pop.gc(debug=True)
+        self.assertGCCollectedNothing(gc_counts)
+
+    def test_gc_step_full_collection(self):
+        pop = self._pop()
+        pop.set_gc_threshold(1, 0, 0)
+        pop.root = pop.new(pmemobj.PersistentList,
+                           [self._make_cycle(pop) for i in range(5)])
+        # These were created before generational collection started, so
+        # only a full collection can free them.
+        pop.root.clear()
+        self.assertIsNone(pop.gc_step())
+        collected = []
+        for i in range(3):
+            pop.root.append(pop.new(pmemobj.PersistentDict,
+                                    a='kept value {}'.format(i)))
+            generation = pop.gc_step(max_objects=3)
+            while generation is None and pop._collection is not None:
+                generation = pop.gc_step(max_objects=3)
+            collected.append(generation)
+        self.assertEqual(collected, [0, 1, 2])
+        self.assertEqual(pop.get_gc_count(), (0, 0, 0))
+        self.assertEqual(len(pop.root), 3)
+        type_counts, gc_counts = pop.gc(debug=True)
+        self.assertGCCollectedNothing(gc_counts)
+
+    def test_gc_step_keeps_objects_in_use(self):
+        # Unreachable objects that the program still has are left alone.
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        pop.set_gc_threshold(1, 0, 0)
+        self.assertIsNone(pop.gc_step())
+        l = pop.new(pmemobj.PersistentList)
+        d = pop.new(pmemobj.PersistentDict, l=l)
+        l.append(d)
+        l.append('long string value')
+        self.assertEqual(pop.gc_step(), 0)
+        self.assertEqual(d['l'][1], 'long string value')
+        # Nor does a full collection free them.
+        collected = []
+        for i in range(3):
+            pop.root.append(pop.new(pmemobj.PersistentDict,
+                                    a='kept value {}'.format(i)))
+            generation = pop.gc_step(max_objects=3)
+            while generation is None and pop._collection is not None:
+                generation = pop.gc_step(max_objects=3)
+            collected.append(generation)
+        self.assertIn(2, collected)
+        self.assertIs(l[0], d)
+        self.assertEqual(d['l'][1], 'long string value')
+        # Once they are dropped they are garbage.
+        del l, d
+        type_counts, gc_counts = pop.gc()
+        self.assertEqual(gc_counts['collections-gced'], 2)
+
+    def test_gc_step_in_transaction(self):
+        pop = self._pop()
+        with pop.transaction():
+            self.assertRaises(RuntimeError, pop.gc_step)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -98,5 +98,19 @@ class TestPersistentTuple(TestCase):
         tpl_2 = self._make_tuple([1, 2, 3])
         self.assertNotEqual(tpl_1, tpl_2)
 
+    def test_deallocate(self):
+        self._make_tuple(['a string that is not inline', 2**62])
+        before = self.pop.gc(debug=True)[0]
+        self.pop.root = None
+        after = self.pop.gc(debug=True)[0]
+        for typ in ('PersistentTuple', 'int', 'str'):
+            self.assertEqual(after.get(typ, 0), before[typ] - 1)
+
+    def test_empty(self):
+        tpl = self._make_tuple([])
+        self.assertEqual(tpl, ())
+        self.assertEqual(self._reread_tuple(), ())
+        self.pop.root = None
+
 if __name__ == '__main__':
     unittest.main()